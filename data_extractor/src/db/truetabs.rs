@@ -2,16 +2,45 @@ use anyhow::{Result, anyhow};
 use serde_json::Value as JsonValue;
 use reqwest::{Client, header};
 use std::error::Error;
+use std::sync::OnceLock;
+use std::time::Duration;
 
 const TRUETABS_BASE_URL: &str = "https://true.tabs.sale/fusion/v1";
 
+static HTTP_CLIENT: OnceLock<Client> = OnceLock::new();
+
+/// Total request timeout in seconds from TRUETABS_REQUEST_TIMEOUT_SECS; unset or 0 means no limit
+/// (large update_records batches can legitimately take a long time).
+fn request_timeout() -> Option<Duration> {
+    std::env::var("TRUETABS_REQUEST_TIMEOUT_SECS")
+        .ok()
+        .and_then(|value| value.trim().parse::<u64>().ok())
+        .filter(|&secs| secs > 0)
+        .map(Duration::from_secs)
+}
+
+/// Shared client: connections (and TLS sessions) are reused across requests to True Tabs.
+fn http_client() -> &'static Client {
+    HTTP_CLIENT.get_or_init(|| {
+        let mut builder = Client::builder()
+            .connect_timeout(Duration::from_secs(10))
+            .pool_idle_timeout(Duration::from_secs(90))
+            .pool_max_idle_per_host(8)
+            .tcp_keepalive(Duration::from_secs(60));
+        if let Some(timeout) = request_timeout() {
+            builder = builder.timeout(timeout);
+        }
+        builder.build().expect("failed to build True Tabs HTTP client")
+    })
+}
+
 pub async fn update_records(
     api_token: &str,
     datasheet_id: &str,
     field_key: &str,
     updates: Vec<JsonValue>,
 ) -> Result<JsonValue, Box<dyn Error + Send + Sync>> {
-    let client = Client::new();
+    let client = http_client();
     let url = format!("{}/datasheets/{}/records", TRUETABS_BASE_URL, datasheet_id);
 
     let mut body = JsonValue::from(serde_json::Map::new());
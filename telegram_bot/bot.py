@@ -3,9 +3,8 @@ import asyncio
 import logging
 import sys
 import os
-import json
+import time
 import config
-from datetime import datetime
 from typing import Optional
 
 from aiogram import Bot, Dispatcher
@@ -15,10 +14,9 @@ from aiogram.client.default import DefaultBotProperties
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
-from apscheduler.triggers.date import DateTrigger
 from apscheduler.jobstores.base import JobLookupError
+from apscheduler.events import EVENT_JOB_SUBMITTED
 
 from telegram_bot.handlers import main_router
 from telegram_bot.handlers import upload_handlers # Убедитесь, что импортированы
@@ -29,7 +27,12 @@ from telegram_bot.handlers import scheduled_handlers # НОВЫЙ ИМПОРТ
 from telegram_bot.handlers import weather_handlers
 
 from config import BOT_TOKEN, TEMP_FILES_DIR
-from telegram_bot.database.sqlite_db import init_db, list_all_scheduled_jobs, delete_scheduled_job, SQLITE_DB_PATH
+from telegram_bot.database.sqlite_db import init_db, close_db, list_all_scheduled_jobs, delete_scheduled_job, SQLITE_DB_PATH
+from telegram_bot.utils import leases
+from telegram_bot.utils.offload import shutdown_offload
+from telegram_bot.utils.truetabs_api import TrueTabsClient, set_truetabs_client
+from telegram_bot.utils.retention import RETENTION_JOB_ID, run_retention
+from telegram_bot.utils.scheduling import job_policy
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging.getLogger('apscheduler').setLevel(logging.INFO)
@@ -62,6 +65,10 @@ async def main() -> None:
     await init_db()
     print("База данных SQLite инициализирована.")
 
+    # Общий HTTP-клиент True Tabs (пул соединений) для всех хэндлеров
+    truetabs_client = TrueTabsClient()
+    set_truetabs_client(truetabs_client)
+
     # --- Настройка и запуск планировщика APScheduler ---
 
     jobstores = {
@@ -73,61 +80,43 @@ async def main() -> None:
     }
 
     global scheduler
-    scheduler = AsyncIOScheduler(jobstores=jobstores, executors=executors)
-
-    logging.info("Загрузка запланированных заданий из базы данных в планировщик...")
-    all_jobs_from_db = await list_all_scheduled_jobs()
-
-    for job_data in all_jobs_from_db:
-        try:
-            trigger_type = job_data['trigger_type']
-            trigger_args = json.loads(job_data['trigger_args_json'])
-            trigger = None
-
-            if trigger_type == 'interval':
-                trigger = IntervalTrigger(**trigger_args)
-            elif trigger_type == 'cron':
-                trigger = CronTrigger(**trigger_args)
-            elif trigger_type == 'date':
-                 try:
-                     run_date = datetime.fromisoformat(trigger_args.get('run_date'))
-                     if run_date < datetime.now(run_date.tzinfo):
-                         logging.warning(f"Пропуск загрузки запланированного задания '{job_data['name']}' (ID: {job_data['job_id']}): Дата запуска ({run_date}) в прошлом.")
-                         continue
-                     trigger = DateTrigger(run_date=run_date)
-                 except Exception as date_e:
-                      logging.warning(f"Пропуск загрузки запланированного задания '{job_data['name']}' (ID: {job_data['job_id']}): Ошибка при парсинге даты запуска или DateTrigger не полностью поддержан: {date_e}")
-                      continue
-
-
-            if trigger and job_data['enabled']:
-                 scheduler.add_job(
-                     scheduled_handlers.scheduled_task_executor,
-                     trigger=trigger,
-                     id=job_data['job_id'],
-                     name=job_data['name'],
-                     kwargs={
-                         'bot': bot, # Передаем экземпляр бота!
-                         'chat_id': job_data['chat_id'],
-                         'source_config_name': job_data['source_config_name'],
-                         'tt_config_name': job_data['tt_config_name'],
-                         'action': job_data['action'],
-                         'job_name': job_data['name']
-                     },
-                     replace_existing=True
-                 )
-                 logging.info(f"Загружено запланированное задание '{job_data['name']}' (ID: {job_data['job_id']}).")
-            elif not job_data['enabled']:
-                 logging.info(f"Пропуск отключенного запланированного задания '{job_data['name']}' (ID: {job_data['job_id']}).")
-            else:
-                 logging.error(f"Не удалось создать триггер для запланированного задания '{job_data['name']}' (ID: {job_data['job_id']}). Пропуск.")
-
-
-        except Exception as e:
-            logging.error(f"Критическая ошибка при загрузке запланированного задания '{job_data.get('name', 'Неизвестно')}' (ID: {job_data.get('job_id', 'Неизвестно')}) из БД: {e}", exc_info=True)
-
-
-    scheduler.start()
+    scheduler = AsyncIOScheduler(jobstores=jobstores, executors=executors, job_defaults=job_policy())
+    # Хэндлерам расписания нужны планировщик и бот (бот не сохраняется в kwargs заданий)
+    scheduled_handlers.scheduler = scheduler
+    scheduled_handlers.bot = bot
+    # Плановое время срабатывания нужно для аренды запуска, когда работают несколько экземпляров бота
+    scheduler.add_listener(leases.on_job_submitted, EVENT_JOB_SUBMITTED)
+    # Запуски остановившихся экземпляров закрываются с ошибкой, об этом сообщается в чат задания
+    leases.on_lost_runs = scheduled_handlers.report_lost_runs
+    await leases.heartbeat()
+    heartbeat_task = asyncio.create_task(leases.run_heartbeat())
+    logging.info(f"Экземпляр планировщика: {leases.INSTANCE_ID}")
+
+    # Хранилище заданий загружается при запуске планировщика; на паузе задания не срабатывают,
+    # пока хранилище сверяется с scheduled_jobs (пишутся только новые и измененные задания)
+    scheduler.start(paused=True)
+    logging.info("Сверка запланированных заданий с хранилищем планировщика...")
+    reconcile_started = time.monotonic()
+    counts = scheduled_handlers.reconcile_scheduler(await list_all_scheduled_jobs())
+    logging.info(
+        f"Задания планировщика сверены за {time.monotonic() - reconcile_started:.3f} сек: "
+        f"без изменений {counts['unchanged']}, добавлено {counts['added']}, обновлено {counts['updated']}, "
+        f"удалено {counts['removed']}, не по расписанию (отключены, после других заданий, дата прошла) {counts['not_scheduled']}; "
+        f"пропущенных за время простоя запусков будет выполнено: {counts['catch_up']}."
+    )
+
+    # Ежедневная очистка истории загрузок и файлов результатов
+    scheduler.add_job(
+        run_retention,
+        trigger=CronTrigger(hour=config.RETENTION_CRON_HOUR, minute=0),
+        id=RETENTION_JOB_ID,
+        name="Очистка истории загрузок",
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1,
+    )
+
+    scheduler.resume()
     logging.info("Планировщик APScheduler запущен.")
 
     print("Запуск бота...")
@@ -137,6 +126,11 @@ async def main() -> None:
         logging.info("Остановка планировщика APScheduler...")
         scheduler.shutdown()
         logging.info("Планировщик остановлен.")
+        heartbeat_task.cancel()
+        await leases.leave()
+        shutdown_offload()
+        await truetabs_client.aclose()
+        await close_db()
 
 
 if __name__ == "__main__":
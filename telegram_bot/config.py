@@ -8,15 +8,83 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 WEATHER_API_KEY = os.environ.get('WEATHER_API_KEY')
 
+# Время жизни кэша ответов OpenWeatherMap (секунды): текущая погода и прогноз кэшируются отдельно
+WEATHER_CURRENT_CACHE_TTL = int(os.getenv("WEATHER_CURRENT_CACHE_TTL", "600"))
+WEATHER_FORECAST_CACHE_TTL = int(os.getenv("WEATHER_FORECAST_CACHE_TTL", "1800"))
+
+# Telegram ID пользователей, которым доступна команда /stats (через запятую). Пусто - доступна всем.
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
 RUST_EXECUTABLE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data_extractor', 'target', 'release', 'data_extractor')
+# Ограничение времени одного запуска Rust утилиты (секунды, 0 - без ограничения; у задания - trigger_args['timeout_seconds'])
+# и сколько ждать завершения после SIGTERM, прежде чем группа процессов получит SIGKILL
+RUST_RUN_TIMEOUT_SECONDS = int(os.getenv("RUST_RUN_TIMEOUT_SECONDS", "3600"))
+RUST_TERMINATE_GRACE_SECONDS = int(os.getenv("RUST_TERMINATE_GRACE_SECONDS", "10"))
 
 TEMP_FILES_DIR = os.path.join(os.path.dirname(__file__), 'temp')
 
 SQLITE_DB_PATH = os.path.join(os.path.dirname(__file__), 'database', 'upload_history.db')
 
+# Отложенная запись истории загрузок: сохранять пачкой по N записей или не реже чем раз в M миллисекунд
+UPLOAD_HISTORY_BATCH_SIZE = int(os.getenv("UPLOAD_HISTORY_BATCH_SIZE", "50"))
+UPLOAD_HISTORY_FLUSH_MS = int(os.getenv("UPLOAD_HISTORY_FLUSH_MS", "500"))
+
+# Очистка истории (ежедневное задание планировщика)
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "90")) # Более старые записи сворачиваются в дневные итоги
+ERROR_MESSAGE_INLINE_CHARS = int(os.getenv("ERROR_MESSAGE_INLINE_CHARS", "1000")) # Длиннее - полный текст уходит в сжатый архив
+RESULT_FILE_GRACE_HOURS = int(os.getenv("RESULT_FILE_GRACE_HOURS", "24")) # Файлы без ссылок из истории удаляются, если старше
+RETENTION_CRON_HOUR = int(os.getenv("RETENTION_CRON_HOUR", "3")) # Час запуска очистки
+
+# Запланированные задания: сколько запусков Rust утилиты выполняется одновременно
+# и насколько поздно (в секундах) пропущенный запуск еще выполняется
+SCHEDULED_MAX_CONCURRENT_RUNS = int(os.getenv("SCHEDULED_MAX_CONCURRENT_RUNS", "2"))
+SCHEDULED_MISFIRE_GRACE_SECONDS = int(os.getenv("SCHEDULED_MISFIRE_GRACE_SECONDS", "300"))
+# Допуск запусков (utils.admission): суммарная ожидаемая пиковая память одновременных запусков (МиБ, 0 - не ограничивать)
+# и сколько секунд ожидаемой длительности "списывает" с запуска каждая секунда ожидания (тяжелые задания не ждут вечно)
+SCHEDULED_MEMORY_BUDGET_MB = int(os.getenv("SCHEDULED_MEMORY_BUDGET_MB", "0"))
+SCHEDULED_AGING_RATE = float(os.getenv("SCHEDULED_AGING_RATE", "1.0"))
+# Разнос запусков: повторяющиеся задания сдвигаются на постоянную (по хэшу ID) величину в пределах окна, 0 - выключено
+SCHEDULE_SPREAD_SECONDS = int(os.getenv("SCHEDULE_SPREAD_SECONDS", "0"))
+# Включенное задание без успешного запуска дольше этого (часы) считается просроченным (/stats), 0 - не проверять
+SCHEDULE_SLA_HOURS = int(os.getenv("SCHEDULE_SLA_HOURS", "24"))
+# После ошибок подряд следующий запуск откладывается: период x 2^(число ошибок), но не дольше этого (секунды)
+SCHEDULE_BACKOFF_MAX_SECONDS = int(os.getenv("SCHEDULE_BACKOFF_MAX_SECONDS", str(6 * 3600)))
+# Запуски, пропущенные за время простоя (политика задания 'all'): сколько последних выполнять не больше,
+# и окно (секунды), в пределах которого разносятся по заданиям начала догоняющих запусков после старта
+SCHEDULE_CATCHUP_MAX_RUNS = int(os.getenv("SCHEDULE_CATCHUP_MAX_RUNS", "10"))
+SCHEDULE_CATCHUP_SPREAD_SECONDS = int(os.getenv("SCHEDULE_CATCHUP_SPREAD_SECONDS", "300"))
+# Шаг конвейера с несколькими предшественниками ждет остальных не дольше этого (часы) после первого завершения;
+# затем цикл бросается, и старые результаты не используются в следующем
+SCHEDULE_PIPELINE_WINDOW_HOURS = int(os.getenv("SCHEDULE_PIPELINE_WINDOW_HOURS", "24"))
+# Как часто (секунды) запуск, ожидающий предыдущий запуск задания на другом экземпляре, проверяет очередь в БД,
+# и выполняющийся запуск - не просит ли следующий его остановиться (политика наложения 'cancel')
+SCHEDULE_OVERRUN_POLL_SECONDS = float(os.getenv("SCHEDULE_OVERRUN_POLL_SECONDS", "2"))
+
+# Несколько экземпляров бота с общей БД: каждый запуск задания выполняет один экземпляр (аренда в run_leases).
+SCHEDULER_INSTANCE_ID = os.getenv("SCHEDULER_INSTANCE_ID", "") # Пусто - <hostname>-<pid>
+SCHEDULER_HEARTBEAT_SECONDS = int(os.getenv("SCHEDULER_HEARTBEAT_SECONDS", "15"))
+SCHEDULER_INSTANCE_TTL_SECONDS = int(os.getenv("SCHEDULER_INSTANCE_TTL_SECONDS", "60")) # Без heartbeat дольше - экземпляр считается остановленным
+
 TRUE_TABS_DATASHEET_ID = os.getenv("TRUE_TABS_DATASHEET_ID")
 TRUE_TABS_API_TOKEN = os.getenv("TRUE_TABS_API_TOKEN")
 
+# Постраничная выгрузка записей True Tabs: размер страницы и число одновременных запросов к API
+TRUE_TABS_PAGE_SIZE = int(os.getenv("TRUE_TABS_PAGE_SIZE", "1000"))
+TRUE_TABS_MAX_CONCURRENT_REQUESTS = int(os.getenv("TRUE_TABS_MAX_CONCURRENT_REQUESTS", "4"))
+# Общий HTTP-клиент True Tabs: таймаут запроса (секунды) и HTTP/2 (требует пакет h2)
+TRUE_TABS_TIMEOUT = float(os.getenv("TRUE_TABS_TIMEOUT", "30"))
+TRUE_TABS_HTTP2 = os.getenv("TRUE_TABS_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Локальная копия таблиц True Tabs: допустимый возраст копии при выгрузке (секунды) и период полной синхронизации (часы)
+TRUE_TABS_MIRROR_MAX_AGE = int(os.getenv("TRUE_TABS_MIRROR_MAX_AGE", "300"))
+TRUE_TABS_MIRROR_FULL_SYNC_HOURS = int(os.getenv("TRUE_TABS_MIRROR_FULL_SYNC_HOURS", "24"))
+
+# Пулы для выноса тяжелой работы из event loop: потоки (ввод-вывод) и процессы (CPU)
+OFFLOAD_THREAD_WORKERS = int(os.getenv("OFFLOAD_THREAD_WORKERS", "4"))
+OFFLOAD_PROCESS_WORKERS = int(os.getenv("OFFLOAD_PROCESS_WORKERS", "2"))
+# JSON-вывод Rust утилиты от этого размера (байт) разбирается в пуле процессов
+OFFLOAD_JSON_MIN_BYTES = int(os.getenv("OFFLOAD_JSON_MIN_BYTES", str(1024 * 1024)))
+
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
 
 if not BOT_TOKEN:
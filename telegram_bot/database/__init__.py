@@ -1,7 +1,10 @@
 from .sqlite_db import (
     init_db,
+    close_db,
     add_upload_record,
+    flush_upload_records,
     get_upload_history,
+    get_upload_history_page,
     count_upload_history,
     add_source_config,
     get_source_config,
@@ -11,14 +14,17 @@ from .sqlite_db import (
     get_tt_config,
     list_tt_configs,
     delete_tt_config,
-    get_last_upload_for_scheduled_job
+    list_schedule_runs
 )
 
 
 __all__ = [
     'init_db',
+    'close_db',
     'add_upload_record',
+    'flush_upload_records',
     'get_upload_history',
+    'get_upload_history_page',
     'count_upload_history',
     'add_source_config',
     'get_source_config',
@@ -28,5 +34,5 @@ __all__ = [
     'get_tt_config',
     'list_tt_configs',
     'delete_tt_config',
-    'get_last_upload_for_scheduled_job'
+    'list_schedule_runs'
 ]
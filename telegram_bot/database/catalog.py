@@ -0,0 +1,118 @@
+import asyncio
+import copy
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Каталог конфигураций в памяти процесса: таблица читается из SQLite один раз и до первого изменения
+# (функции записи в sqlite_db вызывают invalidate). Строки хранятся как в БД - с зашифрованными секретами;
+# расшифровка выполняется при первом запросе полной конфигурации (запуск операции) и запоминается.
+# Изменения из других процессов (несколько экземпляров бота с общей БД) видны по версии таблицы:
+# триггеры SQLite увеличивают ее при каждой записи, и при чтении копия с другой версией перечитывается.
+
+
+class ConfigCatalog:
+    """In-memory copy of one config table, keyed by a unique column."""
+
+    def __init__(self, name: str, load_rows: Callable[[], Awaitable[List[Dict[str, Any]]]], key: str,
+                 decrypt_row: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+                 load_version: Optional[Callable[[], Awaitable[int]]] = None):
+        self.name = name
+        self._load_rows = load_rows
+        self._key = key
+        self._decrypt_row = decrypt_row
+        self._load_version = load_version
+        self._rows: Optional[Dict[Any, Dict[str, Any]]] = None
+        self._decrypted: Dict[Any, Dict[str, Any]] = {}
+        self._generation = 0
+        self._version: Optional[int] = None # Версия таблицы в БД, с которой загружена копия
+        self._lock = asyncio.Lock()
+        self.loads = 0
+        self.hits = 0
+        self.decryptions = 0
+        self.external_changes = 0
+
+    async def _check_version(self) -> None:
+        """Drops the cached copy if the table was changed by another connection (another bot instance) since it was loaded."""
+        if self._load_version is None or self._rows is None:
+            return # Расшифрованные строки без копии таблицы не хранятся
+        version = await self._load_version()
+        if self._rows is not None and version != self._version:
+            self.external_changes += 1
+            self.invalidate()
+
+    async def rows(self) -> List[Dict[str, Any]]:
+        """All rows in load order (secrets still encrypted). Callers must not modify them."""
+        await self._check_version()
+        rows = self._rows
+        if rows is not None:
+            self.hits += 1
+            return list(rows.values())
+        async with self._lock:
+            if self._rows is None:
+                generation = self._generation
+                # Версия читается до строк: если таблицу изменят после, копия будет перечитана при следующем чтении
+                version = await self._load_version() if self._load_version else None
+                loaded = {row[self._key]: row for row in await self._load_rows()}
+                self.loads += 1
+                # Таблицу изменили во время чтения - загруженная копия может быть устаревшей, не запоминаем
+                if generation != self._generation:
+                    return list(loaded.values())
+                self._rows = loaded
+                self._version = version
+            return list(self._rows.values())
+
+    async def get(self, key: Any) -> Optional[Dict[str, Any]]:
+        """Row by key without decrypting anything."""
+        for row in await self.rows():
+            if row[self._key] == key:
+                return row
+        return None
+
+    async def get_decrypted(self, key: Any) -> Optional[Dict[str, Any]]:
+        """Row by key with secrets decrypted (once per row until the table changes). Returns a deep copy."""
+        await self._check_version()
+        generation = self._generation
+        decrypted = self._decrypted.get(key)
+        if decrypted is not None:
+            self.hits += 1
+        else:
+            row = await self.get(key)
+            if row is None:
+                return None
+            decrypted = self._decrypt_row(row) if self._decrypt_row else dict(row)
+            self.decryptions += 1
+            if generation == self._generation:
+                self._decrypted[key] = decrypted
+        return copy.deepcopy(decrypted)
+
+    def patch(self, key: Any, changes: Dict[str, Any], version: Optional[int] = None) -> None:
+        """
+        Applies changes to the cached row after a write that touched only this row's non-secret columns,
+        instead of reloading the whole table. A load in progress is discarded (its copy may predate the write).
+        version - table version right after the write: if other connections changed the table in between,
+        the copy is dropped instead.
+        """
+        if version is not None and self._version is not None and version != self._version + 1:
+            self.invalidate()
+            return
+        self._generation += 1
+        self._decrypted.pop(key, None)
+        if version is not None and self._version is not None:
+            self._version = version
+        if self._rows is not None and key in self._rows:
+            self._rows[key] = {**self._rows[key], **changes}
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._rows = None
+        self._version = None
+        self._decrypted.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'entries': len(self._rows) if self._rows is not None else 0,
+            'loads': self.loads,
+            'hits': self.hits,
+            'decryptions': self.decryptions,
+            'external_changes': self.external_changes,
+        }
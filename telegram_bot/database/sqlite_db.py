@@ -1,23 +1,93 @@
 import aiosqlite
+import asyncio
+import functools
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 from ..config import SQLITE_DB_PATH # BASE_DIR removed because it is not defined in config.py
+from ..config import UPLOAD_HISTORY_BATCH_SIZE, UPLOAD_HISTORY_FLUSH_MS
 from ..utils.encryption import encrypt_data, decrypt_data # Убедитесь, что у вас есть модуль encryption
+from .catalog import ConfigCatalog
 import json
 import sys
+import zlib
 from typing import Dict, Any, Optional, List
 
+# --- Управление соединениями ---
+# Соединения открываются один раз (init_db или первый запрос) и закрываются при остановке бота (close_db).
+# Запись идет через одно соединение под asyncio.Lock (транзакции разных корутин не перемешиваются),
+# чтение - через отдельное соединение: в режиме WAL читатели не блокируются записью.
+
+STATEMENT_CACHE_SIZE = 256 # Сколько подготовленных выражений sqlite3 держит на соединение
+PAGE_CACHE_KIB = 16384 # Размер кэша страниц SQLite на соединение
+
+_write_connection: Optional[aiosqlite.Connection] = None
+_read_connection: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+_open_lock = asyncio.Lock()
+
+async def _open_connection() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(SQLITE_DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+    db.row_factory = aiosqlite.Row # Строки с доступом по имени колонки (и по индексу)
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL') # В WAL безопасно: теряются лишь последние транзакции при сбое ОС
+    await db.execute(f'PRAGMA cache_size=-{PAGE_CACHE_KIB}')
+    await db.execute('PRAGMA temp_store=MEMORY')
+    await db.execute('PRAGMA busy_timeout=5000') # На случай других процессов (например, APScheduler job store)
+    return db
+
+async def _ensure_connections():
+    global _write_connection, _read_connection
+    if _write_connection is not None:
+        return
+    async with _open_lock:
+        if _write_connection is None:
+            # Убедитесь, что директория для БД существует
+            os.makedirs(os.path.dirname(SQLITE_DB_PATH), exist_ok=True)
+            write_connection = await _open_connection()
+            _read_connection = await _open_connection()
+            _write_connection = write_connection
+
+@asynccontextmanager
+async def _reader():
+    """Соединение для чтения (без блокировки)."""
+    await _ensure_connections()
+    yield _read_connection
+
+@asynccontextmanager
+async def _writer():
+    """Соединение для записи, захваченное на время блока. Незакоммиченные изменения откатываются при выходе."""
+    await _ensure_connections()
+    async with _write_lock:
+        try:
+            yield _write_connection
+        finally:
+            # Раньше незакоммиченное (например, после перехваченной ошибки) терялось при закрытии соединения
+            if _write_connection.in_transaction:
+                await _write_connection.rollback()
+
+async def close_db():
+    """Сохраняет отложенные записи истории и закрывает соединения с базой данных (при остановке бота)."""
+    global _write_connection, _read_connection
+    if _upload_flush_task is not None and not _upload_flush_task.done():
+        _upload_flush_task.cancel()
+    await _flush_pending_uploads()
+    async with _write_lock:
+        for connection in (_read_connection, _write_connection):
+            if connection is not None:
+                await connection.close()
+        _write_connection = None
+        _read_connection = None
+    # Каталоги читаются заново при следующем подключении (например, к другому файлу БД)
+    for catalog in (source_configs_catalog, tt_configs_catalog, scheduled_jobs_catalog):
+        catalog.invalidate()
+
 async def init_db():
     """
-    Инициализирует базу данных SQLite: создает директорию, если она не существует,
+    Инициализирует базу данных SQLite: открывает соединения (директория создается, если ее нет)
     и создает все необходимые таблицы, если они еще не существуют.
     """
-    # Убедитесь, что директория для БД существует
-    db_dir = os.path.dirname(SQLITE_DB_PATH)
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir, exist_ok=True)
-
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         # Таблица для истории загрузок
         await db.execute('''
             CREATE TABLE IF NOT EXISTS uploads (
@@ -76,14 +146,291 @@ async def init_db():
             )
         ''')
 
+        # Кэш геокодирования: нормализованное название города -> координаты и каноническое имя
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                query_key TEXT PRIMARY KEY, -- Нормализованная строка запроса (регистр и пробелы)
+                name TEXT NOT NULL, -- Каноническое название города
+                country TEXT, -- Код страны
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                updated_at TEXT NOT NULL -- Время сохранения (ISO формат)
+            )
+        ''')
+
+        # Локальные копии таблиц True Tabs: состояние синхронизации (наличие строки = копия включена)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS tt_mirror_datasheets (
+                datasheet_id TEXT PRIMARY KEY,
+                tt_config_name TEXT NOT NULL, -- Конфигурация TT, через которую синхронизируется копия
+                last_synced_at TEXT, -- Время последней успешной синхронизации (ISO формат)
+                last_full_sync_at TEXT, -- Время последней полной синхронизации (ISO формат)
+                watermark_ms INTEGER, -- Максимальный updatedAt среди полученных записей (мс)
+                record_count INTEGER DEFAULT 0
+            )
+        ''')
+
+        # Записи локальных копий таблиц True Tabs
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS tt_mirror_records (
+                datasheet_id TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                fields_json TEXT NOT NULL, -- Поля записи в JSON
+                updated_at_ms INTEGER, -- updatedAt записи в True Tabs (мс)
+                sync_token TEXT, -- Метка синхронизации, которой запись получена последний раз
+                PRIMARY KEY (datasheet_id, record_id)
+            )
+        ''')
+
+        await _apply_migrations(db)
+
+        await db.commit()
+
+async def _add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, column_type: str):
+    """Добавляет колонку в существующую таблицу, если ее еще нет."""
+    cursor = await db.execute(f'PRAGMA table_info({table})')
+    columns = [row[1] for row in await cursor.fetchall()]
+    if column not in columns:
+        await db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+# --- Версионные изменения схемы (PRAGMA user_version) ---
+# Таблицы в init_db - исходная схема; все последующие изменения добавляются сюда новой версией.
+
+async def _migration_1_tt_export_settings(db: aiosqlite.Connection):
+    # Настройки выгрузки для конфигураций True Tabs
+    await _add_column_if_missing(db, 'true_tabs_configs', 'export_fields_json', 'TEXT') # Список выгружаемых полей в JSON (NULL - все)
+    await _add_column_if_missing(db, 'true_tabs_configs', 'export_filter_formula', 'TEXT') # filterByFormula для выгрузки
+    await _add_column_if_missing(db, 'true_tabs_configs', 'export_view_id', 'TEXT') # viewId для выгрузки
+
+async def _migration_2_uploads_linkage_and_indexes(db: aiosqlite.Connection):
+    # Связь записи истории с запланированным заданием и чатом
+    await _add_column_if_missing(db, 'uploads', 'job_id', 'TEXT') # ID запланированного задания (NULL для ручных запусков)
+    await _add_column_if_missing(db, 'uploads', 'chat_id', 'INTEGER') # ID чата, из которого запущена операция
+    # Пагинация истории (ORDER BY timestamp DESC)
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_uploads_timestamp ON uploads (timestamp, id)')
+    # Последняя запись по заданию (get_latest_upload_history_by_job_id)
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_uploads_job_id_timestamp ON uploads (job_id, timestamp)')
+    # Последняя запись по таблице и типу источника
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_uploads_datasheet_source_timestamp ON uploads (true_tabs_datasheet_id, source_type, timestamp)')
+    # История операций чата
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_uploads_chat_id_timestamp ON uploads (chat_id, timestamp)')
+
+async def _migration_3_uploads_counter(db: aiosqlite.Connection):
+    # Счетчик записей истории, который поддерживают триггеры: COUNT(*) по всей таблице не нужен
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS table_counters (
+            name TEXT PRIMARY KEY, -- Имя таблицы
+            value INTEGER NOT NULL
+        )
+    ''')
+    await db.execute("INSERT OR REPLACE INTO table_counters (name, value) SELECT 'uploads', COUNT(*) FROM uploads")
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_uploads_count_insert AFTER INSERT ON uploads
+        BEGIN
+            UPDATE table_counters SET value = value + 1 WHERE name = 'uploads';
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_uploads_count_delete AFTER DELETE ON uploads
+        BEGIN
+            UPDATE table_counters SET value = value - 1 WHERE name = 'uploads';
+        END
+    ''')
+
+async def _migration_4_uploads_retention(db: aiosqlite.Connection):
+    # Дневные итоги по старым записям истории, свернутым при очистке (run_retention)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS uploads_daily (
+            day TEXT NOT NULL, -- Дата (YYYY-MM-DD)
+            source_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            runs INTEGER NOT NULL, -- Число операций
+            total_duration_seconds REAL NOT NULL DEFAULT 0,
+            max_duration_seconds REAL,
+            PRIMARY KEY (day, source_type, status)
+        )
+    ''')
+    # Полные тексты длинных сообщений об ошибках (zlib); в uploads остается начало текста
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS uploads_message_archive (
+            upload_id INTEGER PRIMARY KEY, -- uploads.id
+            message_zlib BLOB NOT NULL,
+            original_length INTEGER NOT NULL -- Длина исходного текста в байтах (UTF-8)
+        )
+    ''')
+
+async def _migration_5_scheduler_leases(db: aiosqlite.Connection):
+    # Экземпляры бота, выполняющие запланированные задания (heartbeat)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_instances (
+            instance_id TEXT PRIMARY KEY,
+            hostname TEXT,
+            pid INTEGER,
+            started_at REAL NOT NULL, -- Unix time
+            heartbeat_at REAL NOT NULL -- Unix time последнего heartbeat
+        )
+    ''')
+    # Аренда запусков: первая вставка (job_id, scheduled_for) определяет экземпляр, который выполняет запуск
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS run_leases (
+            job_id TEXT NOT NULL,
+            scheduled_for TEXT NOT NULL, -- Плановое время запуска (ISO)
+            instance_id TEXT NOT NULL,
+            claimed_at REAL NOT NULL, -- Unix time
+            PRIMARY KEY (job_id, scheduled_for)
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_run_leases_claimed_at ON run_leases (claimed_at)')
+
+async def _migration_6_schedule_runs(db: aiosqlite.Connection):
+    # Журнал запусков запланированных заданий (по одной строке на запуск)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL, -- scheduled_jobs.job_id
+            scheduled_at TEXT, -- Плановое время (для шагов конвейера - время готовности)
+            started_at TEXT NOT NULL, -- Начало выполнения (после ожидания в пуле)
+            finished_at TEXT,
+            status TEXT NOT NULL, -- RUNNING, SUCCESS, ERROR, SKIPPED
+            rows INTEGER, -- Извлечено строк / загружено записей
+            duration_seconds REAL,
+            queue_wait_seconds REAL -- Ожидание свободного места в пуле запусков
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_schedule_runs_job_id_started_at ON schedule_runs (job_id, started_at)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_schedule_runs_started_at ON schedule_runs (started_at)')
+    # Итоги последнего запуска прямо в задании: детали задания и проверки SLA не читают журнал
+    await _add_column_if_missing(db, 'scheduled_jobs', 'last_run_at', 'TEXT')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'last_run_status', 'TEXT')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'last_run_duration_seconds', 'REAL')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'last_run_rows', 'INTEGER')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'last_success_at', 'TEXT')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'runs_total', 'INTEGER NOT NULL DEFAULT 0')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'runs_failed', 'INTEGER NOT NULL DEFAULT 0')
+
+async def _migration_7_consecutive_failures(db: aiosqlite.Connection):
+    # Ошибки подряд (сбрасываются успешным запуском) - для увеличения интервала после ошибок
+    await _add_column_if_missing(db, 'scheduled_jobs', 'consecutive_failures', 'INTEGER NOT NULL DEFAULT 0')
+
+async def _migration_8_run_cost_estimates(db: aiosqlite.Connection):
+    # Пиковая память процесса выгрузки и оценки стоимости следующего запуска (для допуска запусков, utils.admission)
+    await _add_column_if_missing(db, 'schedule_runs', 'peak_memory_kb', 'INTEGER')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'est_duration_seconds', 'REAL')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'est_rows', 'REAL')
+    await _add_column_if_missing(db, 'scheduled_jobs', 'est_peak_memory_kb', 'INTEGER')
+    # Начальные оценки - по уже накопленному журналу
+    await db.execute('''
+        UPDATE scheduled_jobs SET
+            est_duration_seconds = (SELECT AVG(duration_seconds) FROM schedule_runs r
+                                    WHERE r.job_id = scheduled_jobs.job_id AND r.status NOT IN ('RUNNING', 'SKIPPED', 'CANCELLED')),
+            est_rows = (SELECT AVG(rows) FROM schedule_runs r
+                        WHERE r.job_id = scheduled_jobs.job_id AND r.status = 'SUCCESS')
+    ''')
+
+async def _migration_9_pipeline_ready(db: aiosqlite.Connection):
+    # Готовность шагов конвейера по циклам: какие предшественники успешно завершились в текущем цикле шага.
+    # Хранится в БД, а не в памяти: переживает перезапуск и видна всем экземплярам бота с общей БД
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_cycles (
+            job_id TEXT NOT NULL, -- Шаг конвейера (scheduled_jobs.job_id)
+            cycle INTEGER NOT NULL,
+            opened_at TEXT NOT NULL, -- Первое завершение предшественника в цикле
+            closed_at TEXT, -- Шаг запущен, пропущен или цикл брошен; NULL - цикл открыт
+            PRIMARY KEY (job_id, cycle)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_ready (
+            job_id TEXT NOT NULL,
+            cycle INTEGER NOT NULL,
+            upstream_job_id TEXT NOT NULL,
+            artifact_path TEXT, -- Файл результата предшественника
+            completed_at TEXT NOT NULL,
+            PRIMARY KEY (job_id, cycle, upstream_job_id)
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_cycles_opened_at ON pipeline_cycles (opened_at)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_ready_completed_at ON pipeline_ready (completed_at)')
+
+# Таблицы, копии которых держат каталоги в памяти (database.catalog)
+CATALOG_TABLES = ('source_configs', 'true_tabs_configs', 'scheduled_jobs')
+
+async def _migration_10_catalog_versions(db: aiosqlite.Connection):
+    # Версия каждой таблицы каталога: триггеры увеличивают ее в той же транзакции, что и запись,
+    # поэтому экземпляры бота с общей БД замечают изменения друг друга (ConfigCatalog._check_version)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in CATALOG_TABLES:
+        await db.execute('INSERT OR IGNORE INTO catalog_versions (name, version) VALUES (?, 0)', (table,))
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            await db.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{operation.lower()} AFTER {operation} ON {table}
+                BEGIN
+                    UPDATE catalog_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+
+async def _migration_11_run_owners(db: aiosqlite.Connection):
+    # Экземпляр, выполняющий запуск, и закрытие аренды по его завершении: запуски остановившегося
+    # экземпляра находит и закрывает другой (recover_lost_runs)
+    await _add_column_if_missing(db, 'schedule_runs', 'instance_id', 'TEXT')
+    await _add_column_if_missing(db, 'run_leases', 'finished_at', 'REAL') # Unix time; NULL - запуск еще идет
+    await db.execute('UPDATE run_leases SET finished_at = claimed_at WHERE finished_at IS NULL')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_schedule_runs_running ON schedule_runs (instance_id) WHERE status = 'RUNNING'")
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_run_leases_open ON run_leases (instance_id) WHERE finished_at IS NULL')
+
+async def _migration_12_active_runs(db: aiosqlite.Connection):
+    # Выполняющийся запуск каждого задания на любом экземпляре бота и не больше одного ожидающего за ним
+    # (политика наложения запусков: пропустить, поставить в очередь, остановить текущий)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS active_runs (
+            job_id TEXT PRIMARY KEY,
+            run_token TEXT NOT NULL, -- Выполняющийся запуск
+            instance_id TEXT NOT NULL,
+            started_at REAL NOT NULL, -- Unix time
+            queued_token TEXT, -- Запуск, ожидающий завершения текущего
+            queued_instance_id TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0 -- Ожидающий просит текущий запуск остановиться (политика 'cancel')
+        )
+    ''')
+
+SCHEMA_MIGRATIONS = [
+    (1, _migration_1_tt_export_settings),
+    (2, _migration_2_uploads_linkage_and_indexes),
+    (3, _migration_3_uploads_counter),
+    (4, _migration_4_uploads_retention),
+    (5, _migration_5_scheduler_leases),
+    (6, _migration_6_schedule_runs),
+    (7, _migration_7_consecutive_failures),
+    (8, _migration_8_run_cost_estimates),
+    (9, _migration_9_pipeline_ready),
+    (10, _migration_10_catalog_versions),
+    (11, _migration_11_run_owners),
+    (12, _migration_12_active_runs),
+]
+
+async def _apply_migrations(db: aiosqlite.Connection):
+    """Применяет изменения схемы с версией выше текущей PRAGMA user_version (каждое - вместе с новой версией)."""
+    cursor = await db.execute('PRAGMA user_version')
+    current_version = (await cursor.fetchone())[0]
+    for version, migration in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        await migration(db)
+        await db.execute(f'PRAGMA user_version = {version}')
         await db.commit()
+        print(f"Схема базы данных обновлена до версии {version}.")
 
 # --- Функции для работы с историей загрузок ---
 
 async def get_upload_history_by_id(record_id: int) -> Optional[Dict]:
     """Получает запись истории загрузки по ее ID."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row # Возвращать строки как объекты с доступом по имени колонки
+    await _flush_pending_uploads()
+    async with _reader() as db:
         cursor = await db.cursor()
         await cursor.execute("SELECT * FROM uploads WHERE id = ?", (record_id,))
         row = await cursor.fetchone()
@@ -92,20 +439,96 @@ async def get_upload_history_by_id(record_id: int) -> Optional[Dict]:
         else:
             return None
 
-async def add_upload_record(source_type: str, status: str, file_path: str = None, error_message: str = None, true_tabs_datasheet_id: str = None, duration_seconds: float = None):
-    """Добавляет новую запись в историю загрузок."""
+# Записи истории пишутся с задержкой (write-behind): копятся в очереди и сохраняются одной транзакцией
+# каждые UPLOAD_HISTORY_BATCH_SIZE записей или UPLOAD_HISTORY_FLUSH_MS миллисекунд. Любое чтение истории
+# сначала сохраняет очередь, так что чат, только что завершивший операцию, сразу видит свою запись.
+_pending_uploads: List[tuple] = []
+_upload_flush_task: Optional[asyncio.Task] = None
+# Сколько раз подряд пачка может не сохраниться; затем записи сохраняются по одной, а несохраняемые отбрасываются
+UPLOAD_HISTORY_MAX_ATTEMPTS = 3
+_upload_flush_failures = 0
+
+_UPLOAD_INSERT_SQL = '''
+    INSERT INTO uploads (timestamp, source_type, status, file_path, error_message, true_tabs_datasheet_id, duration_seconds, job_id, chat_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+async def add_upload_record(source_type: str, status: str, file_path: str = None, error_message: str = None, true_tabs_datasheet_id: str = None, duration_seconds: float = None, job_id: str = None, chat_id: int = None):
+    """Добавляет новую запись в историю загрузок (job_id - для запусков по расписанию)."""
     timestamp = datetime.now().isoformat()
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        await db.execute('''
-            INSERT INTO uploads (timestamp, source_type, status, file_path, error_message, true_tabs_datasheet_id, duration_seconds)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, source_type, status, file_path, error_message, true_tabs_datasheet_id, duration_seconds))
+    _pending_uploads.append((timestamp, source_type, status, file_path, error_message, true_tabs_datasheet_id, duration_seconds, job_id, chat_id))
+    if len(_pending_uploads) >= UPLOAD_HISTORY_BATCH_SIZE:
+        await flush_upload_records()
+    else:
+        _schedule_upload_flush()
+
+def _schedule_upload_flush():
+    """Запускает отложенное сохранение очереди, если оно еще не запланировано."""
+    global _upload_flush_task
+    if _upload_flush_task is None or _upload_flush_task.done() or _upload_flush_task is asyncio.current_task():
+        _upload_flush_task = asyncio.create_task(_flush_upload_records_later())
+
+async def _flush_upload_records_later():
+    await asyncio.sleep(UPLOAD_HISTORY_FLUSH_MS / 1000)
+    await flush_upload_records()
+
+async def flush_upload_records():
+    """
+    Сохраняет накопленные записи истории одной транзакцией. Если пачка не сохранилась, она остается в очереди
+    и сохранение повторяется позже; после UPLOAD_HISTORY_MAX_ATTEMPTS неудач подряд записи сохраняются по одной,
+    а те, что не сохраняются, отбрасываются (с записью в лог), чтобы одна плохая запись не блокировала остальные.
+    """
+    global _upload_flush_failures
+    if not _pending_uploads:
+        return
+    retry = False
+    async with _writer() as db:
+        # Забираем очередь под блокировкой: записи, добавленные во время ожидания, попадут в эту же пачку
+        rows = _pending_uploads[:]
+        if not rows:
+            return
+        try:
+            await db.executemany(_UPLOAD_INSERT_SQL, rows)
+            await db.commit()
+            del _pending_uploads[:len(rows)]
+            _upload_flush_failures = 0
+        except Exception as e:
+            if db.in_transaction:
+                await db.rollback()
+            _upload_flush_failures += 1
+            print(f"Ошибка при сохранении записей истории ({len(rows)} шт., попытка {_upload_flush_failures}): {e}", file=sys.stderr)
+            if _upload_flush_failures >= UPLOAD_HISTORY_MAX_ATTEMPTS:
+                await _insert_upload_records_one_by_one(db, rows)
+                del _pending_uploads[:len(rows)]
+                _upload_flush_failures = 0
+            retry = bool(_pending_uploads)
+    if retry:
+        _schedule_upload_flush()
+
+async def _insert_upload_records_one_by_one(db: aiosqlite.Connection, rows: List[tuple]):
+    dropped = 0
+    for row in rows:
+        try:
+            await db.execute(_UPLOAD_INSERT_SQL, row)
+        except Exception as e:
+            dropped += 1
+            print(f"Запись истории отброшена после {UPLOAD_HISTORY_MAX_ATTEMPTS} неудачных попыток: {row!r}: {e}", file=sys.stderr)
+    try:
         await db.commit()
+    except Exception as e:
+        dropped = len(rows)
+        print(f"Записи истории ({len(rows)} шт.) отброшены: не удалось сохранить: {e}", file=sys.stderr)
+    if dropped:
+        print(f"Отброшено записей истории: {dropped} из {len(rows)}", file=sys.stderr)
+
+async def _flush_pending_uploads():
+    if _pending_uploads:
+        await flush_upload_records()
 
 async def get_upload_history(limit: int = 10, offset: int = 0) -> List[Dict]:
     """Получает записи истории загрузок с пагинацией."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    await _flush_pending_uploads()
+    async with _reader() as db:
         cursor = await db.execute('''
             SELECT * FROM uploads
             ORDER BY timestamp DESC
@@ -114,15 +537,128 @@ async def get_upload_history(limit: int = 10, offset: int = 0) -> List[Dict]:
         records = await cursor.fetchall()
         return [dict(row) for row in records]
 
+async def get_upload_history_page(limit: int = 10, older_than: Optional[tuple] = None, newer_than: Optional[tuple] = None) -> List[Dict]:
+    """
+    Получает страницу истории загрузок (новые сверху) по ключу (timestamp, id) вместо OFFSET:
+    older_than - записи после заданной (следующая страница), newer_than - перед ней (предыдущая).
+    Стоимость не зависит от того, насколько далеко страница от начала.
+    """
+    await _flush_pending_uploads()
+    async with _reader() as db:
+        if newer_than is not None:
+            cursor = await db.execute('''
+                SELECT * FROM uploads
+                WHERE (timestamp, id) > (?, ?)
+                ORDER BY timestamp ASC, id ASC
+                LIMIT ?
+            ''', (*newer_than, limit))
+            records = await cursor.fetchall()
+            return [dict(row) for row in reversed(records)]
+
+        if older_than is not None:
+            cursor = await db.execute('''
+                SELECT * FROM uploads
+                WHERE (timestamp, id) < (?, ?)
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (*older_than, limit))
+        else:
+            cursor = await db.execute('''
+                SELECT * FROM uploads
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (limit,))
+        records = await cursor.fetchall()
+        return [dict(row) for row in records]
+
 async def count_upload_history() -> int:
-    """Подсчитывает общее количество записей в истории загрузок."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    """Возвращает общее количество записей в истории загрузок (из счетчика, поддерживаемого триггерами)."""
+    await _flush_pending_uploads()
+    async with _reader() as db:
+        cursor = await db.execute("SELECT value FROM table_counters WHERE name = 'uploads'")
+        row = await cursor.fetchone()
+        if row:
+            return row[0]
+        # Схема еще не обновлена (init_db не вызывался)
         cursor = await db.execute('SELECT COUNT(*) FROM uploads')
         row = await cursor.fetchone()
         return row[0] if row else 0
 
+# --- Каталог конфигураций и заданий в памяти ---
+# Списки для клавиатур и конфигурации для запусков читаются из памяти; функции записи ниже сбрасывают
+# копию своей таблицы (@_invalidates). Секреты расшифровываются только при запросе полной конфигурации.
+
+def _invalidates(*catalogs: ConfigCatalog):
+    """Декоратор функций записи: после изменения таблицы сбрасывает ее копию в каталоге."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                for catalog in catalogs:
+                    catalog.invalidate()
+        return wrapper
+    return decorator
+
+async def _load_catalog_version(name: str) -> int:
+    async with _reader() as db:
+        cursor = await db.execute('SELECT version FROM catalog_versions WHERE name = ?', (name,))
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+async def _load_table(query: str) -> List[Dict[str, Any]]:
+    async with _reader() as db:
+        cursor = await db.execute(query)
+        return [dict(row) for row in await cursor.fetchall()]
+
+def _decrypt_source_config(row: Dict[str, Any]) -> Dict[str, Any]:
+    config_data = dict(row)
+
+    # Дешифруем пароль, если он есть
+    config_data['source_pass'] = decrypt_data(config_data['source_pass']) if config_data['source_pass'] else None
+    # Дешифруем и парсим specific_params_json
+    specific_params_json_decrypted = decrypt_data(config_data.get('specific_params_json')) if config_data.get('specific_params_json') else None
+    config_data['specific_params'] = json.loads(specific_params_json_decrypted) if specific_params_json_decrypted else {}
+
+    # Собираем все параметры в один словарь для удобства, включая is_default
+    full_params = {
+        k: v for k, v in config_data.items() if k not in ['id', 'name', 'specific_params_json', 'specific_params']
+    }
+    full_params.update(config_data['specific_params']) # Добавляем специфические параметры
+    full_params['name'] = config_data['name'] # Добавляем имя
+    full_params['source_type'] = config_data['source_type'] # Добавляем тип источника
+    full_params['is_default'] = bool(config_data.get('is_default', False)) # Добавляем is_default
+    return full_params
+
+def _decrypt_tt_config(row: Dict[str, Any]) -> Dict[str, Any]:
+    # Убедимся, что возвращаем словарь с ожидаемыми ключами, включая is_default
+    return {
+        'id': row.get('id'),
+        'name': row.get('name'),
+        'upload_api_token': decrypt_data(row['upload_api_token']) if row.get('upload_api_token') else None,
+        'upload_datasheet_id': row.get('upload_datasheet_id'),
+        'upload_field_map_json': decrypt_data(row['upload_field_map_json']) if row.get('upload_field_map_json') else None,
+        'is_default': bool(row.get('is_default', False)), # Добавляем is_default
+        'export_fields': json.loads(row['export_fields_json']) if row.get('export_fields_json') else None,
+        'export_filter_formula': row.get('export_filter_formula'),
+        'export_view_id': row.get('export_view_id'),
+    }
+
+source_configs_catalog = ConfigCatalog('source_configs', lambda: _load_table('SELECT * FROM source_configs ORDER BY name'), 'name',
+                                       _decrypt_source_config, lambda: _load_catalog_version('source_configs'))
+tt_configs_catalog = ConfigCatalog('true_tabs_configs', lambda: _load_table('SELECT * FROM true_tabs_configs ORDER BY name'), 'name',
+                                   _decrypt_tt_config, lambda: _load_catalog_version('true_tabs_configs'))
+# Новые задания сверху
+scheduled_jobs_catalog = ConfigCatalog('scheduled_jobs', lambda: _load_table('SELECT * FROM scheduled_jobs ORDER BY created_at DESC'), 'job_id',
+                                       load_version=lambda: _load_catalog_version('scheduled_jobs'))
+
+def catalog_stats() -> List[Dict[str, Any]]:
+    return [catalog.stats() for catalog in (source_configs_catalog, tt_configs_catalog, scheduled_jobs_catalog)]
+
 # --- Функции для работы с конфигурациями источников ---
 
+@_invalidates(source_configs_catalog)
 async def add_source_config(name: str, source_type: str, params: Dict[str, Any]) -> bool:
     """Добавляет новую конфигурацию источника в базу данных."""
     source_url = params.get("source_url")
@@ -139,7 +675,7 @@ async def add_source_config(name: str, source_type: str, params: Dict[str, Any])
     encrypted_specific_params = encrypt_data(json.dumps(specific_params_to_save))
 
 
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             # При добавлении новая конфигурация не является дефолтной
             await db.execute('''
@@ -157,53 +693,28 @@ async def add_source_config(name: str, source_type: str, params: Dict[str, Any])
 
 
 async def get_source_config(name: str) -> Optional[Dict[str, Any]]:
-    """Получает конфигурацию источника по ее имени."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT * FROM source_configs WHERE name = ?', (name,))
-        row = await cursor.fetchone()
-
-        if row:
-            config_data = dict(row)
-
-            # Дешифруем пароль, если он есть
-            config_data['source_pass'] = decrypt_data(config_data['source_pass']) if config_data['source_pass'] else None
-            # Дешифруем и парсим specific_params_json
-            specific_params_json_decrypted = decrypt_data(config_data.get('specific_params_json')) # Используем .get() на случай, если поле было null/пустое
-            config_data['specific_params'] = json.loads(specific_params_json_decrypted) if specific_params_json_decrypted else {}
-
-            # Собираем все параметры в один словарь для удобства, включая is_default
-            full_params = {
-                k: v for k, v in config_data.items() if k not in ['id', 'name', 'specific_params_json', 'specific_params']
-            }
-            full_params.update(config_data['specific_params']) # Добавляем специфические параметры
-            full_params['name'] = config_data['name'] # Добавляем имя
-            full_params['source_type'] = config_data['source_type'] # Добавляем тип источника
-            full_params['is_default'] = bool(config_data.get('is_default', False)) # Добавляем is_default
-
-
-            return full_params
-        return None
+    """Получает конфигурацию источника по ее имени (с расшифрованными секретами)."""
+    return await source_configs_catalog.get_decrypted(name)
 
 
 async def list_source_configs() -> List[Dict[str, Any]]:
     """Получает список всех сохраненных конфигураций источников (только имя, тип, дефолт)."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Выбираем только нужные поля для списка
-        cursor = await db.execute('SELECT id, name, source_type, is_default FROM source_configs ORDER BY name')
-        rows = await cursor.fetchall()
-        # Преобразуем is_default из 0/1 в True/False
-        return [dict(row) | {'is_default': bool(row['is_default'])} for row in rows]
+    # Преобразуем is_default из 0/1 в True/False
+    return [
+        {'id': row['id'], 'name': row['name'], 'source_type': row['source_type'], 'is_default': bool(row['is_default'])}
+        for row in await source_configs_catalog.rows()
+    ]
 
 
+@_invalidates(source_configs_catalog)
 async def delete_source_config(name: str) -> bool:
     """Удаляет конфигурацию источника по ее имени."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         cursor = await db.execute('DELETE FROM source_configs WHERE name = ?', (name,))
         await db.commit()
         return cursor.rowcount > 0
 
+@_invalidates(source_configs_catalog)
 async def update_source_config(name: str, source_type: str, params: Dict[str, Any]) -> bool:
     """Обновляет существующую конфигурацию источника по имени."""
     source_url = params.get("source_url")
@@ -219,7 +730,7 @@ async def update_source_config(name: str, source_type: str, params: Dict[str, An
     encrypted_pass = encrypt_data(source_pass) if source_pass is not None else None
     encrypted_specific_params = encrypt_data(json.dumps(specific_params_to_save))
 
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             cursor = await db.execute('''
                 UPDATE source_configs
@@ -232,10 +743,10 @@ async def update_source_config(name: str, source_type: str, params: Dict[str, An
             print(f"Ошибка при обновлении конфигурации источника '{name}': {e}", file=sys.stderr)
             return False
 
+@_invalidates(source_configs_catalog)
 async def set_default_source_config(name: str) -> bool:
     """Устанавливает конфигурацию источника как дефолтную для ее типа, сбрасывая предыдущую дефолтную."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _writer() as db:
         # Получаем source_type конфигурации, которую хотим сделать дефолтной
         cursor = await db.execute('SELECT source_type FROM source_configs WHERE name = ?', (name,))
         row = await cursor.fetchone()
@@ -260,26 +771,23 @@ async def set_default_source_config(name: str) -> bool:
 
 async def get_default_source_config(source_type: str) -> Optional[Dict[str, Any]]:
     """Получает дефолтную конфигурацию источника для заданного типа источника."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Ищем конфигурацию с флагом is_default = TRUE для данного типа источника
-        cursor = await db.execute('SELECT name FROM source_configs WHERE source_type = ? AND is_default = TRUE LIMIT 1', (source_type,))
-        row = await cursor.fetchone()
-        if row:
-            # Используем существующую функцию get_source_config для получения полных данных
+    # Ищем конфигурацию с флагом is_default = TRUE для данного типа источника
+    for row in await source_configs_catalog.rows():
+        if row['source_type'] == source_type and row['is_default']:
             return await get_source_config(row['name'])
-        return None
+    return None
 
 
 # --- Функции для работы с конфигурациями True Tabs ---
 
+@_invalidates(tt_configs_catalog)
 async def add_tt_config(name: str, upload_api_token: str, upload_datasheet_id: str, upload_field_map_json: str) -> bool:
     """Добавляет новую конфигурацию True Tabs в базу данных."""
     # Шифруем токен и сопоставление полей
     encrypted_token = encrypt_data(upload_api_token) if upload_api_token is not None else None
     encrypted_field_map = encrypt_data(upload_field_map_json) if upload_field_map_json is not None else None
 
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             # При добавлении новая конфигурация не является дефолтной
             await db.execute('''
@@ -297,53 +805,33 @@ async def add_tt_config(name: str, upload_api_token: str, upload_datasheet_id: s
 
 
 async def get_tt_config(name: str) -> Optional[Dict[str, str]]:
-    """Получение конфигурации True Tabs по имени."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT * FROM true_tabs_configs WHERE name = ?', (name,))
-        row = await cursor.fetchone()
-
-        if row:
-            config_data = dict(row)
-            # Дешифруем данные, если они есть
-            config_data['upload_api_token'] = decrypt_data(config_data['upload_api_token']) if config_data['upload_api_token'] else None
-            config_data['upload_field_map_json'] = decrypt_data(config_data['upload_field_map_json']) if config_data['upload_field_map_json'] else None
-
-            # Убедимся, что возвращаем словарь с ожидаемыми ключами, включая is_default
-            return {
-                'id': config_data.get('id'),
-                'name': config_data.get('name'),
-                'upload_api_token': config_data.get('upload_api_token'),
-                'upload_datasheet_id': config_data.get('upload_datasheet_id'),
-                'upload_field_map_json': config_data.get('upload_field_map_json'),
-                'is_default': bool(config_data.get('is_default', False)), # Добавляем is_default
-            }
-        return None
+    """Получение конфигурации True Tabs по имени (с расшифрованным токеном)."""
+    return await tt_configs_catalog.get_decrypted(name)
 
 async def list_tt_configs() -> List[Dict[str, str]]:
     """Получение списка всех сохраненных конфигураций True Tabs (только имя, ID, дефолт)."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Выбираем только нужные поля для списка
-        cursor = await db.execute('SELECT id, name, upload_datasheet_id, is_default FROM true_tabs_configs ORDER BY name')
-        rows = await cursor.fetchall()
-        # Преобразуем is_default из 0/1 в True/False
-        return [dict(row) | {'is_default': bool(row['is_default'])} for row in rows]
+    # Преобразуем is_default из 0/1 в True/False
+    return [
+        {'id': row['id'], 'name': row['name'], 'upload_datasheet_id': row['upload_datasheet_id'], 'is_default': bool(row['is_default'])}
+        for row in await tt_configs_catalog.rows()
+    ]
 
+@_invalidates(tt_configs_catalog)
 async def delete_tt_config(name: str) -> bool:
     """Удаление конфигурации True Tabs по имени."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         cursor = await db.execute('DELETE FROM true_tabs_configs WHERE name = ?', (name,))
         await db.commit()
         return cursor.rowcount > 0
 
+@_invalidates(tt_configs_catalog)
 async def update_tt_config(name: str, upload_api_token: str, upload_datasheet_id: str, upload_field_map_json: str) -> bool:
     """Обновляет существующую конфигурацию True Tabs по имени."""
     # Шифруем токен и сопоставление полей
     encrypted_token = encrypt_data(upload_api_token) if upload_api_token is not None else None
     encrypted_field_map = encrypt_data(upload_field_map_json) if upload_field_map_json is not None else None
 
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             # is_default не обновляется этой функцией
             cursor = await db.execute('''
@@ -357,9 +845,26 @@ async def update_tt_config(name: str, upload_api_token: str, upload_datasheet_id
             print(f"Ошибка при обновлении конфигурации True Tabs '{name}': {e}", file=sys.stderr)
             return False
 
+@_invalidates(tt_configs_catalog)
+async def update_tt_export_settings(name: str, export_fields: Optional[List[str]], export_filter_formula: Optional[str], export_view_id: Optional[str]) -> bool:
+    """Сохраняет настройки выгрузки конфигурации True Tabs (поля, формула фильтра, представление). None - без ограничения."""
+    async with _writer() as db:
+        try:
+            cursor = await db.execute('''
+                UPDATE true_tabs_configs
+                SET export_fields_json = ?, export_filter_formula = ?, export_view_id = ?
+                WHERE name = ?
+            ''', (json.dumps(export_fields, ensure_ascii=False) if export_fields else None, export_filter_formula or None, export_view_id or None, name))
+            await db.commit()
+            return cursor.rowcount > 0
+        except Exception as e:
+            print(f"Ошибка при сохранении настроек выгрузки конфигурации True Tabs '{name}': {e}", file=sys.stderr)
+            return False
+
+@_invalidates(tt_configs_catalog)
 async def set_default_tt_config(name: str) -> bool:
     """Устанавливает конфигурацию True Tabs как дефолтную, сбрасывая предыдущую дефолтную."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             await db.execute("BEGIN") # Начинаем транзакцию
             # Сбрасываем флаг is_default для всех других конфигураций True Tabs
@@ -376,22 +881,19 @@ async def set_default_tt_config(name: str) -> bool:
 
 async def get_default_tt_config() -> Optional[Dict[str, str]]:
     """Получает дефолтную конфигурацию True Tabs."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Ищем конфигурацию с флагом is_default = TRUE
-        cursor = await db.execute('SELECT name FROM true_tabs_configs WHERE is_default = TRUE LIMIT 1')
-        row = await cursor.fetchone()
-        if row:
-            # Используем существующую функцию get_tt_config для получения полных данных
+    # Ищем конфигурацию с флагом is_default = TRUE
+    for row in await tt_configs_catalog.rows():
+        if row['is_default']:
             return await get_tt_config(row['name'])
-        return None
+    return None
 
 # --- Функции для работы с запланированными заданиями ---
 
+@_invalidates(scheduled_jobs_catalog)
 async def add_scheduled_job(job_id: str, name: str, chat_id: int, source_config_name: str, tt_config_name: str, action: str, trigger_type: str, trigger_args_json: str) -> bool:
     """Добавляет новое запланированное задание в базу данных."""
     created_at = datetime.now().isoformat()
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             # При добавлении задание включено по умолчанию (enabled = TRUE)
             await db.execute('''
@@ -410,49 +912,36 @@ async def add_scheduled_job(job_id: str, name: str, chat_id: int, source_config_
 
 async def get_scheduled_job(job_id: str) -> Optional[Dict[str, Any]]:
     """Получает запланированное задание по его job_id."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT * FROM scheduled_jobs WHERE job_id = ?', (job_id,))
-        row = await cursor.fetchone()
-        if row:
-             # Преобразуем enabled из 0/1 в True/False
-             job_data = dict(row)
-             job_data['enabled'] = bool(job_data.get('enabled', False))
-             return job_data
-        return None
+    row = await scheduled_jobs_catalog.get(job_id)
+    return _job_with_flags(row) if row else None
+
+def _job_with_flags(row: Dict[str, Any]) -> Dict[str, Any]:
+    # Преобразуем enabled из 0/1 в True/False
+    return dict(row) | {'enabled': bool(row.get('enabled', False))}
 
 async def list_scheduled_jobs(chat_id: int) -> List[Dict[str, Any]]:
-    """Получает список всех запланированных заданий для конкретного chat_id."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Сортируем по времени создания, чтобы новые задания были сверху
-        cursor = await db.execute('SELECT * FROM scheduled_jobs WHERE chat_id = ? ORDER BY created_at DESC', (chat_id,))
-        rows = await cursor.fetchall()
-         # Преобразуем enabled из 0/1 в True/False
-        return [dict(row) | {'enabled': bool(row.get('enabled', False))} for row in rows]
+    """Получает список всех запланированных заданий для конкретного chat_id (новые сверху)."""
+    return [_job_with_flags(row) for row in await scheduled_jobs_catalog.rows() if row['chat_id'] == chat_id]
 
 async def list_all_scheduled_jobs() -> List[Dict[str, Any]]:
     """Получает список всех запланированных заданий из базы данных (для загрузки в scheduler на старте)."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('SELECT * FROM scheduled_jobs') # Без ORDER BY, т.к. scheduler сам сортирует
-        rows = await cursor.fetchall()
-        # Преобразуем enabled из 0/1 в True/False
-        return [dict(row) | {'enabled': bool(row.get('enabled', False))} for row in rows]
+    return [_job_with_flags(row) for row in await scheduled_jobs_catalog.rows()]
 
+@_invalidates(scheduled_jobs_catalog)
 async def delete_scheduled_job(job_id: str) -> bool:
     """Удаляет запланированное задание по его job_id."""
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         cursor = await db.execute('DELETE FROM scheduled_jobs WHERE job_id = ?', (job_id,))
         await db.commit()
         return cursor.rowcount > 0
 
+@_invalidates(scheduled_jobs_catalog)
 async def update_scheduled_job_via_delete_add(job_id: str, name: str, chat_id: int, source_config_name: str, tt_config_name: str, action: str, trigger_type: str, trigger_args_json: str, enabled: bool) -> bool:
     """
     Обновляет запланированное задание путем удаления старого и добавления нового.
     Возвращает True, если обновление прошло успешно, иначе False.
     """
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             # Удаляем старое задание
             await db.execute('DELETE FROM scheduled_jobs WHERE job_id = ?', (job_id,))
@@ -472,13 +961,14 @@ async def get_latest_upload_history_by_job_id(job_id: str):
     Получить последнюю запись истории загрузок по job_id.
     Возвращает словарь с записью или None, если не найдено.
     """
+    await _flush_pending_uploads()
     query = """
     SELECT * FROM uploads
     WHERE job_id = ?
     ORDER BY timestamp DESC
     LIMIT 1
     """
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _reader() as db:
         async with db.execute(query, (job_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
@@ -487,12 +977,13 @@ async def get_latest_upload_history_by_job_id(job_id: str):
             else:
                 return None
 
+@_invalidates(scheduled_jobs_catalog)
 async def update_scheduled_job(job_id: str, name: str, chat_id: int, source_config_name: str, tt_config_name: str, action: str, trigger_type: str, trigger_args_json: str, enabled: bool) -> bool:
     """
     Обновляет существующее запланированное задание по job_id.
     Возвращает True, если обновление прошло успешно, иначе False.
     """
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
+    async with _writer() as db:
         try:
             cursor = await db.execute('''
                 UPDATE scheduled_jobs
@@ -505,28 +996,543 @@ async def update_scheduled_job(job_id: str, name: str, chat_id: int, source_conf
             print(f"Ошибка при обновлении запланированного задания '{job_id}': {e}", file=sys.stderr)
             return False
 
-async def get_last_upload_for_scheduled_job(chat_id: int, action: str) -> Optional[Dict[str, Any]]:
+# --- Журнал запусков запланированных заданий ---
+
+async def start_schedule_run(job_id: str, scheduled_at: Optional[str], queue_wait_seconds: float, instance_id: Optional[str] = None) -> int:
+    """Записывает начало запуска (status RUNNING) экземпляром instance_id; возвращает run_id."""
+    async with _writer() as db:
+        cursor = await db.execute('''
+            INSERT INTO schedule_runs (job_id, scheduled_at, started_at, status, queue_wait_seconds, instance_id)
+            VALUES (?, ?, ?, 'RUNNING', ?, ?)
+        ''', (job_id, scheduled_at, datetime.now().isoformat(), queue_wait_seconds, instance_id))
+        await db.commit()
+        return cursor.lastrowid
+
+# Вес последнего запуска в оценках стоимости (экспоненциальное скользящее среднее)
+RUN_ESTIMATE_WEIGHT = 0.3
+# Оценка пиковой памяти - затухающий максимум: одно тяжелое выполнение забывается постепенно
+RUN_MEMORY_DECAY = 0.9
+
+async def _finish_schedule_run_in(db: aiosqlite.Connection, run_id: int, job_id: str, status: str, rows: Optional[int],
+                                  duration_seconds: Optional[float], peak_memory_kb: Optional[int], finished_at: str):
     """
-    Получает последнюю запись истории загрузок для заданного chat_id и действия (source_type).
-    Возвращает словарь с записью или None, если записей нет.
+    Записывает итог запуска в журнал и в итоги задания в транзакции db (без commit). Возвращает строку итогов задания
+    или None, если запуск уже закрыт (например, как потерянный после остановки его экземпляра, см. recover_lost_runs).
     """
-    async with aiosqlite.connect(SQLITE_DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Получаем tt_config_name для заданного chat_id и action
-        cursor = await db.execute('SELECT tt_config_name FROM scheduled_jobs WHERE chat_id = ? AND action = ? LIMIT 1', (chat_id, action))
-        row = await cursor.fetchone()
-        if not row:
-            return None
-        tt_config_name = row['tt_config_name']
+    failed = status != 'SUCCESS'
+    executed = status not in ('SKIPPED', 'CANCELLED')
+    duration_sample = duration_seconds if executed else None
+    rows_sample = rows if status == 'SUCCESS' else None
+    memory_sample = peak_memory_kb if executed else None
+    cursor = await db.execute('''
+        UPDATE schedule_runs SET finished_at = ?, status = ?, rows = ?, duration_seconds = ?, peak_memory_kb = ?
+        WHERE run_id = ? AND status = 'RUNNING'
+    ''', (finished_at, status, rows, duration_seconds, peak_memory_kb, run_id))
+    if cursor.rowcount == 0:
+        return None
+    await db.execute('''
+        UPDATE scheduled_jobs
+        SET last_run_at = :finished_at, last_run_status = :status,
+            last_run_duration_seconds = :duration_seconds, last_run_rows = :rows,
+            last_success_at = CASE WHEN :failed THEN last_success_at ELSE :finished_at END,
+            runs_total = runs_total + 1, runs_failed = runs_failed + :failed,
+            consecutive_failures = CASE
+                WHEN :status = 'SUCCESS' THEN 0
+                WHEN :status IN ('SKIPPED', 'CANCELLED') THEN consecutive_failures
+                ELSE consecutive_failures + 1
+            END,
+            est_duration_seconds = CASE
+                WHEN :duration_sample IS NULL THEN est_duration_seconds
+                WHEN est_duration_seconds IS NULL THEN :duration_sample
+                ELSE est_duration_seconds * (1 - :weight) + :duration_sample * :weight
+            END,
+            est_rows = CASE
+                WHEN :rows_sample IS NULL THEN est_rows
+                WHEN est_rows IS NULL THEN :rows_sample
+                ELSE est_rows * (1 - :weight) + :rows_sample * :weight
+            END,
+            est_peak_memory_kb = CASE
+                WHEN :memory_sample IS NULL THEN est_peak_memory_kb
+                WHEN est_peak_memory_kb IS NULL OR :memory_sample > est_peak_memory_kb * :decay THEN :memory_sample
+                ELSE CAST(est_peak_memory_kb * :decay AS INTEGER)
+            END
+        WHERE job_id = :job_id
+    ''', {
+        'finished_at': finished_at, 'status': status, 'duration_seconds': duration_seconds, 'rows': rows,
+        'failed': int(failed), 'duration_sample': duration_sample, 'rows_sample': rows_sample,
+        'memory_sample': memory_sample, 'weight': RUN_ESTIMATE_WEIGHT, 'decay': RUN_MEMORY_DECAY, 'job_id': job_id,
+    })
+    cursor = await db.execute('''
+        SELECT last_success_at, runs_total, runs_failed, consecutive_failures,
+               est_duration_seconds, est_rows, est_peak_memory_kb
+        FROM scheduled_jobs WHERE job_id = ?
+    ''', (job_id,))
+    return await cursor.fetchone()
+
+async def finish_schedule_run(run_id: int, job_id: str, status: str, rows: Optional[int], duration_seconds: Optional[float],
+                              peak_memory_kb: Optional[int] = None) -> int:
+    """
+    Записывает итог запуска в журнал и в итоги последнего запуска задания (одной транзакцией).
+    Возвращает число ошибок подряд: успех сбрасывает счетчик, пропущенный или отмененный запуск его не меняет.
+    Оценки стоимости (est_*) обновляет каждый выполненный запуск, пропущенные и отмененные - нет.
+    Запуск, уже закрытый как потерянный (recover_lost_runs), не меняется; возвращается 0.
+    """
+    finished_at = datetime.now().isoformat()
+    async with _writer() as db:
+        job_row = await _finish_schedule_run_in(db, run_id, job_id, status, rows, duration_seconds, peak_memory_kb, finished_at)
+        cursor = await db.execute("SELECT version FROM catalog_versions WHERE name = 'scheduled_jobs'")
+        version_row = await cursor.fetchone()
+        await db.commit()
+    # Меняются только итоги запуска - обновляем строку каталога, а не перечитываем таблицу
+    if job_row is not None:
+        scheduled_jobs_catalog.patch(job_id, {
+            'last_run_at': finished_at, 'last_run_status': status, 'last_run_duration_seconds': duration_seconds,
+            'last_run_rows': rows, 'last_success_at': job_row['last_success_at'],
+            'runs_total': job_row['runs_total'], 'runs_failed': job_row['runs_failed'],
+            'consecutive_failures': job_row['consecutive_failures'],
+            'est_duration_seconds': job_row['est_duration_seconds'], 'est_rows': job_row['est_rows'],
+            'est_peak_memory_kb': job_row['est_peak_memory_kb'],
+        }, version_row[0] if version_row else None)
+    return job_row['consecutive_failures'] if job_row is not None else 0
+
+async def list_schedule_runs(job_id: str, limit: int = 5) -> List[Dict[str, Any]]:
+    """Последние запуски задания (новые сверху)."""
+    async with _reader() as db:
+        cursor = await db.execute(
+            'SELECT * FROM schedule_runs WHERE job_id = ? ORDER BY started_at DESC LIMIT ?', (job_id, limit)
+        )
+        return [dict(row) for row in await cursor.fetchall()]
 
-        # Получаем последнюю запись из uploads для данного tt_config_name и source_type (action)
+async def get_schedule_failure_stats(since: str) -> List[Dict[str, Any]]:
+    """Число запусков и ошибок по заданиям начиная с since (ISO); задания с ошибками - первыми."""
+    async with _reader() as db:
         cursor = await db.execute('''
-            SELECT * FROM uploads
-            WHERE true_tabs_datasheet_id = ? AND source_type = ?
-            ORDER BY timestamp DESC
-            LIMIT 1
-        ''', (tt_config_name, action))
-        upload_row = await cursor.fetchone()
-        if upload_row:
-            return dict(upload_row)
-        return None
+            SELECT job_id, COUNT(*) AS runs,
+                   SUM(status NOT IN ('SUCCESS', 'RUNNING')) AS failed,
+                   AVG(duration_seconds) AS avg_duration_seconds,
+                   AVG(queue_wait_seconds) AS avg_queue_wait_seconds
+            FROM schedule_runs
+            WHERE started_at >= ?
+            GROUP BY job_id
+            ORDER BY failed DESC, runs DESC
+        ''', (since,))
+        return [dict(row) for row in await cursor.fetchall()]
+
+async def prune_schedule_runs(older_than: str) -> int:
+    """
+    Удаляет записи журнала запусков и циклы конвейеров старше older_than (ISO); итоги в scheduled_jobs остаются.
+    Возвращает число удаленных записей журнала.
+    """
+    async with _writer() as db:
+        cursor = await db.execute('DELETE FROM schedule_runs WHERE started_at < ?', (older_than,))
+        await db.execute('DELETE FROM pipeline_ready WHERE completed_at < ?', (older_than,))
+        await db.execute('DELETE FROM pipeline_cycles WHERE opened_at < ?', (older_than,))
+        await db.commit()
+        return cursor.rowcount
+
+
+# --- Готовность шагов конвейеров ---
+
+async def _open_pipeline_cycle(db: aiosqlite.Connection, job_id: str, opened_after: str, now: str) -> int:
+    cursor = await db.execute(
+        'SELECT cycle, opened_at FROM pipeline_cycles WHERE job_id = ? AND closed_at IS NULL ORDER BY cycle DESC LIMIT 1', (job_id,)
+    )
+    row = await cursor.fetchone()
+    if row is not None and row['opened_at'] >= opened_after:
+        return row['cycle']
+    if row is not None:
+        # Остальные предшественники так и не завершились - результаты этого цикла больше не используются
+        await db.execute('UPDATE pipeline_cycles SET closed_at = ? WHERE job_id = ? AND cycle = ?', (now, job_id, row['cycle']))
+    cursor = await db.execute('SELECT COALESCE(MAX(cycle), 0) + 1 FROM pipeline_cycles WHERE job_id = ?', (job_id,))
+    cycle = (await cursor.fetchone())[0]
+    await db.execute('INSERT INTO pipeline_cycles (job_id, cycle, opened_at) VALUES (?, ?, ?)', (job_id, cycle, now))
+    return cycle
+
+async def record_pipeline_upstream(job_id: str, upstream_job_id: str, artifact_path: Optional[str],
+                                   upstream_job_ids: List[str], opened_after: str) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Отмечает успешное завершение предшественника upstream_job_id в открытом цикле шага job_id. Цикл, открытый
+    раньше opened_after (ISO), считается брошенным и закрывается - его результаты не переходят в следующий цикл.
+    Если в цикле завершились все upstream_job_ids, цикл закрывается и возвращается {upstream_job_id: файл результата};
+    получает его только один вызов, даже если предшественники выполнялись разными экземплярами бота.
+    """
+    now = datetime.now().isoformat()
+    async with _writer() as db:
+        # Чтение и запись одной транзакцией с блокировкой записи: экземпляры с общей БД не делят цикл между собой
+        await db.execute('BEGIN IMMEDIATE')
+        cycle = await _open_pipeline_cycle(db, job_id, opened_after, now)
+        await db.execute('''
+            INSERT OR REPLACE INTO pipeline_ready (job_id, cycle, upstream_job_id, artifact_path, completed_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (job_id, cycle, upstream_job_id, artifact_path, now))
+        cursor = await db.execute('SELECT upstream_job_id, artifact_path FROM pipeline_ready WHERE job_id = ? AND cycle = ?', (job_id, cycle))
+        ready = {row['upstream_job_id']: row['artifact_path'] for row in await cursor.fetchall()}
+        if any(upstream_id not in ready for upstream_id in upstream_job_ids):
+            await db.commit()
+            return None
+        await db.execute('UPDATE pipeline_cycles SET closed_at = ? WHERE job_id = ? AND cycle = ?', (now, job_id, cycle))
+        await db.commit()
+        return ready
+
+async def close_pipeline_cycle(job_id: str) -> None:
+    """Закрывает открытый цикл шага job_id (шаг пропущен): уже завершившиеся предшественники не переходят в следующий цикл."""
+    async with _writer() as db:
+        await db.execute('UPDATE pipeline_cycles SET closed_at = ? WHERE job_id = ? AND closed_at IS NULL', (datetime.now().isoformat(), job_id))
+        await db.commit()
+
+
+# --- Координация экземпляров планировщика (utils.leases) ---
+
+async def record_scheduler_heartbeat(instance_id: str, hostname: str, pid: int, now: float):
+    async with _writer() as db:
+        await db.execute('''
+            INSERT INTO scheduler_instances (instance_id, hostname, pid, started_at, heartbeat_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(instance_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+        ''', (instance_id, hostname, pid, now, now))
+        await db.commit()
+
+async def list_live_scheduler_instances(min_heartbeat_at: float) -> List[str]:
+    """ID экземпляров, которые присылали heartbeat не раньше min_heartbeat_at."""
+    async with _reader() as db:
+        cursor = await db.execute('SELECT instance_id FROM scheduler_instances WHERE heartbeat_at >= ? ORDER BY instance_id', (min_heartbeat_at,))
+        return [row[0] for row in await cursor.fetchall()]
+
+async def remove_scheduler_instance(instance_id: str):
+    async with _writer() as db:
+        await db.execute('DELETE FROM scheduler_instances WHERE instance_id = ?', (instance_id,))
+        await db.commit()
+
+async def prune_scheduler_state(min_heartbeat_at: float, leases_older_than: float) -> int:
+    """Удаляет остановленные экземпляры и старые завершенные аренды; возвращает число удаленных аренд."""
+    async with _writer() as db:
+        await db.execute('DELETE FROM scheduler_instances WHERE heartbeat_at < ?', (min_heartbeat_at,))
+        cursor = await db.execute('DELETE FROM run_leases WHERE claimed_at < ? AND finished_at IS NOT NULL', (leases_older_than,))
+        await db.commit()
+        return cursor.rowcount
+
+async def claim_scheduled_run(job_id: str, scheduled_for: str, instance_id: str, now: float) -> bool:
+    """Берет запуск (job_id, scheduled_for) в аренду. True - запуск достался этому экземпляру."""
+    async with _writer() as db:
+        cursor = await db.execute(
+            'INSERT OR IGNORE INTO run_leases (job_id, scheduled_for, instance_id, claimed_at) VALUES (?, ?, ?, ?)',
+            (job_id, scheduled_for, instance_id, now)
+        )
+        await db.commit()
+        return cursor.rowcount == 1
+
+async def finish_run_lease(job_id: str, scheduled_for: str, now: float):
+    """Закрывает аренду запуска после его завершения (запуск больше не считается выполняющимся)."""
+    async with _writer() as db:
+        await db.execute('UPDATE run_leases SET finished_at = ? WHERE job_id = ? AND scheduled_for = ?', (now, job_id, scheduled_for))
+        await db.commit()
+
+@_invalidates(scheduled_jobs_catalog)
+async def recover_lost_runs(live_instance_ids: List[str], now: float) -> List[Dict[str, Any]]:
+    """
+    Закрывает запуски экземпляров, которых нет среди live_instance_ids (перестали присылать heartbeat или остановились):
+    открытые аренды, строки журнала со статусом RUNNING и отметки выполняющихся и ожидающих запусков (active_runs). Запуск записывается в журнал с ошибкой (аренда без строки
+    журнала - запуск, ждавший допуска, - получает новую строку). Все делается одной транзакцией, поэтому потерянный
+    запуск достается только одному экземпляру. Возвращает закрытые запуски: job_id, scheduled_at, instance_id, consecutive_failures.
+    """
+    live = ', '.join('?' for _ in live_instance_ids)
+    finished_at = datetime.now().isoformat()
+    lost: List[Dict[str, Any]] = []
+    async with _writer() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        cursor = await db.execute(f'''
+            SELECT run_id, job_id, scheduled_at, instance_id FROM schedule_runs
+            WHERE status = 'RUNNING' AND instance_id IS NOT NULL AND instance_id NOT IN ({live})
+        ''', live_instance_ids)
+        runs = [dict(row) for row in await cursor.fetchall()]
+        cursor = await db.execute(f'''
+            SELECT l.job_id, l.scheduled_for, l.instance_id,
+                   EXISTS (SELECT 1 FROM schedule_runs r WHERE r.job_id = l.job_id AND r.scheduled_at = l.scheduled_for
+                           AND r.instance_id = l.instance_id) AS has_run
+            FROM run_leases l WHERE l.finished_at IS NULL AND l.instance_id NOT IN ({live})
+        ''', live_instance_ids)
+        leases = [dict(row) for row in await cursor.fetchall()]
+        # Ожидающий запуск живого экземпляра сам займет освободившееся место (take_active_run_turn)
+        await db.execute(f'DELETE FROM active_runs WHERE instance_id NOT IN ({live})', live_instance_ids)
+        await db.execute(f'''
+            UPDATE active_runs SET queued_token = NULL, queued_instance_id = NULL, cancel_requested = 0
+            WHERE queued_instance_id NOT IN ({live})
+        ''', live_instance_ids)
+        if not runs and not leases:
+            await db.commit()
+            return []
+        await db.execute(f'UPDATE run_leases SET finished_at = ? WHERE finished_at IS NULL AND instance_id NOT IN ({live})',
+                         [now, *live_instance_ids])
+        for lease in leases:
+            if lease['has_run']:
+                continue # Запуск начался: закрывается по строке журнала (или уже завершен)
+            cursor = await db.execute('''
+                INSERT INTO schedule_runs (job_id, scheduled_at, started_at, status, queue_wait_seconds, instance_id)
+                VALUES (?, ?, ?, 'RUNNING', NULL, ?)
+            ''', (lease['job_id'], lease['scheduled_for'], finished_at, lease['instance_id']))
+            runs.append({'run_id': cursor.lastrowid, 'job_id': lease['job_id'], 'scheduled_at': lease['scheduled_for'],
+                         'instance_id': lease['instance_id']})
+        for run in runs:
+            job_row = await _finish_schedule_run_in(db, run['run_id'], run['job_id'], 'ERROR', None, None, None, finished_at)
+            lost.append({
+                'job_id': run['job_id'], 'scheduled_at': run['scheduled_at'], 'instance_id': run['instance_id'],
+                'consecutive_failures': job_row['consecutive_failures'] if job_row is not None else 0,
+            })
+        await db.commit()
+    return lost
+
+
+# --- Выполняющиеся запуски заданий (политика наложения, handlers.scheduled_handlers) ---
+
+async def claim_active_run(job_id: str, run_token: str, instance_id: str, now: float, queue: bool, cancel: bool) -> Optional[Dict[str, Any]]:
+    """
+    Делает запуск run_token выполняющимся запуском задания. Если задание уже выполняется (на любом экземпляре),
+    при queue запуск становится ожидающим за ним (не больше одного на задание), cancel - просит текущий остановиться.
+    Возвращает None, если запуск стал выполняющимся, иначе строку текущего запуска с полем queued (встал ли в очередь).
+    """
+    async with _writer() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        cursor = await db.execute(
+            'INSERT OR IGNORE INTO active_runs (job_id, run_token, instance_id, started_at) VALUES (?, ?, ?, ?)',
+            (job_id, run_token, instance_id, now)
+        )
+        if cursor.rowcount == 1:
+            await db.commit()
+            return None
+        queued = False
+        if queue:
+            cursor = await db.execute('''
+                UPDATE active_runs SET queued_token = ?, queued_instance_id = ?, cancel_requested = MAX(cancel_requested, ?)
+                WHERE job_id = ? AND queued_token IS NULL
+            ''', (run_token, instance_id, int(cancel), job_id))
+            queued = cursor.rowcount == 1
+        cursor = await db.execute('SELECT * FROM active_runs WHERE job_id = ?', (job_id,))
+        holder = dict(await cursor.fetchone())
+        await db.commit()
+        return {**holder, 'queued': queued}
+
+async def take_active_run_turn(job_id: str, run_token: str, instance_id: str, now: float) -> Optional[bool]:
+    """
+    Очередь ожидающего запуска run_token: True - он стал выполняющимся (предыдущий завершился или его экземпляр
+    остановился), False - ждать дальше, None - место в очереди потеряно.
+    """
+    async with _writer() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        cursor = await db.execute('SELECT run_token, queued_token FROM active_runs WHERE job_id = ?', (job_id,))
+        row = await cursor.fetchone()
+        if row is None:
+            await db.execute('INSERT INTO active_runs (job_id, run_token, instance_id, started_at) VALUES (?, ?, ?, ?)',
+                             (job_id, run_token, instance_id, now))
+            await db.commit()
+            return True
+        if row['run_token'] == run_token:
+            return True
+        return False if row['queued_token'] == run_token else None
+
+async def release_active_run(job_id: str, run_token: str, now: float):
+    """Завершает выполняющийся запуск run_token (ожидающий за ним становится выполняющимся) или убирает его из очереди."""
+    async with _writer() as db:
+        await db.execute('''
+            UPDATE active_runs SET run_token = queued_token, instance_id = queued_instance_id, started_at = ?,
+                queued_token = NULL, queued_instance_id = NULL, cancel_requested = 0
+            WHERE job_id = ? AND run_token = ? AND queued_token IS NOT NULL
+        ''', (now, job_id, run_token))
+        await db.execute('DELETE FROM active_runs WHERE job_id = ? AND run_token = ?', (job_id, run_token))
+        await db.execute('''
+            UPDATE active_runs SET queued_token = NULL, queued_instance_id = NULL, cancel_requested = 0
+            WHERE job_id = ? AND queued_token = ?
+        ''', (job_id, run_token))
+        await db.commit()
+
+async def is_active_run_cancel_requested(job_id: str, run_token: str) -> bool:
+    async with _reader() as db:
+        cursor = await db.execute('SELECT cancel_requested FROM active_runs WHERE job_id = ? AND run_token = ?', (job_id, run_token))
+        row = await cursor.fetchone()
+        return bool(row and row[0])
+
+
+# --- Функции для кэша геокодирования ---
+
+async def get_geocode(query_key: str) -> Optional[Dict[str, Any]]:
+    """Получает сохраненный результат геокодирования по нормализованной строке запроса."""
+    async with _reader() as db:
+        cursor = await db.execute('SELECT name, country, lat, lon FROM geocode_cache WHERE query_key = ?', (query_key,))
+        row = await cursor.fetchone()
+        return dict(row) if row else None
+
+async def save_geocode(query_key: str, name: str, country: Optional[str], lat: float, lon: float) -> bool:
+    """Сохраняет (или обновляет) результат геокодирования."""
+    async with _writer() as db:
+        try:
+            await db.execute('''
+                INSERT OR REPLACE INTO geocode_cache (query_key, name, country, lat, lon, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (query_key, name, country, lat, lon, datetime.now().isoformat()))
+            await db.commit()
+            return True
+        except Exception as e:
+            print(f"Ошибка при сохранении геокодирования для '{query_key}': {e}", file=sys.stderr)
+            return False
+
+
+# --- Функции для локальных копий таблиц True Tabs ---
+
+async def get_mirror_state(datasheet_id: str) -> Optional[Dict[str, Any]]:
+    """Получает состояние локальной копии таблицы или None, если копия не включена."""
+    async with _reader() as db:
+        cursor = await db.execute('SELECT * FROM tt_mirror_datasheets WHERE datasheet_id = ?', (datasheet_id,))
+        row = await cursor.fetchone()
+        return dict(row) if row else None
+
+async def enable_mirror(datasheet_id: str, tt_config_name: str) -> bool:
+    """Включает локальную копию таблицы (данные появятся после первой синхронизации)."""
+    async with _writer() as db:
+        try:
+            await db.execute('''
+                INSERT INTO tt_mirror_datasheets (datasheet_id, tt_config_name) VALUES (?, ?)
+                ON CONFLICT(datasheet_id) DO UPDATE SET tt_config_name = excluded.tt_config_name
+            ''', (datasheet_id, tt_config_name))
+            await db.commit()
+            return True
+        except Exception as e:
+            print(f"Ошибка при включении локальной копии таблицы '{datasheet_id}': {e}", file=sys.stderr)
+            return False
+
+async def disable_mirror(datasheet_id: str) -> bool:
+    """Отключает локальную копию таблицы и удаляет ее записи."""
+    async with _writer() as db:
+        await db.execute('DELETE FROM tt_mirror_records WHERE datasheet_id = ?', (datasheet_id,))
+        cursor = await db.execute('DELETE FROM tt_mirror_datasheets WHERE datasheet_id = ?', (datasheet_id,))
+        await db.commit()
+        return cursor.rowcount > 0
+
+async def upsert_mirror_records(datasheet_id: str, records: List[Dict[str, Any]], sync_token: str):
+    """Сохраняет пачку записей True Tabs ({'recordId', 'fields', 'updatedAt'}) в локальную копию."""
+    rows = [
+        (datasheet_id, record['recordId'], json.dumps(record.get('fields', {}), ensure_ascii=False), record.get('updatedAt'), sync_token)
+        for record in records
+    ]
+    async with _writer() as db:
+        await db.executemany('''
+            INSERT INTO tt_mirror_records (datasheet_id, record_id, fields_json, updated_at_ms, sync_token)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(datasheet_id, record_id) DO UPDATE SET
+                fields_json = excluded.fields_json,
+                updated_at_ms = excluded.updated_at_ms,
+                sync_token = excluded.sync_token
+        ''', rows)
+        await db.commit()
+
+async def finish_mirror_sync(datasheet_id: str, sync_token: str, watermark_ms: Optional[int], full: bool) -> int:
+    """
+    Завершает синхронизацию: при полной синхронизации удаляет записи, не полученные в этот раз
+    (удаленные в True Tabs). Обновляет состояние копии и возвращает число записей в ней.
+    """
+    now = datetime.now().isoformat()
+    async with _writer() as db:
+        if full:
+            await db.execute('DELETE FROM tt_mirror_records WHERE datasheet_id = ? AND sync_token IS NOT ?', (datasheet_id, sync_token))
+        cursor = await db.execute('SELECT COUNT(*) FROM tt_mirror_records WHERE datasheet_id = ?', (datasheet_id,))
+        record_count = (await cursor.fetchone())[0]
+        await db.execute('''
+            UPDATE tt_mirror_datasheets
+            SET last_synced_at = ?,
+                last_full_sync_at = CASE WHEN ? THEN ? ELSE last_full_sync_at END,
+                watermark_ms = MAX(COALESCE(watermark_ms, 0), COALESCE(?, 0)),
+                record_count = ?
+            WHERE datasheet_id = ?
+        ''', (now, full, now, watermark_ms, record_count, datasheet_id))
+        await db.commit()
+        return record_count
+
+async def iter_mirror_records(datasheet_id: str):
+    """Асинхронно перебирает записи локальной копии в формате API True Tabs ({'recordId', 'fields'})."""
+    async with _reader() as db:
+        async with db.execute('SELECT record_id, fields_json FROM tt_mirror_records WHERE datasheet_id = ? ORDER BY rowid', (datasheet_id,)) as cursor:
+            async for record_id, fields_json in cursor:
+                yield {'recordId': record_id, 'fields': json.loads(fields_json)}
+
+# --- Очистка истории (retention) ---
+
+ARCHIVED_MESSAGE_SUFFIX = "\n… (полный текст в архиве)"
+
+async def rollup_upload_history(older_than: str) -> int:
+    """
+    Сворачивает записи истории старше older_than (ISO) в дневные итоги uploads_daily и удаляет их.
+    Последняя запись каждого запланированного задания сохраняется. Возвращает число удаленных записей.
+    """
+    await _flush_pending_uploads()
+    condition = '''
+        timestamp < ? AND id NOT IN (SELECT MAX(id) FROM uploads WHERE job_id IS NOT NULL GROUP BY job_id)
+    '''
+    async with _writer() as db:
+        try:
+            await db.execute(f'''
+                INSERT INTO uploads_daily (day, source_type, status, runs, total_duration_seconds, max_duration_seconds)
+                SELECT substr(timestamp, 1, 10), source_type, status, COUNT(*), COALESCE(SUM(duration_seconds), 0), MAX(duration_seconds)
+                FROM uploads WHERE {condition}
+                GROUP BY substr(timestamp, 1, 10), source_type, status
+                ON CONFLICT (day, source_type, status) DO UPDATE SET
+                    runs = runs + excluded.runs,
+                    total_duration_seconds = total_duration_seconds + excluded.total_duration_seconds,
+                    max_duration_seconds = MAX(COALESCE(max_duration_seconds, 0), COALESCE(excluded.max_duration_seconds, 0))
+            ''', (older_than,))
+            await db.execute(f'DELETE FROM uploads_message_archive WHERE upload_id IN (SELECT id FROM uploads WHERE {condition})', (older_than,))
+            cursor = await db.execute(f'DELETE FROM uploads WHERE {condition}', (older_than,))
+            await db.commit()
+            return cursor.rowcount
+        except Exception as e:
+            print(f"Ошибка при сворачивании истории загрузок: {e}", file=sys.stderr)
+            return 0
+
+async def archive_long_error_messages(max_chars: int, batch_size: int = 200) -> tuple:
+    """
+    Переносит длинные сообщения об ошибках (дампы stdout/stderr) в uploads_message_archive (zlib),
+    оставляя в uploads первые max_chars символов. Возвращает (число записей, освобождено байт).
+    """
+    await _flush_pending_uploads()
+    archived = 0
+    saved_bytes = 0
+    last_id = 0
+    while True:
+        async with _writer() as db:
+            cursor = await db.execute('''
+                SELECT id, error_message FROM uploads
+                WHERE id > ? AND length(error_message) > ? AND id NOT IN (SELECT upload_id FROM uploads_message_archive)
+                ORDER BY id LIMIT ?
+            ''', (last_id, max_chars + len(ARCHIVED_MESSAGE_SUFFIX), batch_size))
+            rows = await cursor.fetchall()
+            if not rows:
+                return archived, saved_bytes
+            for row in rows:
+                original = row['error_message'].encode('utf-8')
+                compressed = zlib.compress(original, 9)
+                truncated = row['error_message'][:max_chars] + ARCHIVED_MESSAGE_SUFFIX
+                await db.execute('INSERT INTO uploads_message_archive (upload_id, message_zlib, original_length) VALUES (?, ?, ?)', (row['id'], compressed, len(original)))
+                await db.execute('UPDATE uploads SET error_message = ? WHERE id = ?', (truncated, row['id']))
+                saved_bytes += len(original) - len(compressed) - len(truncated.encode('utf-8'))
+                last_id = row['id']
+            await db.commit()
+            archived += len(rows)
+
+async def get_archived_error_message(upload_id: int) -> Optional[str]:
+    """Возвращает полный текст сообщения об ошибке из архива или None, если он не архивировался."""
+    async with _reader() as db:
+        cursor = await db.execute('SELECT message_zlib FROM uploads_message_archive WHERE upload_id = ?', (upload_id,))
+        row = await cursor.fetchone()
+        return zlib.decompress(row['message_zlib']).decode('utf-8') if row else None
+
+async def list_referenced_upload_files() -> set:
+    """Пути файлов результатов, на которые ссылается история загрузок."""
+    await _flush_pending_uploads()
+    async with _reader() as db:
+        cursor = await db.execute('SELECT DISTINCT file_path FROM uploads WHERE file_path IS NOT NULL')
+        return {os.path.abspath(row['file_path']) for row in await cursor.fetchall()}
+
+async def get_database_free_bytes() -> int:
+    """Размер свободных страниц файла БД (место, которое освободит VACUUM)."""
+    async with _reader() as db:
+        cursor = await db.execute('PRAGMA freelist_count')
+        free_pages = (await cursor.fetchone())[0]
+        cursor = await db.execute('PRAGMA page_size')
+        return free_pages * (await cursor.fetchone())[0]
@@ -6,8 +6,13 @@ from . import upload_handlers
 from . import config_handlers
 from . import history_handlers
 from . import scheduled_handlers
+from . import stats_handlers
+from . import export_settings_handlers
 
 main_router = Router()
+# stats_handlers и export_settings_handlers подключаются первыми: start_handlers перехватывает все текстовые сообщения
+main_router.include_router(stats_handlers.router)
+main_router.include_router(export_settings_handlers.router)
 main_router.include_router(start_handlers.router)
 main_router.include_router(source_handlers.router)
 main_router.include_router(upload_handlers.router)
@@ -0,0 +1,176 @@
+import logging
+from html import escape
+from typing import Any, Dict, List, Optional
+
+from aiogram import Router, F
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from telegram_bot.database import sqlite_db
+from telegram_bot.utils.truetabs_api import get_truetabs_client
+
+logger = logging.getLogger(__name__)
+
+router = Router()
+
+# Настройки выгрузки (поля, формула фильтра, представление) хранятся в конфигурации True Tabs по умолчанию
+# и передаются в параметры запроса к API (fields, filterByFormula, viewId).
+
+
+class ExportSettingsProcess(StatesGroup):
+    select_fields = State()
+    waiting_filter_formula = State()
+    waiting_view_id = State()
+
+
+def format_export_settings(tt_config: Optional[Dict[str, Any]]) -> str:
+    if not tt_config:
+        return "Конфигурация True Tabs по умолчанию не найдена."
+    fields = tt_config.get('export_fields')
+    lines = [
+        f"Поля: {escape(', '.join(fields)) if fields else 'все'}",
+        f"Фильтр: <code>{escape(tt_config['export_filter_formula'])}</code>" if tt_config.get('export_filter_formula') else "Фильтр: нет",
+        f"Представление: <code>{escape(tt_config['export_view_id'])}</code>" if tt_config.get('export_view_id') else "Представление: нет",
+    ]
+    return "\n".join(lines)
+
+
+def export_settings_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📋 Поля", callback_data="export_settings:fields")],
+        [
+            InlineKeyboardButton(text="🔎 Формула фильтра", callback_data="export_settings:filter"),
+            InlineKeyboardButton(text="👁 Представление", callback_data="export_settings:view"),
+        ],
+        [InlineKeyboardButton(text="♻️ Сбросить", callback_data="export_settings:reset")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="export_data")],
+    ])
+
+
+def select_fields_keyboard(available_fields: List[str], selected_fields: List[str]) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    # В callback_data - индекс поля: имена полей могут не уместиться в 64 байта
+    for index, name in enumerate(available_fields):
+        mark = "✅" if name in selected_fields else "▫️"
+        builder.row(InlineKeyboardButton(text=f"{mark} {name}", callback_data=f"export_field:{index}"))
+    builder.row(
+        InlineKeyboardButton(text="Все поля", callback_data="export_fields_all"),
+        InlineKeyboardButton(text="💾 Сохранить", callback_data="export_fields_save"),
+    )
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="export_settings"))
+    return builder.as_markup()
+
+
+async def settings_text(notice: str = "") -> str:
+    tt_config = await sqlite_db.get_default_tt_config()
+    return f"{notice}⚙️ <b>Настройки выгрузки</b>\n\n{format_export_settings(tt_config)}"
+
+
+@router.callback_query(F.data == "export_settings")
+async def export_settings_handler(callback: CallbackQuery, state: FSMContext):
+    await state.set_state(None)
+    await callback.message.edit_text(await settings_text(), reply_markup=export_settings_keyboard(), parse_mode='HTML')
+    await callback.answer()
+
+
+@router.callback_query(F.data == "export_settings:fields")
+async def export_select_fields_handler(callback: CallbackQuery, state: FSMContext):
+    tt_config = await sqlite_db.get_default_tt_config()
+    if not tt_config:
+        await callback.answer("Конфигурация True Tabs по умолчанию не найдена.", show_alert=True)
+        return
+    try:
+        available_fields = await get_truetabs_client().get_field_names(tt_config['upload_api_token'], tt_config['upload_datasheet_id'], tt_config.get('export_view_id'))
+    except Exception as e:
+        logger.error(f"Ошибка получения списка полей таблицы {tt_config['upload_datasheet_id']}: {e}", exc_info=True)
+        await callback.answer("Не удалось получить список полей из True Tabs.", show_alert=True)
+        return
+
+    selected_fields = tt_config.get('export_fields') or list(available_fields)
+    await state.set_state(ExportSettingsProcess.select_fields)
+    await state.update_data(export_available_fields=available_fields, export_selected_fields=selected_fields)
+    await callback.message.edit_text("Выберите поля для выгрузки:", reply_markup=select_fields_keyboard(available_fields, selected_fields))
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("export_field:"), ExportSettingsProcess.select_fields)
+async def export_toggle_field_handler(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    available_fields = data['export_available_fields']
+    selected_fields = data['export_selected_fields']
+    name = available_fields[int(callback.data.split(":")[1])]
+    if name in selected_fields:
+        selected_fields.remove(name)
+    else:
+        # Сохраняем порядок полей таблицы
+        selected_fields = [field for field in available_fields if field in selected_fields or field == name]
+    await state.update_data(export_selected_fields=selected_fields)
+    await callback.message.edit_reply_markup(reply_markup=select_fields_keyboard(available_fields, selected_fields))
+    await callback.answer()
+
+
+@router.callback_query(F.data.in_({"export_fields_all", "export_fields_save"}), ExportSettingsProcess.select_fields)
+async def export_save_fields_handler(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    selected_fields = data['export_selected_fields']
+    # Все поля (или ни одного) - без ограничения, в запрос fields не передается
+    if callback.data == "export_fields_all" or not selected_fields or len(selected_fields) == len(data['export_available_fields']):
+        selected_fields = None
+    await save_export_settings(export_fields=selected_fields)
+    await state.set_state(None)
+    await callback.message.edit_text(await settings_text("Поля сохранены.\n\n"), reply_markup=export_settings_keyboard(), parse_mode='HTML')
+    await callback.answer()
+
+
+@router.callback_query(F.data.in_({"export_settings:filter", "export_settings:view"}))
+async def export_ask_setting_handler(callback: CallbackQuery, state: FSMContext):
+    if callback.data == "export_settings:filter":
+        await state.set_state(ExportSettingsProcess.waiting_filter_formula)
+        prompt = "Введите формулу фильтра True Tabs (filterByFormula), например <code>{Статус} = \"Активен\"</code>.\nОтправьте <code>-</code>, чтобы убрать фильтр."
+    else:
+        await state.set_state(ExportSettingsProcess.waiting_view_id)
+        prompt = "Введите ID представления (viewId), например <code>viwXXXXXXXX</code>.\nОтправьте <code>-</code>, чтобы выгружать без представления."
+    cancel_kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="export_settings")]])
+    await callback.message.edit_text(prompt, reply_markup=cancel_kb, parse_mode='HTML')
+    await callback.answer()
+
+
+@router.message(ExportSettingsProcess.waiting_filter_formula)
+async def export_filter_formula_handler(message: Message, state: FSMContext):
+    formula = message.text.strip()
+    await save_export_settings(export_filter_formula=None if formula == "-" else formula)
+    await state.set_state(None)
+    await message.answer(await settings_text("Фильтр сохранен.\n\n"), reply_markup=export_settings_keyboard(), parse_mode='HTML')
+
+
+@router.message(ExportSettingsProcess.waiting_view_id)
+async def export_view_id_handler(message: Message, state: FSMContext):
+    view_id = message.text.strip()
+    await save_export_settings(export_view_id=None if view_id == "-" else view_id)
+    await state.set_state(None)
+    await message.answer(await settings_text("Представление сохранено.\n\n"), reply_markup=export_settings_keyboard(), parse_mode='HTML')
+
+
+@router.callback_query(F.data == "export_settings:reset")
+async def export_reset_settings_handler(callback: CallbackQuery):
+    await save_export_settings(export_fields=None, export_filter_formula=None, export_view_id=None)
+    await callback.message.edit_text(await settings_text("Настройки сброшены.\n\n"), reply_markup=export_settings_keyboard(), parse_mode='HTML')
+    await callback.answer()
+
+
+_UNCHANGED = object()
+
+
+async def save_export_settings(export_fields: Any = _UNCHANGED, export_filter_formula: Any = _UNCHANGED, export_view_id: Any = _UNCHANGED) -> bool:
+    """Updates the given export settings of the default TT config, keeping the others."""
+    tt_config = await sqlite_db.get_default_tt_config()
+    if not tt_config:
+        return False
+    return await sqlite_db.update_tt_export_settings(
+        tt_config['name'],
+        tt_config.get('export_fields') if export_fields is _UNCHANGED else export_fields,
+        tt_config.get('export_filter_formula') if export_filter_formula is _UNCHANGED else export_filter_formula,
+        tt_config.get('export_view_id') if export_view_id is _UNCHANGED else export_view_id,
+    )
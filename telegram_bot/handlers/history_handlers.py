@@ -3,29 +3,71 @@ from aiogram import Router, F, Bot # Добавлен Bot для отправк
 from aiogram.types import CallbackQuery, InlineKeyboardButton, FSInputFile # Добавлен InlineKeyboardButton, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder # Добавлен InlineKeyboardBuilder
 from ..keyboards import history_pagination_keyboard, main_menu_keyboard
-from ..database.sqlite_db import get_upload_history, count_upload_history, get_upload_history_by_id # Добавлен get_upload_history_by_id
+from ..database.sqlite_db import get_upload_history_page, count_upload_history, get_upload_history_by_id, get_archived_error_message, ARCHIVED_MESSAGE_SUFFIX
+from ..config import TEMP_FILES_DIR
+import base64
 import os
+import struct
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 
 router = Router()
 
 RECORDS_PER_PAGE = 5
 
+_EPOCH = datetime(1970, 1, 1)
+
+# Подписи статусов операций; все прочие статусы показываются как ошибка
+STATUS_LABELS = {
+    'SUCCESS': '✅ Успех',
+    'SKIPPED': '⏭ Пропущено',
+    'CANCELLED': '⏹ Остановлено',
+    'TIMEOUT': '⏱ Превышено время',
+}
+
+def status_label(status: str) -> str:
+    return STATUS_LABELS.get(status, '❌ Ошибка')
+
+# Курсор страницы - ключ (timestamp, id) записи, упакованный в 16 байт и base64 (22 символа),
+# чтобы callback_data укладывался в лимит Telegram 64 байта.
+def encode_history_cursor(record: dict) -> str:
+    timestamp = datetime.fromisoformat(record['timestamp'])
+    micros = (timestamp - _EPOCH) // timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(struct.pack('>qq', micros, record['id'])).decode().rstrip('=')
+
+def decode_history_cursor(cursor: str) -> tuple:
+    micros, record_id = struct.unpack('>qq', base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    # isoformat() дает ту же строку, что записана в uploads.timestamp (datetime.now().isoformat())
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat(), record_id
+
 @router.callback_query(F.data.startswith("view_history:"))
 async def handle_view_history(callback: CallbackQuery):
-    try:
-        offset = int(callback.data.split(":")[1])
-    except (IndexError, ValueError):
-        offset = 0
+    # view_history:0 - первая страница; view_history:<n|p>:<номер страницы>:<курсор> - следующая/предыдущая
+    parts = callback.data.split(":")
+    page = 1
+    older_than = newer_than = None
+    if len(parts) == 4:
+        try:
+            direction, page, key = parts[1], int(parts[2]), decode_history_cursor(parts[3])
+            if direction == "n":
+                older_than = key
+            elif page > 1: # На первую страницу возвращаемся обычным запросом (с учетом новых записей)
+                newer_than = key
+        except (ValueError, struct.error):
+            page = 1
+            older_than = newer_than = None
 
     total_records = await count_upload_history()
-    # Убедимся, что offset не превышает общее количество записей
-    if offset >= total_records and total_records > 0:
-        offset = max(0, total_records - RECORDS_PER_PAGE)
-
-
-    history_records = await get_upload_history(limit=RECORDS_PER_PAGE, offset=offset)
+    # Запрашиваем на одну запись больше, чтобы знать, есть ли следующая страница
+    history_records = await get_upload_history_page(limit=RECORDS_PER_PAGE + (0 if newer_than else 1), older_than=older_than, newer_than=newer_than)
+    has_next = newer_than is not None or len(history_records) > RECORDS_PER_PAGE
+    history_records = history_records[:RECORDS_PER_PAGE]
+    if not history_records and page > 1:
+        # Записи этой страницы удалены - показываем первую
+        page = 1
+        history_records = await get_upload_history_page(limit=RECORDS_PER_PAGE + 1)
+        has_next = len(history_records) > RECORDS_PER_PAGE
+        history_records = history_records[:RECORDS_PER_PAGE]
 
     text = "📊 <b>История загрузок:</b>\n\n"
     builder = InlineKeyboardBuilder() # Используем билдер для создания кнопок записей и пагинации
@@ -39,26 +81,20 @@ async def handle_view_history(callback: CallbackQuery):
             # Форматируем дату и время для отображения
             timestamp_local = datetime.fromisoformat(record["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
             # Краткая сводка для списка
-            record_summary = f"#{record['id']}: {timestamp_local} - {record['source_type']} - {'✅ Успех' if record['status'] == 'SUCCESS' else '❌ Ошибка'}"
+            record_summary = f"#{record['id']}: {timestamp_local} - {record['source_type']} - {status_label(record['status'])}"
             text += f"{record_summary}\n"
             # Добавляем кнопку "Детали" для каждой записи в отдельную строку
             builder.row(InlineKeyboardButton(text=f"👁️ Детали #{record['id']}", callback_data=f"view_history_details:{record['id']}"))
         text += "---\n" # Разделитель перед кнопками пагинации
 
-        # Добавляем кнопки пагинации
-        prev_offset = max(0, offset - RECORDS_PER_PAGE)
-        next_offset = offset + RECORDS_PER_PAGE
-        has_prev = offset > 0
-        has_next = next_offset < total_records
-
+        # Добавляем кнопки пагинации: курсор - первая/последняя запись текущей страницы
         pagination_buttons = []
-        if has_prev:
-            pagination_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"view_history:{prev_offset}"))
-        current_page_start = offset + 1
-        current_page_end = min(offset + RECORDS_PER_PAGE, total_records)
-        pagination_buttons.append(InlineKeyboardButton(text=f"{current_page_start}-{current_page_end} из {total_records}", callback_data="ignore")) # Кнопка "игнорировать" для отображения текущей страницы
+        if page > 1:
+            pagination_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"view_history:p:{page - 1}:{encode_history_cursor(history_records[0])}"))
+        total_pages = max(1, -(-total_records // RECORDS_PER_PAGE))
+        pagination_buttons.append(InlineKeyboardButton(text=f"Стр. {page} из {total_pages} ({total_records} записей)", callback_data="ignore")) # Кнопка "игнорировать" для отображения текущей страницы
         if has_next:
-            pagination_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"view_history:{next_offset}"))
+            pagination_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"view_history:n:{page + 1}:{encode_history_cursor(history_records[-1])}"))
 
         # Добавляем кнопки пагинации в одну строку (если есть)
         if pagination_buttons:
@@ -94,7 +130,7 @@ async def handle_view_history_details(callback: CallbackQuery, bot: Bot): # До
     timestamp_local = datetime.fromisoformat(record["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
     details_text += f"Дата и время: {timestamp_local}\n"
     details_text += f"Источник: <code>{record['source_type']}</code>\n"
-    details_text += f"Статус: {'✅ Успех' if record['status'] == 'SUCCESS' else '❌ Ошибка'}\n"
+    details_text += f"Статус: {status_label(record['status'])}\n"
     if record['duration_seconds'] is not None:
         details_text += f"Время выполнения: {record['duration_seconds']:.2f} сек\n"
     if record['file_path']:
@@ -115,6 +151,9 @@ async def handle_view_history_details(callback: CallbackQuery, bot: Bot): # До
 
 
     builder = InlineKeyboardBuilder()
+    # Длинное сообщение об ошибке сокращено при очистке истории - полный текст можно получить файлом
+    if record['error_message'] and record['error_message'].endswith(ARCHIVED_MESSAGE_SUFFIX):
+         builder.row(InlineKeyboardButton(text="📄 Полный текст ошибки", callback_data=f"send_history_error:{record['id']}"))
     # Кнопка для повторной отправки файла, если операция была успешной и файл существует на сервере бота
     if record['status'] == 'SUCCESS' and record['file_path'] and os.path.exists(record['file_path']):
          builder.row(InlineKeyboardButton(text="📎 Отправить файл", callback_data=f"send_history_file:{record['id']}"))
@@ -152,6 +191,34 @@ async def handle_send_history_file(callback: CallbackQuery, bot: Bot):
         await callback.answer("Произошла ошибка при отправке файла.")
 
 
+# --- Хэндлер для отправки полного текста ошибки из архива ---
+@router.callback_query(F.data.startswith("send_history_error:"))
+async def handle_send_history_error(callback: CallbackQuery, bot: Bot):
+    try:
+        record_id = int(callback.data.split(":")[1])
+    except (IndexError, ValueError):
+        await callback.answer("Неверный ID записи истории.")
+        return
+
+    message_text = await get_archived_error_message(record_id)
+    if message_text is None:
+        await callback.answer("Полный текст ошибки не найден.")
+        return
+
+    file_path = os.path.join(TEMP_FILES_DIR, f"error_{record_id}.txt")
+    try:
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(message_text)
+        await bot.send_document(callback.message.chat.id, document=FSInputFile(file_path, filename=f"error_{record_id}.txt"))
+        await callback.answer()
+    except Exception as e:
+        print(f"Ошибка при отправке полного текста ошибки: {e}", file=sys.stderr)
+        await callback.answer("Произошла ошибка при отправке файла.")
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
 @router.callback_query(F.data == "ignore")
 async def handle_ignore_callback(callback: CallbackQuery):
     # Хэндлер для кнопок, которые должны просто игнорироваться (например, кнопка текущей страницы пагинации)
@@ -5,7 +5,9 @@ import time
 import os
 import shutil
 import uuid # Импортируем uuid для генерации уникальных ID заданий
-from datetime import datetime
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Dict, Any, Optional, List
 
 from aiogram import Bot, Router, F
@@ -16,24 +18,38 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import StateFilter
 
-# Импорт APScheduler trigger classes и scheduler instance
-from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.triggers.cron import CronTrigger # Хотя пока не используем, импортируем для FSM
-from apscheduler.triggers.date import DateTrigger # Хотя пока не используем, импортируем для FSM
 from apscheduler.jobstores.base import JobLookupError
-# *** Важно: Импортируем экземпляр планировщика из вашего bot.py ***
-# Этот импорт вызывает циклическую зависимость, поэтому удаляем его
-# try:
-#     from bot import scheduler
-# except ImportError:
-#     # Если импорт не удался (например, при запуске напрямую scheduled_handlers),
-#     # нужно как-то получить доступ к планировщику. В продакшене лучше использовать DI.
-#     # Для быстрой реализации, можем просто выводить ошибку, если scheduler недоступен.
-#     print("WARNING: APScheduler instance 'scheduler' not found. Scheduled job execution/management may fail.", file=sys.stderr)
-#     scheduler = None # Устанавливаем в None, если импорт не удался
-
-
-from ..utils.rust_executor import execute_rust_command
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+
+from ..utils.admission import estimate_run_cost, run_admission
+from ..utils.leases import INSTANCE_ID, claim_run, finish_run, take_scheduled_time
+from ..utils.rust_executor import run_rust_command
+from ..utils.rust_args import build_rust_args
+from ..utils.scheduling import (
+    AFTER_TRIGGER_TYPE,
+    CATCHUP_POLICIES,
+    DEFAULT_OVERRUN_POLICY,
+    OVERRUN_POLICIES,
+    OffsetTrigger,
+    backoff_delay_seconds,
+    build_trigger,
+    catchup_limit,
+    catchup_policy,
+    definition_fingerprint,
+    downstream_jobs,
+    find_dependency_cycle,
+    format_duration,
+    is_expired_date_trigger,
+    job_policy,
+    missed_fire_times,
+    overrun_policy,
+    run_timeout_seconds,
+    spread_offset,
+    start_histogram,
+    trigger_period_seconds,
+    upstream_job_ids,
+)
 from ..database import sqlite_db
 from .. import config
 from .upload_handlers import SOURCE_PARAMS_ORDER, get_friendly_param_name
@@ -64,49 +80,522 @@ class ScheduleProcess(StatesGroup):
     waiting_cron_args = State() # Ожидание параметров для CronTrigger - НОВОЕ
     waiting_date_args = State() # Ожидание параметров для DateTrigger - НОВОЕ
     confirm_schedule = State() # Подтверждение создания задания - НОВОЕ
+    waiting_jitter_seconds = State() # Ожидание окна разброса запуска (редактирование)
+    waiting_timeout_seconds = State() # Ожидание ограничения времени запуска (редактирование)
+    select_schedule_upstream = State() # Выбор заданий, после которых запускается задание (тип 'after')
+    select_overrun_policy = State() # Выбор политики наложения запусков (редактирование)
+    select_catchup_policy = State() # Выбор политики пропущенных запусков (редактирование)
     # ... состояния для редактирования/удаления ...
 
 
 import logging
 from aiogram import Bot
 
-# --- Функции выполнения запланированных задач (без изменений) ---
-# async def scheduled_task_executor(bot: Bot, chat_id: int, ...): ...
-# async def run_rust_task_for_scheduled_job(...): ...
+# Планировщик и бот задаются в bot.py при запуске (scheduled_handlers.scheduler / scheduled_handlers.bot).
+# Экземпляр бота не передается в kwargs задания: они сохраняются в SQLAlchemyJobStore (pickle).
+scheduler: Optional[AsyncIOScheduler] = None
+bot: Optional[Bot] = None
+
+# Запущенные шаги конвейеров (ссылки на задачи, пока они выполняются)
+_pipeline_tasks: set = set()
+
+# Политика наложения запусков: отметка "задание выполняется" хранится в БД (sqlite_db.claim_active_run) и видна всем
+# экземплярам бота. Здесь - запуски этого экземпляра: токен запуска по задаче, событие остановки по токену (следующий
+# запуск на этом экземпляре выставляет его сразу, с другого экземпляра просьба приходит через БД) и события
+# освобождения заданий для ожидающих запусков
+_run_tokens: Dict[asyncio.Task, str] = {}
+_supersede_events: Dict[str, asyncio.Event] = {}
+_turn_events: Dict[str, asyncio.Event] = {}
+# Результат _unless_superseded, если запуск остановлен следующим запуском
+_SUPERSEDED = object()
+
+# Догоняющие запуски после простоя (ссылки на задачи, пока они выполняются)
+_catchup_tasks: set = set()
+
+
+def add_job_to_scheduler(job_data: Dict[str, Any], replace_existing: bool = True) -> bool:
+    """
+    Добавляет задание из scheduled_jobs в планировщик (триггер и политика запуска из utils.scheduling).
+    Возвращает False, если задание выключено, одноразовое и его дата уже прошла, или запускается после
+    других заданий (тип 'after' - такие задания запускает advance_pipeline). Ошибки триггера - ValueError.
+    """
+    trigger_args = json.loads(job_data['trigger_args_json'])
+    if not job_data.get('enabled', True) or job_data['trigger_type'] == AFTER_TRIGGER_TYPE:
+        return False
+    if is_expired_date_trigger(job_data['trigger_type'], trigger_args):
+        return False
+    scheduler.add_job(
+        scheduled_task_executor,
+        trigger=build_trigger(job_data['trigger_type'], trigger_args, job_data['job_id']),
+        id=job_data['job_id'],
+        name=job_data['name'],
+        kwargs={
+            'job_id': job_data['job_id'],
+            'chat_id': job_data['chat_id'],
+            'source_config_name': job_data['source_config_name'],
+            'tt_config_name': job_data['tt_config_name'],
+            'action': job_data['action'],
+            'job_name': job_data['name'],
+            'fingerprint': definition_fingerprint(job_data),
+        },
+        replace_existing=replace_existing,
+        **job_policy(),
+    )
+    return True
+
+
+def reconcile_scheduler(jobs: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Brings the job store in line with scheduled_jobs at startup: only added and changed jobs are written
+    (compared by the fingerprint in the job kwargs), jobs that are gone, disabled or not timer-driven
+    any more are removed. The scheduler must already be started (paused), so the job store is loaded.
+    Runs missed while the bot was down are caught up according to the job's catch-up policy (plan_catchup).
+    """
+    counts = {'unchanged': 0, 'added': 0, 'updated': 0, 'removed': 0, 'not_scheduled': 0, 'catch_up': 0}
+    stored = {job.id: job for job in scheduler.get_jobs() if job.func is scheduled_task_executor}
+    wanted = set()
+    for job_data in jobs:
+        job_id = job_data['job_id']
+        stored_job = stored.get(job_id)
+        if job_data['enabled'] and job_data['trigger_type'] != AFTER_TRIGGER_TYPE:
+            counts['catch_up'] += plan_catchup(job_data, stored_job)
+        if (stored_job is not None and job_data['enabled'] and job_data['trigger_type'] != AFTER_TRIGGER_TYPE
+                and stored_job.kwargs.get('fingerprint') == definition_fingerprint(job_data)):
+            wanted.add(job_id)
+            counts['unchanged'] += 1
+            continue
+        try:
+            if add_job_to_scheduler(job_data):
+                wanted.add(job_id)
+                counts['updated' if stored_job is not None else 'added'] += 1
+            else:
+                counts['not_scheduled'] += 1
+        except Exception as e:
+            logging.error(f"Ошибка при загрузке запланированного задания '{job_data.get('name')}' (ID: {job_id}): {e}", exc_info=True)
+    for job_id in stored.keys() - wanted:
+        scheduler.remove_job(job_id)
+        counts['removed'] += 1
+    return counts
+
+
+def plan_catchup(job_data: Dict[str, Any], stored_job) -> int:
+    """
+    Finds runs of the job missed while the bot was down and starts catching them up ('once' - the latest one,
+    'all' - the last catchup_limit, oldest first). The stored job is moved to its next future fire time, so
+    APScheduler does not run the missed ones itself. 'skip' leaves them to APScheduler: only a run late by less
+    than SCHEDULED_MISFIRE_GRACE_SECONDS is executed. Returns the number of catch-up runs.
+    """
+    policy = catchup_policy(job_data)
+    if policy == 'skip':
+        return 0
+    limit = 1 if policy == 'once' else catchup_limit(job_data)
+    if job_data['trigger_type'] == 'date':
+        # Одноразовое задание, дата которого прошла, пока бот не работал (и после нее задание не выполнялось)
+        trigger_args = json.loads(job_data['trigger_args_json'])
+        if not is_expired_date_trigger('date', trigger_args):
+            return 0
+        run_date = datetime.fromisoformat(trigger_args['run_date'])
+        local_run_date = run_date.astimezone().replace(tzinfo=None) if run_date.tzinfo else run_date
+        if job_data.get('last_run_at') and datetime.fromisoformat(job_data['last_run_at']) >= local_run_date:
+            return 0
+        missed_total, run_times = 1, [run_date]
+    else:
+        if stored_job is None or stored_job.next_run_time is None:
+            return 0
+        now = datetime.now(stored_job.next_run_time.tzinfo)
+        if stored_job.next_run_time > now:
+            return 0
+        missed_total, run_times = missed_fire_times(stored_job.trigger, stored_job.next_run_time, now, limit)
+        stored_job.modify(next_run_time=stored_job.trigger.get_next_fire_time(None, now))
+    logging.warning(f"Scheduled job '{job_data['name']}' missed {missed_total} run(s) while the bot was down; "
+                    f"catching up {len(run_times)} (policy '{policy}')")
+    task = asyncio.create_task(run_catchup(job_data, run_times))
+    _catchup_tasks.add(task)
+    task.add_done_callback(_catchup_tasks.discard)
+    return len(run_times)
+
+
+async def run_catchup(job_data: Dict[str, Any], run_times: List[datetime]):
+    """
+    Executes the missed runs of one job one after another. Jobs start their catch-up at a constant offset
+    within SCHEDULE_CATCHUP_SPREAD_SECONDS, so a restart after an outage does not start all of them at once.
+    """
+    await asyncio.sleep(spread_offset(f"{job_data['job_id']}:catchup", config.SCHEDULE_CATCHUP_SPREAD_SECONDS))
+    for scheduled_for in run_times:
+        await scheduled_task_executor(
+            chat_id=job_data['chat_id'],
+            source_config_name=job_data['source_config_name'],
+            tt_config_name=job_data['tt_config_name'],
+            action=job_data['action'],
+            job_name=job_data['name'],
+            job_id=job_data['job_id'],
+            scheduled_for=scheduled_for,
+        )
+
 
 async def scheduled_task_executor(
-    bot: Bot,
     chat_id: int,
     source_config_name: str,
     tt_config_name: str,
     action: str,
     job_name: str,
+    job_id: Optional[str] = None,
+    artifact_path: Optional[str] = None,
+    fingerprint: Optional[str] = None, # Хэш определения задания для reconcile_scheduler, при запуске не используется
+    scheduled_for: Optional[datetime] = None, # Плановое время пропущенного запуска (run_catchup)
 ):
     """
-    Executes the scheduled task based on the action and configurations.
+    Executes a scheduled job: resolves the saved source and TT configs, runs the Rust utility
+    (admitted by utils.admission: shortest expected run first, within the run and memory budgets),
+    records the result in the history and notifies the chat.
+    artifact_path - result file of the previous pipeline step; it replaces the configured source.
+    With several bot instances a timer run is executed only by the instance that claims it (utils.leases);
+    the lease stays open until the run is over.
     """
-    logging.info(f"Scheduled task '{job_name}' started for chat_id={chat_id}, action={action}")
+    if scheduled_for is None and job_id:
+        scheduled_for = take_scheduled_time(job_id)
+    if scheduled_for is not None and not await claim_run(job_id, scheduled_for):
+        logging.info(f"Scheduled task '{job_name}' ({scheduled_for.isoformat()}) is executed by another instance")
+        return
+    try:
+        if job_id and not await acquire_overrun_turn(job_id, job_name):
+            return
+        logging.info(f"Scheduled task '{job_name}' triggered for chat_id={chat_id}, action={action}")
+        start_histogram.record()
+        run_token = _run_tokens.get(asyncio.current_task())
+        queued_at = datetime.now()
+        job = await sqlite_db.get_scheduled_job(job_id) if job_id else None
+        cost = estimate_run_cost(job)
+        async with AsyncExitStack() as admission:
+            queue_wait_seconds = await _unless_superseded(admission.enter_async_context(run_admission.slot(cost)), job_id, run_token)
+            if queue_wait_seconds is _SUPERSEDED:
+                logging.info(f"Scheduled task '{job_name}' was replaced by the next run before it started")
+                return
+            run_id = None
+            if job_id:
+                run_id = await record_run_start(job_id, (scheduled_for or queued_at).isoformat(), queue_wait_seconds)
+            result = await run_scheduled_job(chat_id, source_config_name, tt_config_name, action, job_name, job_id, artifact_path,
+                                             run_timeout_seconds(job), run_token)
+        if run_id is not None:
+            consecutive_failures = await record_run_finish(run_id, job_id, result)
+            if consecutive_failures:
+                apply_backoff(job_id, consecutive_failures)
+        # Следующие шаги конвейера запускаются вне пула: они сами встанут в очередь допуска
+        if job_id:
+            await advance_pipeline(job_id, job_name, result["status"], result.get("file_path") if result["status"] == "SUCCESS" else None)
+    finally:
+        run_token = _run_tokens.pop(asyncio.current_task(), None)
+        if run_token is not None:
+            await release_overrun_turn(job_id, run_token)
+        if scheduled_for is not None:
+            await finish_run(job_id, scheduled_for)
+
+
+async def acquire_overrun_turn(job_id: str, job_name: str) -> bool:
+    """
+    Applies the job's overrun policy if its previous run is still going on any bot instance (active_runs in the database):
+    'skip' drops this run, 'queue' waits for the previous one (one waiting run at most), 'cancel' stops the previous one.
+    Returns True when this run may start; it is then the job's active run until release_overrun_turn.
+    """
+    run_token = uuid.uuid4().hex
+    # Запуск освобождает отметку в БД и тогда, когда только ждал очереди (release_overrun_turn в scheduled_task_executor)
+    _run_tokens[asyncio.current_task()] = run_token
+    job = await sqlite_db.get_scheduled_job(job_id)
+    policy = overrun_policy(job) if job else DEFAULT_OVERRUN_POLICY
+    holder = await sqlite_db.claim_active_run(job_id, run_token, INSTANCE_ID, time.time(), policy != 'skip', policy == 'cancel')
+    if holder is None:
+        _supersede_events[run_token] = asyncio.Event()
+        return True
+    if not holder['queued']:
+        logging.warning(f"Scheduled task '{job_name}': the previous run is still going on instance {holder['instance_id']}, "
+                        f"this run is skipped (policy '{policy}')")
+        return False
+    if policy == 'cancel':
+        logging.warning(f"Scheduled task '{job_name}': the previous run is still going on instance {holder['instance_id']} "
+                        f"and is cancelled (policy 'cancel')")
+        if holder['run_token'] in _supersede_events:
+            _supersede_events[holder['run_token']].set()
+    while True:
+        turn = _turn_events.setdefault(job_id, asyncio.Event())
+        taken = await sqlite_db.take_active_run_turn(job_id, run_token, INSTANCE_ID, time.time())
+        if taken:
+            _supersede_events[run_token] = asyncio.Event()
+            return True
+        if taken is None:
+            logging.warning(f"Scheduled task '{job_name}': the place in the overrun queue was lost, this run is skipped")
+            return False
+        # Предыдущий запуск этого экземпляра будит сразу, запуск другого экземпляра замечается при проверке БД
+        try:
+            await asyncio.wait_for(turn.wait(), config.SCHEDULE_OVERRUN_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
 
+async def release_overrun_turn(job_id: str, run_token: str):
+    """Ends the job's active run (or leaves the overrun queue); the waiting run, if any, takes over."""
+    _supersede_events.pop(run_token, None)
     try:
-        # Example: handle different actions
-        if action == "extract":
-            # Call extraction logic here, e.g., run rust task or other
-            # For example, call run_rust_task_for_scheduled_job or similar
-            logging.info(f"Executing extract action for job '{job_name}'")
-            # Placeholder: await run_rust_task_for_scheduled_job(bot, chat_id, source_config_name, tt_config_name, job_name)
-        elif action == "update":
-            logging.info(f"Executing update action for job '{job_name}'")
-            # Placeholder for update action logic
-        else:
-            logging.warning(f"Unknown action '{action}' for scheduled task '{job_name}'")
+        await sqlite_db.release_active_run(job_id, run_token, time.time())
+    except Exception as e:
+        logging.error(f"Не удалось снять отметку выполняющегося запуска задания {job_id}: {e}", exc_info=True)
+    turn = _turn_events.pop(job_id, None)
+    if turn is not None:
+        turn.set()
+
+
+async def _wait_superseded(job_id: str, run_token: str):
+    """Returns when the next run of the job asks this one to stop: on this instance via the event, on another one via active_runs."""
+    event = _supersede_events[run_token]
+    while not event.is_set():
+        try:
+            await asyncio.wait_for(event.wait(), config.SCHEDULE_OVERRUN_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            try:
+                if await sqlite_db.is_active_run_cancel_requested(job_id, run_token):
+                    return
+            except Exception as e:
+                logging.error(f"Ошибка проверки остановки запуска задания {job_id}: {e}")
 
-        # Notify user about task completion (optional)
-        await bot.send_message(chat_id, f"Scheduled task '{job_name}' executed successfully.")
 
+async def _unless_superseded(aw, job_id: Optional[str], run_token: Optional[str]):
+    """
+    Awaits aw unless the run is superseded by the next run of its job first (policy 'cancel'):
+    then aw is cancelled and _SUPERSEDED is returned. The run's own task is never cancelled.
+    """
+    if run_token is None or run_token not in _supersede_events:
+        return await aw
+    task = asyncio.ensure_future(aw)
+    stop = asyncio.ensure_future(_wait_superseded(job_id, run_token))
+    stopped = False
+    try:
+        await asyncio.wait([task, stop], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop.cancel()
+        if not task.done():
+            stopped = True
+            task.cancel()
+            await asyncio.wait([task])
+    if stopped:
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"Остановленный запуск завершился с ошибкой: {task.exception()}")
+        return _SUPERSEDED
+    return task.result()
+
+
+def apply_backoff(job_id: str, consecutive_failures: int):
+    """Postpones the next timer run after consecutive failures: period * 2^failures (utils.scheduling.backoff_delay_seconds)."""
+    aps_job = scheduler.get_job(job_id) if scheduler else None
+    if aps_job is None or aps_job.next_run_time is None:
+        return
+    now = datetime.now(aps_job.next_run_time.tzinfo)
+    period = trigger_period_seconds(aps_job.trigger, now)
+    if not period:
+        return
+    next_run_time = now + timedelta(seconds=backoff_delay_seconds(period, consecutive_failures))
+    if next_run_time > aps_job.next_run_time:
+        aps_job.modify(next_run_time=next_run_time)
+        logging.warning(f"Scheduled job {job_id}: {consecutive_failures} failures in a row, next run postponed to {next_run_time.isoformat()}")
+
+
+async def record_run_start(job_id: str, scheduled_at: str, queue_wait_seconds: float) -> Optional[int]:
+    """Starts a schedule_runs ledger entry; ledger errors never stop the run itself."""
+    try:
+        return await sqlite_db.start_schedule_run(job_id, scheduled_at, queue_wait_seconds, INSTANCE_ID)
+    except Exception as e:
+        logging.error(f"Ошибка записи в журнал запусков задания {job_id}: {e}", exc_info=True)
+        return None
+
+
+async def record_run_finish(run_id: int, job_id: str, result: Dict[str, Any]) -> Optional[int]:
+    """Closes the ledger entry; returns the job's number of consecutive failures (None if the ledger write failed)."""
+    rows = result.get("uploaded_records") if result.get("uploaded_records") is not None else result.get("extracted_rows")
+    try:
+        return await sqlite_db.finish_schedule_run(run_id, job_id, result["status"], rows, result.get("duration_seconds"),
+                                                   result.get("peak_memory_kb"))
+    except Exception as e:
+        logging.error(f"Ошибка записи в журнал запусков задания {job_id}: {e}", exc_info=True)
+        return None
+
+
+async def run_scheduled_job(chat_id: int, source_config_name: str, tt_config_name: str, action: str, job_name: str, job_id: Optional[str],
+                            artifact_path: Optional[str] = None, timeout_seconds: Optional[int] = None,
+                            run_token: Optional[str] = None) -> Dict[str, Any]:
+    source_type = "unknown"
+    datasheet_id = "N/A"
+    started = time.monotonic()
+    result: Dict[str, Any] = {"status": "ERROR", "message": None, "duration_seconds": 0.0, "file_path": None}
+    try:
+        source_config = await sqlite_db.get_source_config(source_config_name)
+        tt_config = await sqlite_db.get_tt_config(tt_config_name)
+        if not source_config:
+            raise ValueError(f"Конфигурация источника '{source_config_name}' не найдена.")
+        if not tt_config:
+            raise ValueError(f"Конфигурация True Tabs '{tt_config_name}' не найдена.")
+        if action not in ('extract', 'update'):
+            raise ValueError(f"Неизвестное действие '{action}'.")
+
+        source_type = source_config['source_type']
+        if artifact_path:
+            # Шаг конвейера: источником служит файл результата предыдущего шага
+            source_type = 'csv' if artifact_path.lower().endswith('.csv') else 'excel'
+            source_config = {'source_url': artifact_path, 'upload_expected_headers': source_config.get('upload_expected_headers')}
+        datasheet_id = tt_config.get('upload_datasheet_id') or "N/A"
+        output_filepath = None
+        if action == 'extract':
+            output_filename = f"scheduled_{job_id or chat_id}_{source_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            output_filepath = str(Path(config.TEMP_FILES_DIR) / output_filename)
+        tt_params = {key: tt_config.get(key) for key in ('upload_api_token', 'upload_datasheet_id', 'upload_field_map_json')}
+        rust_args = build_rust_args(action, source_type, source_config, tt_params, output_filepath)
+
+        result = await _unless_superseded(run_rust_command(rust_args, chat_id, 'scheduled', timeout_seconds), job_id, run_token)
+        if result is _SUPERSEDED:
+            result = {"status": "CANCELLED", "message": "Запуск остановлен: начался следующий запуск задания (политика наложения 'cancel').",
+                      "duration_seconds": time.monotonic() - started, "file_path": None}
+        datasheet_id = result.get("datasheet_id") or datasheet_id
     except Exception as e:
         logging.error(f"Error executing scheduled task '{job_name}': {e}", exc_info=True)
-        await bot.send_message(chat_id, f"Error executing scheduled task '{job_name}': {e}")
+        result = {"status": "ERROR", "message": str(e), "duration_seconds": result.get("duration_seconds", 0.0), "file_path": None}
 
+    status = result["status"]
+    file_path = result.get("file_path") if status == "SUCCESS" else None
+    try:
+        await sqlite_db.add_upload_record(
+            source_type=source_type,
+            status=status,
+            file_path=file_path,
+            error_message=result.get("message"),
+            true_tabs_datasheet_id=datasheet_id,
+            duration_seconds=result.get("duration_seconds"),
+            job_id=job_id,
+            chat_id=chat_id,
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении записи истории для задания '{job_name}': {e}", exc_info=True)
+
+    logging.info(f"Scheduled task '{job_name}' finished with status {status}")
+    await notify_scheduled_result(chat_id, job_name, result, file_path)
+    return result
+
+
+async def advance_pipeline(job_id: str, job_name: str, status: str, file_path: Optional[str], skipped: Optional[set] = None):
+    """
+    Starts the jobs waiting for job_id as soon as all of their upstream jobs have succeeded,
+    passing them the upstream result file. If job_id did not succeed, its dependents are skipped.
+    Readiness is kept per cycle in the database (sqlite_db.record_pipeline_upstream), so it survives
+    restarts and upstream jobs run by different instances still meet.
+    skipped - steps already skipped by this propagation: in a diamond (A->B, A->C, B->C) a failed A
+    reaches C both directly and through B, and C must be skipped once.
+    """
+    opened_after = (datetime.now() - timedelta(hours=config.SCHEDULE_PIPELINE_WINDOW_HOURS)).isoformat()
+    for downstream in downstream_jobs(await sqlite_db.list_all_scheduled_jobs(), job_id):
+        if not downstream['enabled']:
+            continue
+        downstream_id = downstream['job_id']
+        if status != 'SUCCESS':
+            if skipped is None:
+                skipped = set()
+            if downstream_id in skipped:
+                continue
+            skipped.add(downstream_id)
+            await sqlite_db.close_pipeline_cycle(downstream_id)
+            await skip_pipeline_step(downstream, f"Предыдущий шаг '{job_name}' завершился со статусом {status}.", skipped)
+            continue
+
+        upstream_ids = upstream_job_ids(downstream)
+        ready = await sqlite_db.record_pipeline_upstream(downstream_id, job_id, file_path, upstream_ids, opened_after)
+        if ready is None:
+            continue # Ждем остальных предшественников (или шаг уже запустил другой экземпляр)
+        # Файл результата первого (в порядке зависимостей) предшественника, у которого он есть
+        artifact_path = next((ready[upstream_id] for upstream_id in upstream_ids if ready[upstream_id]), None)
+        logging.info(f"Pipeline step '{downstream['name']}' is ready after '{job_name}' (artifact: {artifact_path})")
+        task = asyncio.create_task(scheduled_task_executor(
+            chat_id=downstream['chat_id'],
+            source_config_name=downstream['source_config_name'],
+            tt_config_name=downstream['tt_config_name'],
+            action=downstream['action'],
+            job_name=downstream['name'],
+            job_id=downstream_id,
+            artifact_path=artifact_path,
+        ))
+        _pipeline_tasks.add(task)
+        task.add_done_callback(_pipeline_tasks.discard)
+
+
+async def report_lost_runs(lost: List[Dict[str, Any]]):
+    """
+    Reports runs of a stopped instance that were closed with an error by sqlite_db.recover_lost_runs:
+    records them in the history, notifies the chat, applies the backoff and skips their pipeline dependents.
+    """
+    for run in lost:
+        job = await sqlite_db.get_scheduled_job(run['job_id'])
+        if not job:
+            continue
+        reason = f"Экземпляр бота {run['instance_id']}, выполнявший запуск, перестал отвечать; результат запуска неизвестен."
+        logging.warning(f"Scheduled task '{job['name']}' ({run['scheduled_at']}) lost: {reason}")
+        try:
+            source_config = await sqlite_db.get_source_config(job['source_config_name'])
+            await sqlite_db.add_upload_record(
+                source_type=source_config['source_type'] if source_config else "unknown",
+                status="ERROR",
+                error_message=reason,
+                job_id=job['job_id'],
+                chat_id=job['chat_id'],
+            )
+            await notify_scheduled_result(job['chat_id'], job['name'], {"status": "ERROR", "message": reason, "duration_seconds": 0.0}, None)
+            if run['consecutive_failures']:
+                apply_backoff(job['job_id'], run['consecutive_failures'])
+            await advance_pipeline(job['job_id'], job['name'], "ERROR", None)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке потерянного запуска задания '{job['name']}': {e}", exc_info=True)
+
+
+async def skip_pipeline_step(job: Dict[str, Any], reason: str, skipped: Optional[set] = None):
+    """Records a skipped pipeline step in the history, notifies the chat and skips the step's own dependents."""
+    logging.info(f"Pipeline step '{job['name']}' skipped: {reason}")
+    source_config = await sqlite_db.get_source_config(job['source_config_name'])
+    try:
+        await sqlite_db.add_upload_record(
+            source_type=source_config['source_type'] if source_config else "unknown",
+            status="SKIPPED",
+            error_message=reason,
+            duration_seconds=0.0,
+            job_id=job['job_id'],
+            chat_id=job['chat_id'],
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении записи истории для задания '{job['name']}': {e}", exc_info=True)
+    result = {"status": "SKIPPED", "message": reason, "duration_seconds": 0.0}
+    run_id = await record_run_start(job['job_id'], datetime.now().isoformat(), 0.0)
+    if run_id is not None:
+        await record_run_finish(run_id, job['job_id'], result)
+    await notify_scheduled_result(job['chat_id'], job['name'], result, None)
+    await advance_pipeline(job['job_id'], job['name'], "SKIPPED", None, skipped)
+
+
+async def notify_scheduled_result(chat_id: int, job_name: str, result: Dict[str, Any], file_path: Optional[str]):
+    if bot is None:
+        logging.warning(f"Бот недоступен, результат задания '{job_name}' не отправлен в чат {chat_id}.")
+        return
+    if result["status"] == "SUCCESS":
+        text = f"✅ Запланированное задание <b>{job_name}</b> выполнено за {result.get('duration_seconds') or 0:.2f} сек."
+        if result.get("extracted_rows") is not None:
+            text += f"\nИзвлечено строк: {result['extracted_rows']}"
+        if result.get("uploaded_records") is not None:
+            text += f"\nЗагружено записей: {result['uploaded_records']}"
+    elif result["status"] == "SKIPPED":
+        text = f"⏭ Запланированное задание <b>{job_name}</b> пропущено: {result.get('message')}"
+    elif result["status"] == "CANCELLED":
+        text = f"⏹ Запланированное задание <b>{job_name}</b> остановлено: {result.get('message')}"
+    elif result["status"] == "TIMEOUT":
+        text = f"⏱ Запланированное задание <b>{job_name}</b> остановлено: {result.get('message')}"
+    else:
+        text = f"❌ Запланированное задание <b>{job_name}</b> завершилось с ошибкой:\n<pre><code>{result.get('message')}</code></pre>"
+    try:
+        await bot.send_message(chat_id, text, parse_mode='HTML')
+        if file_path and os.path.exists(file_path):
+            await bot.send_document(chat_id, document=FSInputFile(file_path, filename=os.path.basename(file_path)), caption="Файл результата:")
+    except TelegramAPIError as e:
+        logging.error(f"Ошибка отправки результата задания '{job_name}' в чат {chat_id}: {e}")
 
 
 @router.callback_query(F.data == "manage_schedules")
@@ -166,22 +655,24 @@ async def view_schedule_details_handler(callback: CallbackQuery):
         await callback.answer()
         return
 
-    # Получаем последнюю запись истории загрузок для этого задания
-    last_upload = await sqlite_db.get_last_upload_for_scheduled_job(job.get('chat_id'), job.get('action'))
-
-    last_run_info = "Нет данных о последнем запуске."
-    if last_upload:
-        status = last_upload.get('status', 'Неизвестно')
-        timestamp = last_upload.get('timestamp', 'Неизвестно')
-        last_run_info = f"Статус последнего запуска: <b>{status}</b>\nВремя последнего запуска: <b>{timestamp}</b>"
+    last_run_info = format_last_run(job, await sqlite_db.list_schedule_runs(job_id))
 
     # Получаем время следующего запуска из APScheduler
     next_run_time_str = "Неизвестно"
-    if scheduler:
+    interval_info = ""
+    all_jobs = await sqlite_db.list_all_scheduled_jobs()
+    job_names = {j['job_id']: j['name'] for j in all_jobs}
+    if job.get('trigger_type') == AFTER_TRIGGER_TYPE:
+        upstream_names = [job_names.get(upstream_id, f"удалено ({upstream_id})") for upstream_id in upstream_job_ids(job)]
+        next_run_time_str = f"после успешного завершения: {', '.join(upstream_names)}"
+    elif scheduler:
         try:
             aps_job = scheduler.get_job(job.get('job_id', ''))
             if aps_job and aps_job.next_run_time:
                 next_run_time_str = aps_job.next_run_time.strftime('%Y-%m-%d %H:%M:%S %Z')
+                if isinstance(aps_job.trigger, OffsetTrigger):
+                    next_run_time_str += f" (сдвиг +{int(aps_job.trigger.offset.total_seconds())} сек)"
+                interval_info = format_effective_interval(aps_job, job.get('consecutive_failures') or 0)
             elif aps_job and not aps_job.next_run_time:
                 next_run_time_str = "Нет запланированных запусков (возможно, завершено)"
             else:
@@ -191,6 +682,7 @@ async def view_schedule_details_handler(callback: CallbackQuery):
     else:
         next_run_time_str = "Планировщик недоступен"
 
+    timeout_seconds = run_timeout_seconds(job)
     # Формируем текст с деталями задания
     details_text = (
         f"<b>Детали запланированного задания:</b>\n\n"
@@ -200,9 +692,16 @@ async def view_schedule_details_handler(callback: CallbackQuery):
         f"True Tabs: <b>{job.get('tt_config_name')}</b>\n"
         f"Тип триггера: <b>{job.get('trigger_type')}</b>\n"
         f"Аргументы триггера: <code>{job.get('trigger_args_json')}</code>\n\n"
-        f"Следующий запуск: {next_run_time_str}\n\n"
+        f"Следующий запуск: {next_run_time_str}\n"
+        f"{interval_info}"
+        f"При наложении запусков: {OVERRUN_POLICIES[overrun_policy(job)]}\n"
+        f"Пропущенные за время простоя: {format_catchup_policy(job)}\n"
+        f"Ограничение времени запуска: {format_duration(timeout_seconds) if timeout_seconds else 'нет'}\n\n"
         f"{last_run_info}\n"
     )
+    dependents = downstream_jobs(all_jobs, job_id)
+    if dependents:
+        details_text += f"\nСледующие шаги конвейера: {', '.join(j['name'] for j in dependents)}\n"
 
     # Проверяем, есть ли у задания статус паузы (если есть поле is_paused)
     is_paused = job.get('is_paused', False)
@@ -216,6 +715,57 @@ async def view_schedule_details_handler(callback: CallbackQuery):
     await callback.answer()
 
 
+def format_effective_interval(aps_job, consecutive_failures: int) -> str:
+    """Текущий интервал повторяющегося задания: после ошибок подряд он увеличен (apply_backoff)."""
+    now = datetime.now(aps_job.next_run_time.tzinfo)
+    period = trigger_period_seconds(aps_job.trigger, now)
+    if not period:
+        return ""
+    if not consecutive_failures:
+        return f"Интервал: {format_duration(period)}\n"
+    return (f"Текущий интервал: <b>{format_duration(backoff_delay_seconds(period, consecutive_failures))}</b> "
+            f"(обычный {format_duration(period)}, увеличен после ошибок подряд: {consecutive_failures})\n")
+
+
+def format_catchup_policy(job: Dict[str, Any]) -> str:
+    policy = catchup_policy(job)
+    if policy == 'all':
+        return f"выполнить все (не больше {catchup_limit(job)} последних)"
+    return CATCHUP_POLICIES[policy]
+
+
+def _format_time(iso_value: Optional[str]) -> str:
+    return datetime.fromisoformat(iso_value).strftime('%Y-%m-%d %H:%M:%S') if iso_value else "-"
+
+
+def format_last_run(job: Dict[str, Any], runs: List[Dict[str, Any]]) -> str:
+    """Итоги последнего запуска (поля scheduled_jobs) и последние запуски из журнала schedule_runs."""
+    if not job.get('last_run_at') and not runs:
+        return "Нет данных о последнем запуске."
+    lines = []
+    if job.get('last_run_at'):
+        lines.append(
+            f"Статус последнего запуска: <b>{job['last_run_status']}</b>\n"
+            f"Время последнего запуска: <b>{_format_time(job['last_run_at'])}</b> ({job.get('last_run_duration_seconds') or 0:.1f} сек)\n"
+            f"Последний успешный: <b>{_format_time(job.get('last_success_at'))}</b>\n"
+            f"Запусков: {job.get('runs_total') or 0}, с ошибкой: {job.get('runs_failed') or 0}"
+        )
+    if job.get('est_duration_seconds') is not None:
+        estimate = f"Ожидаемый запуск: ~{format_duration(job['est_duration_seconds'])}"
+        if job.get('est_rows') is not None:
+            estimate += f", ~{int(job['est_rows'])} строк"
+        if job.get('est_peak_memory_kb'):
+            estimate += f", до {job['est_peak_memory_kb'] // 1024} МиБ"
+        lines.append(estimate)
+    if runs:
+        lines.append("Последние запуски:")
+        for run in runs:
+            rows = f", строк: {run['rows']}" if run.get('rows') is not None else ""
+            wait = f", ожидание: {run['queue_wait_seconds']:.1f} сек" if run.get('queue_wait_seconds') else ""
+            lines.append(f"<code>{_format_time(run['started_at'])}</code> {run['status']} {run.get('duration_seconds') or 0:.1f} сек{rows}{wait}")
+    return "\n".join(lines)
+
+
 # --- Handlers for Adding a New Scheduled Job (FSM) ---
 
 # Handler for "add_schedule" callback - Starts the FSM (without changes)
@@ -262,6 +812,10 @@ async def start_edit_schedule_handler(callback: CallbackQuery, state: FSMContext
             [InlineKeyboardButton(text="True Tabs", callback_data="edit_field:tt_config")],
             [InlineKeyboardButton(text="Тип триггера", callback_data="edit_field:trigger_type")],
             [InlineKeyboardButton(text="Параметры триггера", callback_data="edit_field:trigger_args")],
+            [InlineKeyboardButton(text="Разброс запуска", callback_data="edit_field:jitter")],
+            [InlineKeyboardButton(text="Ограничение времени", callback_data="edit_field:timeout")],
+            [InlineKeyboardButton(text="Наложение запусков", callback_data="edit_field:overrun")],
+            [InlineKeyboardButton(text="Пропущенные запуски", callback_data="edit_field:catchup")],
             [InlineKeyboardButton(text="Включено/Отключено", callback_data="edit_field:enabled")],
             [InlineKeyboardButton(text="Отмена", callback_data="cancel_edit")]
         ]),
@@ -322,9 +876,54 @@ async def edit_field_selection_handler(callback: CallbackQuery, state: FSMContex
         elif current_trigger_type == 'date':
             await callback.message.edit_text("Введите дату и время в формате `YYYY-MM-DD HH:MM:SS`:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_edit")]]))
             await state.set_state(ScheduleProcess.waiting_date_args)
+        elif current_trigger_type == AFTER_TRIGGER_TYPE:
+            await show_upstream_selection(callback, state, upstream_job_ids(job))
         else:
             await callback.message.edit_text("Неизвестный тип триггера. Отмена.", reply_markup=manage_schedules_menu_keyboard())
             await state.clear()
+    elif field == "jitter":
+        await callback.message.edit_text(
+            "Введите окно разброса запуска в секундах (например, <code>120</code>): задание будет запускаться "
+            "с постоянным сдвигом внутри окна, чтобы не стартовать одновременно с другими.\n"
+            "<code>0</code> - без сдвига, <code>-</code> - общая настройка бота.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_edit")]]),
+            parse_mode='HTML'
+        )
+        await state.set_state(ScheduleProcess.waiting_jitter_seconds)
+    elif field == "timeout":
+        await callback.message.edit_text(
+            "Введите ограничение времени одного запуска в секундах (например, <code>1800</code>): зависший запуск "
+            "будет остановлен и записан в историю со статусом «превышено время».\n"
+            "<code>0</code> - без ограничения, <code>-</code> - общая настройка бота "
+            f"({format_duration(config.RUST_RUN_TIMEOUT_SECONDS) if config.RUST_RUN_TIMEOUT_SECONDS else 'без ограничения'}).",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_edit")]]),
+            parse_mode='HTML'
+        )
+        await state.set_state(ScheduleProcess.waiting_timeout_seconds)
+    elif field == "overrun":
+        builder = InlineKeyboardBuilder()
+        for policy, description in OVERRUN_POLICIES.items():
+            mark = "✅ " if policy == overrun_policy(job) else ""
+            builder.row(InlineKeyboardButton(text=f"{mark}{description}", callback_data=f"set_overrun:{policy}"))
+        builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_edit"))
+        await callback.message.edit_text(
+            "Что делать, если пришло время запуска, а предыдущий запуск задания еще не завершился?",
+            reply_markup=builder.as_markup()
+        )
+        await state.set_state(ScheduleProcess.select_overrun_policy)
+    elif field == "catchup":
+        builder = InlineKeyboardBuilder()
+        for policy, description in CATCHUP_POLICIES.items():
+            mark = "✅ " if policy == catchup_policy(job) else ""
+            builder.row(InlineKeyboardButton(text=f"{mark}{description}", callback_data=f"set_catchup:{policy}"))
+        builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_edit"))
+        await callback.message.edit_text(
+            "Что делать с запусками, пропущенными, пока бот не работал?\n"
+            f"«Пропустить» - выполняется только запуск, опоздавший не больше чем на {format_duration(config.SCHEDULED_MISFIRE_GRACE_SECONDS)}. "
+            f"«Выполнить все» - не больше {catchup_limit(job)} последних, по очереди.",
+            reply_markup=builder.as_markup()
+        )
+        await state.set_state(ScheduleProcess.select_catchup_policy)
     elif field == "enabled":
         # Toggle enabled status
         current_enabled = job.get('enabled', True)
@@ -340,6 +939,110 @@ async def edit_field_selection_handler(callback: CallbackQuery, state: FSMContex
         await state.clear()
     await callback.answer()
 
+# Handler for select_overrun_policy state - Processes the overrun policy
+@router.callback_query(F.data.startswith("set_overrun:"), ScheduleProcess.select_overrun_policy)
+async def process_overrun_policy(callback: CallbackQuery, state: FSMContext):
+    job = (await state.get_data()).get('editing_job')
+    policy = callback.data.split(":")[1]
+    if not job or policy not in OVERRUN_POLICIES:
+        await callback.message.edit_text("Ошибка: данные задания не найдены. Начните заново.", reply_markup=manage_schedules_menu_keyboard())
+        await state.clear()
+        await callback.answer()
+        return
+
+    trigger_args = json.loads(job.get('trigger_args_json'))
+    trigger_args['overrun'] = policy
+    await state.update_data(schedule_trigger_args=trigger_args, schedule_settings_edited=True)
+    await state.set_state(ScheduleProcess.confirm_schedule)
+    await callback.message.edit_text(f"При наложении запусков: {OVERRUN_POLICIES[policy]}. Подтвердите изменения?", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Подтвердить", callback_data="confirm_edit_schedule")],
+        [InlineKeyboardButton(text="Отмена", callback_data="cancel_edit")]
+    ]))
+    await callback.answer()
+
+# Handler for select_catchup_policy state - Processes the catch-up policy
+@router.callback_query(F.data.startswith("set_catchup:"), ScheduleProcess.select_catchup_policy)
+async def process_catchup_policy(callback: CallbackQuery, state: FSMContext):
+    job = (await state.get_data()).get('editing_job')
+    policy = callback.data.split(":")[1]
+    if not job or policy not in CATCHUP_POLICIES:
+        await callback.message.edit_text("Ошибка: данные задания не найдены. Начните заново.", reply_markup=manage_schedules_menu_keyboard())
+        await state.clear()
+        await callback.answer()
+        return
+
+    trigger_args = json.loads(job.get('trigger_args_json'))
+    trigger_args['catchup'] = policy
+    await state.update_data(schedule_trigger_args=trigger_args, schedule_settings_edited=True)
+    await state.set_state(ScheduleProcess.confirm_schedule)
+    await callback.message.edit_text(f"Пропущенные за время простоя: {CATCHUP_POLICIES[policy]}. Подтвердите изменения?", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Подтвердить", callback_data="confirm_edit_schedule")],
+        [InlineKeyboardButton(text="Отмена", callback_data="cancel_edit")]
+    ]))
+    await callback.answer()
+
+# Handler for waiting_jitter_seconds state - Processes the jitter window
+@router.message(ScheduleProcess.waiting_jitter_seconds)
+async def process_jitter_seconds(message: Message, state: FSMContext):
+    job = (await state.get_data()).get('editing_job')
+    if not job:
+        await message.answer("Ошибка: данные задания не найдены. Начните заново.", reply_markup=manage_schedules_menu_keyboard())
+        await state.clear()
+        return
+
+    user_input = message.text.strip()
+    trigger_args = json.loads(job.get('trigger_args_json'))
+    if user_input == '-':
+        trigger_args.pop('jitter_seconds', None)
+    else:
+        try:
+            jitter_seconds = int(user_input)
+            if jitter_seconds < 0:
+                raise ValueError
+        except ValueError:
+            await message.answer("Ожидается целое неотрицательное число секунд или <code>-</code>. Попробуйте снова:", parse_mode='HTML')
+            return
+        trigger_args['jitter_seconds'] = jitter_seconds
+
+    await state.update_data(schedule_trigger_args=trigger_args, schedule_settings_edited=True)
+    await state.set_state(ScheduleProcess.confirm_schedule)
+    jitter_text = f"{trigger_args['jitter_seconds']} сек" if 'jitter_seconds' in trigger_args else "общая настройка бота"
+    await message.answer(f"Окно разброса запуска: {jitter_text}. Подтвердите изменения?", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Подтвердить", callback_data="confirm_edit_schedule")],
+        [InlineKeyboardButton(text="Отмена", callback_data="cancel_edit")]
+    ]))
+
+# Handler for waiting_timeout_seconds state - Processes the run timeout
+@router.message(ScheduleProcess.waiting_timeout_seconds)
+async def process_timeout_seconds(message: Message, state: FSMContext):
+    job = (await state.get_data()).get('editing_job')
+    if not job:
+        await message.answer("Ошибка: данные задания не найдены. Начните заново.", reply_markup=manage_schedules_menu_keyboard())
+        await state.clear()
+        return
+
+    user_input = message.text.strip()
+    trigger_args = json.loads(job.get('trigger_args_json'))
+    if user_input == '-':
+        trigger_args.pop('timeout_seconds', None)
+    else:
+        try:
+            timeout_seconds = int(user_input)
+            if timeout_seconds < 0:
+                raise ValueError
+        except ValueError:
+            await message.answer("Ожидается целое неотрицательное число секунд или <code>-</code>. Попробуйте снова:", parse_mode='HTML')
+            return
+        trigger_args['timeout_seconds'] = timeout_seconds
+
+    await state.update_data(schedule_trigger_args=trigger_args, schedule_settings_edited=True)
+    await state.set_state(ScheduleProcess.confirm_schedule)
+    timeout_text = f"{trigger_args['timeout_seconds']} сек" if 'timeout_seconds' in trigger_args else "общая настройка бота"
+    await message.answer(f"Ограничение времени запуска: {timeout_text}. Подтвердите изменения?", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Подтвердить", callback_data="confirm_edit_schedule")],
+        [InlineKeyboardButton(text="Отмена", callback_data="cancel_edit")]
+    ]))
+
 # Handler for confirming edited schedule
 @router.callback_query(F.data == "confirm_edit_schedule", StateFilter(ScheduleProcess.confirm_schedule))
 async def confirm_edit_schedule_handler(callback: CallbackQuery, state: FSMContext):
@@ -357,7 +1060,14 @@ async def confirm_edit_schedule_handler(callback: CallbackQuery, state: FSMConte
     updated_source_config_name = data.get('schedule_source_config_name', job.get('source_config_name'))
     updated_tt_config_name = data.get('schedule_tt_config_name', job.get('tt_config_name'))
     updated_trigger_type = data.get('schedule_trigger_type', job.get('trigger_type'))
-    updated_trigger_args = data.get('schedule_trigger_args', json.loads(job.get('trigger_args_json')))
+    current_trigger_args = json.loads(job.get('trigger_args_json'))
+    updated_trigger_args = data.get('schedule_trigger_args', current_trigger_args)
+    # Окно разброса, политики наложения и пропущенных запусков и ограничение времени сохраняются при повторном вводе параметров триггера.
+    # Экраны этих настроек сами передают полный набор параметров: удаленный ключ (ввод "-") не восстанавливается
+    if not data.get('schedule_settings_edited'):
+        for key in ('jitter_seconds', 'overrun', 'catchup', 'catchup_limit', 'timeout_seconds'):
+            if key in current_trigger_args and (key in ('overrun', 'timeout_seconds') or updated_trigger_type != AFTER_TRIGGER_TYPE):
+                updated_trigger_args.setdefault(key, current_trigger_args[key])
     updated_enabled = data.get('schedule_enabled', job.get('enabled', True))
 
     # Validate updated name uniqueness if changed
@@ -394,40 +1104,9 @@ async def confirm_edit_schedule_handler(callback: CallbackQuery, state: FSMConte
     except Exception:
         pass
 
-    # Create new trigger object
-    trigger = None
-    try:
-        if updated_trigger_type == 'interval':
-            trigger = IntervalTrigger(**updated_trigger_args)
-        elif updated_trigger_type == 'cron':
-            cron_expression = updated_trigger_args.get('cron_expression')
-            trigger = CronTrigger.from_crontab(cron_expression)
-        elif updated_trigger_type == 'date':
-            run_date_str = updated_trigger_args.get('run_date')
-            run_date = datetime.fromisoformat(run_date_str)
-            trigger = DateTrigger(run_date=run_date)
-    except Exception as e:
-        await callback.message.edit_text(f"Ошибка при создании триггера: {e}", reply_markup=manage_schedules_menu_keyboard())
-        await state.clear()
-        await callback.answer()
-        return
-
-    # Add updated job to scheduler
+    # Add updated job to scheduler (выключенное задание просто не добавляется)
     try:
-        scheduler.add_job(
-            scheduled_task_executor,
-            trigger=trigger,
-            id=job.get('job_id'),
-            name=updated_name,
-            kwargs={
-                'bot': callback.bot,
-                'chat_id': job.get('chat_id'),
-                'source_config_name': updated_source_config_name,
-                'tt_config_name': updated_tt_config_name,
-                'action': updated_action,
-                'job_name': updated_name
-            }
-        )
+        add_job_to_scheduler(await sqlite_db.get_scheduled_job(job.get('job_id')))
     except Exception as e:
         await callback.message.edit_text(f"Ошибка при добавлении обновленного задания в планировщик: {e}", reply_markup=manage_schedules_menu_keyboard())
         await state.clear()
@@ -448,6 +1127,17 @@ async def delete_schedule_handler(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
+    dependents = downstream_jobs(await sqlite_db.list_all_scheduled_jobs(), job_id)
+    if dependents:
+        await callback.message.edit_text(
+            f"❌ Задание <b>{job.get('name')}</b> нельзя удалить: после него запускаются "
+            f"{', '.join(j['name'] for j in dependents)}. Сначала измените или удалите эти задания.",
+            reply_markup=manage_schedules_menu_keyboard(),
+            parse_mode='HTML'
+        )
+        await callback.answer()
+        return
+
     await state.update_data(deleting_job=job)
     await callback.message.edit_text(
         f"Вы уверены, что хотите удалить задание: <b>{job.get('name')}</b>?",
@@ -660,6 +1350,10 @@ async def select_schedule_trigger_type_handler(callback: CallbackQuery, state: F
             , parse_mode='HTML'
         )
 
+    elif trigger_type == AFTER_TRIGGER_TYPE:
+        await show_upstream_selection(callback, state, [])
+        return
+
     else:
         error_msg = f"Неизвестный тип триггера: {trigger_type}"
         print(error_msg, file=sys.stderr)
@@ -668,6 +1362,96 @@ async def select_schedule_trigger_type_handler(callback: CallbackQuery, state: F
 
     await callback.answer()
 
+# --- Выбор предшественников для заданий, запускаемых после других заданий (конвейер) ---
+
+def select_upstream_keyboard(jobs: List[Dict[str, Any]], selected_ids: List[str]) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for job in jobs:
+        mark = "✅ " if job['job_id'] in selected_ids else ""
+        builder.row(InlineKeyboardButton(text=f"{mark}{job['name']}", callback_data=f"schedule_upstream:{job['job_id']}"))
+    builder.row(InlineKeyboardButton(text="Готово", callback_data="schedule_upstream_done"))
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
+    return builder.as_markup()
+
+async def _upstream_candidates(state: FSMContext) -> List[Dict[str, Any]]:
+    """Задания чата, после которых можно запускать создаваемое (редактируемое) задание."""
+    data = await state.get_data()
+    editing_job = data.get('editing_job')
+    chat_id = editing_job['chat_id'] if editing_job else data.get('chat_id')
+    editing_job_id = editing_job['job_id'] if editing_job else None
+    return [job for job in await sqlite_db.list_scheduled_jobs(chat_id) if job['job_id'] != editing_job_id]
+
+async def show_upstream_selection(callback: CallbackQuery, state: FSMContext, selected_ids: List[str]):
+    candidates = await _upstream_candidates(state)
+    if not candidates:
+        await callback.message.edit_text("🚫 Нет других заданий, после которых можно запускать это задание.", reply_markup=manage_schedules_menu_keyboard())
+        await state.clear()
+        await callback.answer()
+        return
+    await state.update_data(schedule_upstream_ids=selected_ids)
+    await state.set_state(ScheduleProcess.select_schedule_upstream)
+    await callback.message.edit_text(
+        "Выберите задания, после успешного завершения которых запускать это задание "
+        "(если выбрано несколько - после завершения всех).\n"
+        "Файл результата предыдущего шага передается этому заданию вместо источника. "
+        "Если предыдущий шаг завершится с ошибкой, задание будет пропущено.",
+        reply_markup=select_upstream_keyboard(candidates, selected_ids)
+    )
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("schedule_upstream:"), ScheduleProcess.select_schedule_upstream)
+async def toggle_schedule_upstream_handler(callback: CallbackQuery, state: FSMContext):
+    upstream_id = callback.data.split(":", 1)[1]
+    selected_ids = list((await state.get_data()).get('schedule_upstream_ids') or [])
+    if upstream_id in selected_ids:
+        selected_ids.remove(upstream_id)
+    else:
+        selected_ids.append(upstream_id)
+    await state.update_data(schedule_upstream_ids=selected_ids)
+    await callback.message.edit_reply_markup(reply_markup=select_upstream_keyboard(await _upstream_candidates(state), selected_ids))
+    await callback.answer()
+
+@router.callback_query(F.data == "schedule_upstream_done", ScheduleProcess.select_schedule_upstream)
+async def schedule_upstream_done_handler(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    selected_ids = data.get('schedule_upstream_ids') or []
+    if not selected_ids:
+        await callback.answer("Выберите хотя бы одно задание.", show_alert=True)
+        return
+
+    all_jobs = await sqlite_db.list_all_scheduled_jobs()
+    job_names = {job['job_id']: job['name'] for job in all_jobs}
+    editing_job = data.get('editing_job')
+    if editing_job:
+        # Новое задание еще ни от кого не зависит, цикл может появиться только при редактировании
+        cycle = find_dependency_cycle(all_jobs, editing_job['job_id'], selected_ids)
+        if cycle:
+            await callback.answer(f"Получается цикл зависимостей: {' ← '.join(job_names.get(job_id, job_id) for job_id in cycle)}", show_alert=True)
+            return
+
+    await state.update_data(schedule_trigger_type=AFTER_TRIGGER_TYPE, schedule_trigger_args={'job_ids': selected_ids})
+    await state.set_state(ScheduleProcess.confirm_schedule)
+    upstream_text = ", ".join(job_names.get(job_id, job_id) for job_id in selected_ids)
+
+    if editing_job:
+        await callback.message.edit_text(f"Задание будет запускаться после: <b>{upstream_text}</b>. Подтвердите изменения?", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Подтвердить", callback_data="confirm_edit_schedule")],
+            [InlineKeyboardButton(text="Отмена", callback_data="cancel_edit")]
+        ]), parse_mode='HTML')
+    else:
+        confirm_text = (
+            f"<b>Подтверждение создания запланированного задания:</b>\n\n"
+            f"Имя: <b>{data.get('schedule_name', 'Без имени')}</b>\n"
+            f"Действие: <b>{data.get('schedule_action', 'Без действия')}</b>\n"
+            f"Источник: <b>{data.get('schedule_source_config_name', 'Без источника')}</b>\n"
+            f"True Tabs: <b>{data.get('schedule_tt_config_name', 'Без TT')}</b>\n"
+            f"Тип расписания: <b>После других заданий</b>\n"
+            f"Запускается после: <b>{upstream_text}</b>\n\n"
+            f"Все верно? Нажмите 'Подтвердить и создать' или 'Отмена'."
+        )
+        await callback.message.edit_text(confirm_text, reply_markup=confirm_schedule_keyboard(), parse_mode='HTML')
+    await callback.answer()
+
 # Handler for waiting_interval_args state - Processes interval arguments
 @router.message(ScheduleProcess.waiting_interval_args)
 async def process_interval_args(message: Message, state: FSMContext):
@@ -846,8 +1630,6 @@ async def process_date_args(message: Message, state: FSMContext):
 # Handler for confirm_schedule state - Processes the confirmation
 @router.callback_query(F.data == "confirm_create_schedule", ScheduleProcess.confirm_schedule)
 async def confirm_schedule_handler(callback: CallbackQuery, state: FSMContext):
-    global scheduler  # moved global declaration to be the first statement in the function
-
     """
     Handles the confirmation to create the scheduled job.
     Saves to DB and adds to APScheduler.
@@ -885,28 +1667,10 @@ async def confirm_schedule_handler(callback: CallbackQuery, state: FSMContext):
     # Генерируем уникальный ID задания для APScheduler и базы данных
     job_id = str(uuid.uuid4())
 
-    # Создаем объект триггера APScheduler из собранных данных
-    trigger = None
+    # Проверяем, что из собранных данных получается триггер APScheduler (задания 'after' запускаются без триггера)
     try:
-        if trigger_type == 'interval':
-             # Создаем IntervalTrigger из словаря аргументов
-             trigger = IntervalTrigger(**trigger_args)
-        elif trigger_type == 'cron':
-             # Аргументы для CronTrigger будут строкой (cron expression)
-             cron_expression = trigger_args.get('cron_expression') # Предполагаем такой ключ
-             if not cron_expression: raise ValueError("Cron expression is missing.")
-             trigger = CronTrigger.from_crontab(cron_expression) # Или CronTrigger(**args)
-        elif trigger_type == 'date':
-             # Аргументы для DateTrigger будут дата и время (например, строка в ISO формате)
-             run_date_str = trigger_args.get('run_date') # Предполагаем такой ключ
-             if not run_date_str: raise ValueError("Run date is missing.")
-             run_date = datetime.fromisoformat(run_date_str) # Парсим строку даты
-             trigger = DateTrigger(run_date=run_date)
-
-        if trigger is None:
-             # Если тип триггера неизвестен или логика создания отсутствует
-             raise ValueError(f"Неподдерживаемый или неполностью реализованный тип триггера: {trigger_type}")
-
+        if trigger_type != AFTER_TRIGGER_TYPE:
+            build_trigger(trigger_type, trigger_args)
     except Exception as e:
         # Обработка ошибок при создании объекта триггера (например, неверные аргументы)
         error_msg = f"Ошибка при создании расписания для задания '{job_name}': {e}. Задание не создано."
@@ -942,21 +1706,7 @@ async def confirm_schedule_handler(callback: CallbackQuery, state: FSMContext):
 
     # Добавляем запланированное задание в экземпляр планировщика APScheduler
     try:
-        scheduler.add_job(
-            scheduled_task_executor, # Функция, которую вызовет планировщик при срабатывании триггера
-            trigger=trigger, # Созданный объект триггера
-            id=job_id, # Используем тот же уникальный ID задания, что и в БД
-            name=job_name, # Имя задания
-            kwargs={ # Аргументы, которые будут переданы в scheduled_task_executor при вызове
-                'bot': callback.bot, # Передаем экземпляр бота из callback_data!
-                'chat_id': chat_id,
-                'source_config_name': source_config_name,
-                'tt_config_name': tt_config_name,
-                'action': action,
-                'job_name': job_name # Передаем имя задания для удобства в scheduled_task_executor
-            },
-            # replace_existing=False по умолчанию, что подходит для добавления нового уникального задания
-        )
+        add_job_to_scheduler(await sqlite_db.get_scheduled_job(job_id), replace_existing=False)
         logging.info(f"Запланированное задание '{job_name}' (ID: {job_id}) успешно добавлено в планировщик.")
 
         # Отправляем пользователю сообщение об успешном создании задания
@@ -1,18 +1,21 @@
 import asyncio
 import logging
+import os
 import sys
-from typing import Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 from aiogram import Router, F
 from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext # Импортируем для очистки состояния при отмене
 import json
-import io
-import csv
-import httpx
 from aiogram.types import CallbackQuery, FSInputFile, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram_bot.keyboards.inline_with_export_update import main_menu_keyboard
-from telegram_bot.database import get_tt_config
-from telegram_bot.utils.encryption import decrypt_data
+from telegram_bot.database import sqlite_db
+from telegram_bot.database.sqlite_db import get_default_tt_config
+from telegram_bot.utils.truetabs_api import build_export_params, get_truetabs_client, iter_datasheet_records
+from telegram_bot.utils.export_writers import export_records
+from telegram_bot.handlers.export_settings_handlers import format_export_settings
+from telegram_bot.utils.truetabs_mirror import format_mirror_freshness, get_mirrored_records, sync_mirror
+from telegram_bot.config import TEMP_FILES_DIR
 
 
 from ..keyboards.inline import main_menu_keyboard # Импортируем клавиатуру главного меню
@@ -93,41 +96,99 @@ async def handle_unexpected_message(message: Message, state: FSMContext):
         # Если состояния нет, это просто обычное сообщение, которое бот не понимает
         await message.answer("Извините, я не понял вашу команду. Используйте меню.")
 
-@router.callback_query(F.data == "export_data")
-async def export_data_handler(callback: CallbackQuery, state: FSMContext):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+def export_menu_keyboard(mirror_enabled: bool) -> InlineKeyboardMarkup:
+    mirror_row = [
+        InlineKeyboardButton(text="🔄 Синхронизировать копию", callback_data="export_mirror:sync"),
+        InlineKeyboardButton(text="🚫 Отключить копию", callback_data="export_mirror:off"),
+    ] if mirror_enabled else [
+        InlineKeyboardButton(text="💾 Включить локальную копию", callback_data="export_mirror:on"),
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="Excel (.xlsx)", callback_data="export_format:xlsx"),
             InlineKeyboardButton(text="CSV (.csv)", callback_data="export_format:csv"),
         ],
+        mirror_row,
+        [
+            InlineKeyboardButton(text="⚙️ Поля и фильтр", callback_data="export_settings"),
+        ],
         [
             InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")
         ]
     ])
-    await callback.message.edit_text("Выберите формат для выгрузки данных:", reply_markup=keyboard)
+
+async def show_export_menu(callback: CallbackQuery, notice: str = ""):
+    tt_config = await get_default_tt_config()
+    mirror_state = await sqlite_db.get_mirror_state(tt_config['upload_datasheet_id']) if tt_config else None
+    text = (
+        f"{notice}Выберите формат для выгрузки данных:\n\n"
+        f"{format_export_settings(tt_config)}\n"
+        f"<i>{format_mirror_freshness(mirror_state)}</i>"
+    )
+    await callback.message.edit_text(text, reply_markup=export_menu_keyboard(mirror_state is not None), parse_mode='HTML')
+
+@router.callback_query(F.data == "export_data")
+async def export_data_handler(callback: CallbackQuery, state: FSMContext):
+    await show_export_menu(callback)
     await state.set_state("export_select_format")
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("export_mirror:"))
+async def export_mirror_handler(callback: CallbackQuery):
+    """Включение/отключение/синхронизация локальной копии таблицы True Tabs по умолчанию."""
+    action = callback.data.split(":")[1]
+    tt_config = await get_default_tt_config()
+    if not tt_config:
+        await callback.answer("Конфигурация True Tabs по умолчанию не найдена.", show_alert=True)
+        return
+    datasheet_id = tt_config['upload_datasheet_id']
+
+    notice = ""
+    if action == "off":
+        await sqlite_db.disable_mirror(datasheet_id)
+        notice = "Локальная копия отключена.\n\n"
+    else:
+        if action == "on":
+            await sqlite_db.enable_mirror(datasheet_id, tt_config['name'])
+        await callback.answer("Синхронизация...")
+        try:
+            result = await sync_mirror(tt_config['upload_api_token'], datasheet_id)
+            mode = "полная" if result['mode'] == 'full' else "инкрементальная"
+            notice = f"Синхронизация ({mode}): получено записей {result['fetched']}.\n\n"
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации локальной копии таблицы {datasheet_id}: {e}", exc_info=True)
+            notice = "⚠️ Ошибка синхронизации локальной копии.\n\n"
+
+    await show_export_menu(callback, notice)
+    if action == "off":
+        await callback.answer()
 
 @router.callback_query(F.data.startswith("export_format:"))
 async def export_format_handler(callback: CallbackQuery, state: FSMContext):
-    format_selected = callback.data.split(":")[1]
-    data = await fetch_truetabs_data(callback.from_user.id)
-    if data is None:
+    format_selected = "csv" if callback.data.split(":")[1] == "csv" else "xlsx"
+    records = await fetch_truetabs_data(callback.from_user.id)
+    if records is None:
         await callback.message.answer("Ошибка при получении данных из True Tabs.")
         await callback.answer()
         return
 
-    if format_selected == "csv":
-        file_bytes = convert_to_csv_bytes(data)
-        file_name = "exported_data.csv"
-    else:
-        file_bytes = convert_to_excel_bytes(data)
-        file_name = "exported_data.xlsx"
+    await callback.answer()
+    file_path = None
+    try:
+        # Записи пишутся в файл по мере загрузки страниц, целиком в памяти не держатся
+        file_path, record_count = await export_records(records, format_selected, TEMP_FILES_DIR)
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке данных True Tabs пользователем {callback.from_user.id}: {e}", exc_info=True)
+        await callback.message.answer("Ошибка при получении данных из True Tabs.")
+        return
 
-    file = FSInputFile(io.BytesIO(file_bytes), filename=file_name)
-    await callback.message.answer_document(file)
-    await callback.message.edit_text("Выгрузка завершена.", reply_markup=main_menu_keyboard())
+    try:
+        file = FSInputFile(file_path, filename=f"exported_data.{format_selected}")
+        await callback.message.answer_document(file, caption=f"Записей: {record_count}")
+        await callback.message.edit_text("Выгрузка завершена.", reply_markup=main_menu_keyboard())
+    finally:
+        os.remove(file_path)
     await state.clear()
-    await callback.answer()
 
 @router.callback_query(F.data == "update_data")
 async def update_data_handler(callback: CallbackQuery):
@@ -139,76 +200,53 @@ async def update_data_handler(callback: CallbackQuery):
     await callback.message.edit_text("Основное меню:", reply_markup=main_menu_keyboard())
     await callback.answer()
 
-async def fetch_truetabs_data(user_id: int):
-    tt_config = await get_tt_config(user_id)
+async def fetch_truetabs_data(user_id: int) -> Optional[AsyncIterator[Dict[str, Any]]]:
+    """
+    Возвращает асинхронный итератор по всем записям таблицы True Tabs или None, если конфигурация не найдена.
+    Если для таблицы включена локальная копия, записи читаются из нее (с досинхронизацией устаревшей копии),
+    иначе страницы запрашиваются из API параллельно. Ошибки API возникают при итерации.
+    Используется конфигурация True Tabs по умолчанию: конфигурации не привязаны к пользователям.
+    """
+    tt_config = await get_default_tt_config()
     if not tt_config:
+        logger.warning(f"Выгрузка для пользователя {user_id}: конфигурация True Tabs по умолчанию не найдена.")
         return None
-    api_token = decrypt_data(tt_config['api_token'])
-    datasheet_id = tt_config['datasheet_id']
-
-    url = f"https://true.tabs.sale/fusion/v1/datasheets/{datasheet_id}/records?viewId=viwyshvXsylyv&fieldKey=name"
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-    }
-    async with httpx.AsyncClient() as client:
+    # get_tt_config уже возвращает расшифрованный токен
+    api_token = tt_config['upload_api_token']
+    datasheet_id = tt_config['upload_datasheet_id']
+
+    params = build_export_params(tt_config)
+
+    # Локальная копия хранит все записи целиком: фильтр и представление вычисляет только True Tabs,
+    # поэтому с ними выгрузка идет напрямую из API; выбор полей применяется к копии локально
+    if 'filterByFormula' not in params and 'viewId' not in params:
         try:
-            response = await client.get(url, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except Exception:
-            return None
-
-def convert_to_csv_bytes(data):
-    output = io.StringIO()
-    writer = csv.writer(output)
-    records = data.get('records', [])
-    if not records:
-        return b""
-    headers = records[0]['fields'].keys()
-    writer.writerow(headers)
-    for record in records:
-        writer.writerow([record['fields'].get(h, "") for h in headers])
-    return output.getvalue().encode('utf-8')
-
-def convert_to_excel_bytes(data):
-    import openpyxl
-    from openpyxl.utils import get_column_letter
-
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    records = data.get('records', [])
-    if not records:
-        return b""
-    headers = list(records[0]['fields'].keys())
-    ws.append(headers)
-    for record in records:
-        ws.append([record['fields'].get(h, "") for h in headers])
-    for i, _ in enumerate(headers, 1):
-        ws.column_dimensions[get_column_letter(i)].width = 20
-    output = io.BytesIO()
-    wb.save(output)
-    return output.getvalue()
+            mirrored = await get_mirrored_records(api_token, datasheet_id)
+        except Exception as e:
+            # Копия не обновилась - выгружаем напрямую из True Tabs
+            logger.error(f"Ошибка синхронизации локальной копии таблицы {datasheet_id}: {e}", exc_info=True)
+            mirrored = None
+        if mirrored is not None:
+            return project_records(mirrored, tt_config['export_fields']) if tt_config.get('export_fields') else mirrored
+    return iter_datasheet_records(api_token, datasheet_id, params=params)
+
+async def project_records(records: AsyncIterator[Dict[str, Any]], fields: List[str]) -> AsyncIterator[Dict[str, Any]]:
+    """Оставляет в записях только выбранные поля (в порядке выбора)."""
+    async for record in records:
+        record_fields = record.get('fields', {})
+        yield {**record, 'fields': {name: record_fields[name] for name in fields if name in record_fields}}
 
 async def send_update_to_truetabs(user_id: int):
-    tt_config = await get_tt_config(user_id)
+    tt_config = await get_default_tt_config()
     if not tt_config:
         return False
-    api_token = decrypt_data(tt_config['api_token'])
-    datasheet_id = tt_config['datasheet_id']
-
-    url = f"https://true.tabs.sale/fusion/v1/datasheets/{datasheet_id}/records?viewId=viwyshvXsylyv&fieldKey=name"
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "records": [],
-        "fieldKey": "name"
-    }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.patch(url, headers=headers, json=payload)
-            response.raise_for_status()
-            return True
-        except Exception:
-            return False
+    # get_tt_config уже возвращает расшифрованный токен
+    api_token = tt_config['upload_api_token']
+    datasheet_id = tt_config['upload_datasheet_id']
+
+    try:
+        await get_truetabs_client().update_records(api_token, datasheet_id, records=[])
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении данных True Tabs (datasheet {datasheet_id}) для пользователя {user_id}: {e}", exc_info=True)
+        return False
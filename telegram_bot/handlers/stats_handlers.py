@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.types import Message
+
+from .. import config
+from .weather_handlers import weather_cache
+from ..utils.geocoding import geocode_lru
+from ..utils.offload import offload_stats
+from ..utils import retention
+from ..database.sqlite_db import catalog_stats, get_schedule_failure_stats, list_all_scheduled_jobs
+from ..utils.scheduling import format_start_histogram, start_histogram
+from ..utils.leases import format_lease_stats
+from ..utils.admission import format_admission_stats, run_admission
+from ..utils.rust_executor import format_run_stats
+
+router = Router()
+
+
+def format_cache_stats(stats: dict) -> str:
+    return (
+        f"Кэш <b>{stats['name']}</b>: записей {stats['entries']}, "
+        f"попаданий {stats['hits']}, промахов {stats['misses']} "
+        f"(из них объединено {stats['coalesced']}), "
+        f"hit ratio {stats['hit_ratio']:.1%}"
+    )
+
+
+def format_catalog_stats(stats: dict) -> str:
+    return (
+        f"Каталог <b>{stats['name']}</b>: записей {stats['entries']}, "
+        f"загрузок из БД {stats['loads']}, чтений из памяти {stats['hits']}, расшифровок {stats['decryptions']}, "
+        f"изменений другими экземплярами {stats['external_changes']}"
+    )
+
+
+def format_offload_stats(stats: dict) -> str:
+    return (
+        f"Пул <b>{stats['name']}</b>: в очереди/в работе {stats['pending']} (макс. {stats['peak_pending']}), "
+        f"выполнено {stats['completed']}, ошибок {stats['failed']}, "
+        f"ожидание в среднем {stats['avg_wait']:.3f} с, "
+        f"выполнение в среднем {stats['avg_run']:.3f} с (макс. {stats['max_run']:.3f} с)"
+    )
+
+
+async def format_schedule_health(max_rows: int = 5) -> str:
+    """Доля ошибок запусков за сутки (журнал schedule_runs) и задания, нарушившие SLA (итоги в scheduled_jobs)."""
+    jobs = {job['job_id']: job for job in await list_all_scheduled_jobs()}
+    lines = []
+    failing = [row for row in await get_schedule_failure_stats((datetime.now() - timedelta(days=1)).isoformat()) if row['failed']]
+    if failing:
+        lines.append("Ошибки запусков за сутки:")
+        for row in failing[:max_rows]:
+            name = jobs[row['job_id']]['name'] if row['job_id'] in jobs else row['job_id']
+            lines.append(f"• {name}: {row['failed']} из {row['runs']} ({row['failed'] / row['runs']:.0%})")
+    else:
+        lines.append("Ошибок запусков за сутки нет.")
+
+    if config.SCHEDULE_SLA_HOURS:
+        deadline = (datetime.now() - timedelta(hours=config.SCHEDULE_SLA_HOURS)).isoformat()
+        # Задание, которое еще ни разу не выполнилось успешно, отсчитывается от создания
+        overdue = [job for job in jobs.values() if job['enabled'] and (job.get('last_success_at') or job['created_at']) < deadline]
+        if overdue:
+            lines.append(f"Без успешного запуска дольше {config.SCHEDULE_SLA_HOURS} ч: " + ", ".join(job['name'] for job in overdue[:max_rows * 2]))
+    return "\n".join(lines)
+
+
+# Хэндлер на команду /stats - служебная статистика бота
+@router.message(Command("stats"))
+async def stats_command_handler(message: Message):
+    """Показывает служебные метрики (кэши и т.п.). Доступно только ADMIN_USER_IDS, если список задан."""
+    if config.ADMIN_USER_IDS and message.from_user.id not in config.ADMIN_USER_IDS:
+        await message.answer("Команда недоступна.")
+        return
+
+    lines = ["📈 <b>Статистика бота</b>\n"]
+    lines.append(format_cache_stats(weather_cache.stats()))
+    lines.append(format_cache_stats(geocode_lru.stats()))
+    lines.extend(format_catalog_stats(stats) for stats in catalog_stats())
+    lines.extend(format_offload_stats(stats) for stats in offload_stats())
+    lines.append(format_start_histogram(start_histogram))
+    lines.append(format_lease_stats())
+    lines.append(format_admission_stats(run_admission.stats()))
+    lines.append(format_run_stats())
+    lines.append(await format_schedule_health())
+    lines.append(f"Очистка истории: {retention.format_retention_report(retention.last_retention_report)}")
+
+    await message.answer("\n".join(lines), parse_mode='HTML')
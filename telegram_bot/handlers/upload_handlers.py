@@ -22,7 +22,6 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import StateFilter, Command # Импортируем Command фильтр для команды /cancel
 import asyncio
-from signal import SIGTERM
 
 from telegram_bot.keyboards import (
     main_menu_keyboard,
@@ -32,7 +31,9 @@ from telegram_bot.keyboards import (
     select_config_keyboard,
     operation_in_progress_keyboard # Импортируем клавиатуру "Операция в процессе"
 )
-from telegram_bot.utils.rust_executor import execute_rust_command # Убедитесь, что этот модуль существует
+from telegram_bot.utils.rust_executor import execute_rust_command, runs_for_chat, terminate_process_group, terminate_run
+from telegram_bot.utils.rust_args import build_rust_args, RustArgsError
+from telegram_bot.utils.offload import loads_json, run_in_thread
 from telegram_bot.database import sqlite_db # Убедитесь, что этот модуль существует и содержит add_upload_record
 from telegram_bot import config # Убедитесь, что этот модуль существует и содержит TEMP_FILES_DIR
 
@@ -103,20 +104,13 @@ class UploadProcess(StatesGroup):
     operation_in_progress = State()
 
 
-# Глобальный словарь для отслеживания запущенных процессов Rust по chat_id
-running_processes = {}
+# Запущенные процессы Rust регистрируются по ID запуска в utils.rust_executor.running_processes
 
 # Функция для корректного завершения процесса Rust
 async def terminate_process(chat_id: int):
-    process = running_processes.get(chat_id)
-    if process and process.returncode is None:
-        logger.info(f"Отправка SIGTERM процессу Rust для chat {chat_id} (PID {process.pid})")
-        process.send_signal(SIGTERM)
-        await asyncio.sleep(1)
-        if process.returncode is None:
-            logger.info(f"Принудительное завершение процесса Rust для chat {chat_id} (PID {process.pid})")
-            process.kill()
-        del running_processes[chat_id]
+    """Останавливает запущенные из чата операции (SIGTERM группе процессов, затем SIGKILL); запуски по расписанию не трогает."""
+    for run_id in runs_for_chat(chat_id, origin='upload'):
+        await terminate_run(run_id, 'cancel')
 
 
 # --- Вспомогательные данные и функции ---
@@ -898,7 +892,7 @@ async def process_uploaded_file(message: Message, state: FSMContext, bot: Bot):
         logger.error(f"Telegram API error downloading file: {e}", exc_info=True)
         # Попытка очистить временную директорию, если она была создана
         if temp_dir and os.path.exists(temp_dir):
-             try: shutil.rmtree(temp_dir)
+             try: await run_in_thread(shutil.rmtree, temp_dir)
              except Exception as cleanup_e: logger.error(f"Ошибка очистки temp dir {temp_dir} после ошибки скачивания: {cleanup_e}")
 
         await message.answer("Произошла ошибка при скачивании файла из Telegram. Попробуйте еще раз.", reply_markup=cancel_kb)
@@ -908,7 +902,7 @@ async def process_uploaded_file(message: Message, state: FSMContext, bot: Bot):
         logger.error(f"Error processing uploaded file: {e}", exc_info=True)
         # Попытка очистить временную директорию
         if temp_dir and os.path.exists(temp_dir):
-             try: shutil.rmtree(temp_dir)
+             try: await run_in_thread(shutil.rmtree, temp_dir)
              except Exception as cleanup_e: logger.error(f"Ошибка очистки temp dir {temp_dir} после внутренней ошибки: {cleanup_e}")
 
         await message.answer("Произошла внутренняя ошибка при обработке файла.", reply_markup=cancel_kb)
@@ -1221,11 +1215,11 @@ def build_confirmation_message(source_type: str, source_params: Dict[str, Any],
               # Скрываем чувствительные данные (пароли, токены)
               if key in ['source_pass', 'upload_api_token']:
                   confirm_text += f"  {friendly_key.capitalize()}: <code>***</code>\n"
-          # Специальная обработка для пути к файлу (CSV)
-          elif key == 'source_url' and source_type == 'csv':
-               # Получаем имя файла из пути для более короткого отображения
-               file_name = Path(value).name if isinstance(value, str) else value
-               confirm_text += f"  {get_friendly_param_name('source_url_file').capitalize()}: <code>{file_name}</code>\n"
+              # Специальная обработка для пути к файлу (CSV)
+              elif key == 'source_url' and source_type == 'csv':
+                  # Получаем имя файла из пути для более короткого отображения
+                  file_name = Path(value).name if isinstance(value, str) else value
+                  confirm_text += f"  {get_friendly_param_name('source_url_file').capitalize()}: <code>{file_name}</code>\n"
               # Специальная обработка для JSON (запросов, сопоставления полей)
               elif key in ['es_query', 'upload_field_map_json'] and isinstance(value, (str, dict)):
                   try:
@@ -1302,106 +1296,19 @@ async def handle_confirm_upload(callback: CallbackQuery, state: FSMContext, bot:
          output_filepath = Path(config.TEMP_FILES_DIR) / output_filename
 
 
-    # --- Формируем аргументы для Rust утилиты ---
-    # Этот блок должен совпадать с логикой формирования аргументов в scheduled_handlers.py
-    # Лучше вынести эту логику в отдельную функцию в utils или общем модуле
-    rust_args = []
-    rust_args.append("--action")
-    rust_args.append(rust_action) # Действие для Rust
-
-    rust_args.append("--source")
-    rust_args.append(source_type) # Тип источника
-
-    # Маппинг ключей параметров бота на аргументы Rust
-    # Этот маппинг должен быть консистентным с Rust Args и Scheduled Handlers
-    rust_arg_map = {
-         'source_url': '--connection',
-         'source_user': '--user', 'source_pass': '--pass',
-         'source_query': '--query',
-         'db_name': '--db-name', 'collection_name': '--collection', # Для MongoDB
-         'key_pattern': '--key-pattern', # Для Redis
-         'org': '--org', 'bucket': '--bucket', 'index': '--index', # Для Elasticsearch (или других)
-         'es_query': '--query', # Для Elasticsearch
-         'redis_pattern': '--key-pattern', # Для Redis
-         'mongo_db': '--db-name', # Для MongoDB
-         'mongo_collection': '--collection', # Для MongoDB
-         'specific_params': '--specific-params-json', # Для других специфических параметров
-    }
-    # Добавляем маппинг для аргументов действия 'update'
-    if rust_action == 'update':
-        tt_arg_map = {
-            'upload_api_token': '--api-token',
-            'upload_datasheet_id': '--datasheet-id',
-            'upload_field_map_json': '--field-map-json',
-            # Добавлены дополнительные аргументы для update, если нужно
-            'record_id': '--record-id',
-            'field_updates_json': '--field-updates-json',
-        }
-        for key, value in tt_params.items():
-            if value is None or value == "":
-                continue
-            rust_arg_name = tt_arg_map.get(key)
-            if rust_arg_name:
-                rust_args.append(rust_arg_name)
-                rust_args.append(str(value))
-
-    # Добавляем параметры источника в аргументы Rust
-    # Используем собранные source_params
-    for key, value in source_params.items():
-        # Пропускаем None, пустые строки, ключи, которые не маппятся, или внутренние ключи
-        if value is None or value == "" or key not in rust_arg_map or key in ['id', 'name', 'source_type', 'is_default']:
-            continue
-
-        rust_arg_name = rust_arg_map[key]
-
-        # Специальная обработка для JSON параметров
-        if key in ['es_query', 'specific_params']:
-            if isinstance(value, dict): value_to_dump = value
-            elif isinstance(value, str):
-                 try: value_to_dump = json.loads(value)
-                 except json.JSONDecodeError:
-                      logger.error(f"Неверный JSON string для параметра {key} при формировании args Rust в handle_confirm_upload.")
-                      await callback.message.edit_text(f"Ошибка: Неверный формат JSON параметра '{get_friendly_param_name(key)}'. Отмена операции.", reply_markup=main_menu_keyboard())
-                      await state.clear()
-                      await callback.answer()
-                      return
-            else:
-                 logger.error(f"Неожиданный тип ({type(value)}) для параметра {key} при формировании args Rust.")
-                 await callback.message.edit_text(f"Ошибка: Неожиданный тип данных для параметра '{get_friendly_param_name(key)}'. Отмена операции.", reply_markup=main_menu_keyboard())
-                 await state.clear()
-                 await callback.answer()
-                 return
-
-            rust_args.append(rust_arg_name)
-            rust_args.append(json.dumps(value_to_dump)) # Передаем как JSON строку
-
+    # --- Формируем аргументы для Rust утилиты (общий маппинг с запланированными заданиями) ---
+    try:
+        rust_args = build_rust_args(rust_action, source_type, source_params, tt_params, str(output_filepath) if output_filepath else None)
+    except RustArgsError as e:
+        logger.error(f"Ошибка при формировании args Rust в handle_confirm_upload: {e}")
+        if e.param == 'upload_expected_headers':
+            error_text = "Ошибка: Неверный формат ожидаемых заголовков. Отмена операции."
         else:
-            # Остальные параметры передаем как строки
-            rust_args.append(rust_arg_name)
-            rust_args.append(str(value))
-
-    # Добавляем путь выходного файла, если действие extract
-    if output_filepath:
-         rust_args.append("--output-xlsx-path")
-         rust_args.append(str(output_filepath))
-
-    # Обработка --expected-headers, если они есть в source_params
-    expected_headers = source_params.get('upload_expected_headers')
-    if expected_headers:
-        try:
-            # Если expected_headers - строка, пытаемся распарсить как JSON
-            if isinstance(expected_headers, str):
-                expected_headers_json = json.loads(expected_headers)
-            else:
-                expected_headers_json = expected_headers
-            rust_args.append("--expected-headers")
-            rust_args.append(json.dumps(expected_headers_json))
-        except Exception as e:
-            logger.error(f"Ошибка при обработке expected_headers: {e}")
-            await callback.message.edit_text("Ошибка: Неверный формат ожидаемых заголовков. Отмена операции.", reply_markup=main_menu_keyboard())
-            await state.clear()
-            await callback.answer()
-            return
+            error_text = f"Ошибка: Неверный формат JSON параметра '{get_friendly_param_name(e.param)}'. Отмена операции."
+        await callback.message.edit_text(error_text, reply_markup=main_menu_keyboard())
+        await state.clear()
+        await callback.answer()
+        return
 
     # Переводим FSM в состояние "операция в процессе"
     await state.set_state(UploadProcess.operation_in_progress)
@@ -1458,7 +1365,7 @@ async def process_upload_task(
         await status_message.edit_text("⚙️ Выполняю Rust утилиту...", reply_markup=operation_in_progress_keyboard())
 
         # Выполняем Rust команду. execute_rust_command не блокирует, возвращает процесс и future для ожидания.
-        execution_info = await execute_rust_command(rust_args)
+        execution_info = await execute_rust_command(rust_args, chat_id=chat_id)
         # Время завершения выполнения execute_rust_command (может быть запуском или ошибкой запуска)
         end_time_launch = time.time()
 
@@ -1495,7 +1402,8 @@ async def process_upload_task(
 
                 # Попытка парсить JSON выход от Rust утилиты (предполагаем, что Rust выводит результат в JSON в stdout)
                 try:
-                    json_result: Dict[str, Any] = json.loads(stdout_str)
+                    # Большой вывод разбирается вне event loop (в пуле процессов)
+                    json_result: Dict[str, Any] = await loads_json(stdout_str)
                     # Извлекаем ожидаемые поля из JSON результата Rust
                     final_status = json_result.get("status", "ERROR") # Статус из JSON ('SUCCESS', 'ERROR')
                     error_message = json_result.get("message", "Сообщение от утилиты отсутствует.") # Сообщение от утилиты
@@ -1529,18 +1437,23 @@ async def process_upload_task(
                            error_message = f"Rust процесс завершился с ошибкой (код {process.returncode}). Stderr:\n{stderr_str}\nStdout:\n{stdout_str}"
                     final_status = "ERROR" # Подтверждаем статус ошибки
 
+                # Процесс остановлен сторожевым таймером или кнопкой отмены - его вывод неполный
+                stop_reason = execution_info["run"]["stop_reason"]
+                if stop_reason == 'timeout':
+                    final_status = "TIMEOUT"
+                    error_message = f"Операция остановлена: превышено ограничение времени ({execution_info['run']['timeout_seconds']} сек)."
+                elif stop_reason == 'cancel':
+                    final_status = "CANCELLED"
+                    error_message = "Операция была отменена пользователем."
+
             except asyncio.CancelledError:
                 # Перехват отмены задачи (например, если пользователь нажал "Отмена операции")
                 logger.info(f"Задача Communicate cancelled for PID {process.pid} for chat {chat_id}")
                 final_status = "CANCELLED" # Статус "Отменено"
                 error_message = "Операция была отменена пользователем." # Сообщение об отмене
                 duration = time.time() - start_time # Рассчитываем длительность до отмены
-    # Здесь нужно попытаться корректно завершить запущенный процесс Rust,
-    # отправив ему сигнал (например, SIGTERM), чтобы он завершился чисто.
-    # process.terminate() или process.kill() могут помочь.
-
-    # В handle_confirm_upload при запуске процесса добавить запись в running_processes
-    # В handle_cancel_operation вызвать terminate_process(chat_id)
+                # Процесс не должен работать после отмены задачи
+                await terminate_process_group(process)
 
             except Exception as e:
                 # Перехват других неожиданных ошибок во время ожидания communicate()
@@ -1561,7 +1474,7 @@ async def process_upload_task(
         # Очищаем временную директорию, если она была создана для загруженного файла
         if temp_upload_dir and os.path.exists(temp_upload_dir):
             try:
-                shutil.rmtree(temp_upload_dir)
+                await run_in_thread(shutil.rmtree, temp_upload_dir)
                 logger.info(f"Временная директория {temp_upload_dir} очищена.")
             except Exception as cleanup_e:
                 logger.error(f"Ошибка очистки временной директории {temp_upload_dir}: {cleanup_e}")
@@ -1575,7 +1488,8 @@ async def process_upload_task(
                  file_path=final_generated_file_path if final_status == "SUCCESS" and final_generated_file_path else None,
                  error_message=error_message, # Сообщение об ошибке или успехе
                  true_tabs_datasheet_id=datasheet_id_from_result, # ID таблицы TT
-                 duration_seconds=duration # Длительность выполнения
+                 duration_seconds=duration, # Длительность выполнения
+                 chat_id=chat_id # Чат, из которого запущена операция
              )
              logger.info(f"Запись истории добавлена для chat {chat_id} со статусом: {final_status}")
         except Exception as e:
@@ -1591,6 +1505,7 @@ async def process_upload_task(
         try:
             final_message_text = f"✅ <b>Операция успешно завершена!</b>\n" if final_status == "SUCCESS" else \
                                  f"⚠️ <b>Операция отменена.</b>\n" if final_status == "CANCELLED" else \
+                                 f"⏱ <b>Операция остановлена: превышено время выполнения.</b>\n" if final_status == "TIMEOUT" else \
                                  f"❌ <b>Операция завершилась с ошибкой!</b>\n"
 
             # Добавляем информацию об источнике и TT
@@ -1623,7 +1538,7 @@ async def process_upload_task(
                     # Добавим удаление временных файлов после отправки результата
                     if final_generated_file_path and Path(final_generated_file_path).exists():
                         try:
-                            shutil.rmtree(Path(final_generated_file_path).parent)
+                            await run_in_thread(shutil.rmtree, Path(final_generated_file_path).parent)
                             logger.info(f"Временные файлы удалены: {final_generated_file_path}")
                         except Exception as e:
                             logger.error(f"Ошибка при удалении временных файлов {final_generated_file_path}: {e}")
@@ -3,19 +3,22 @@ import logging
 import sys
 import os
 import json
+import time
 import aiohttp # Need aiohttp for async HTTP requests
-from datetime import datetime, timedelta # Need timedelta for forecast periods
-from typing import Dict, Any, Optional, List
+from datetime import datetime, timedelta, timezone # Need timedelta for forecast periods
+from typing import Dict, Any, Optional
 
 from aiogram import Bot, Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramAPIError
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import StateFilter
 
 from .. import config # Import config for API key
+from ..utils.cache import TTLCache
+from ..utils.geocoding import resolve_city
 from ..keyboards.inline import (
     main_menu_keyboard, # For returning to main menu
     weather_menu_keyboard, # NEW weather menu keyboard
@@ -51,10 +54,70 @@ class WeatherProcess(StatesGroup):
     # No specific waiting states for forecast period, handled by callback
 
 
+# Shared cache of OpenWeatherMap responses (current weather and forecast use separate TTLs)
+weather_cache = TTLCache("weather")
+
+
+def weather_cache_key(city_name: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None, is_forecast: bool = False) -> Optional[tuple]:
+    """
+    Builds the cache key for a weather lookup.
+    Coordinates win over the city name and are rounded to 2 decimals (~1 km), so lookups by
+    a geocoded city and by nearby coordinates share entries. City names are normalized.
+    """
+    kind = "forecast" if is_forecast else "weather"
+    if lat is not None and lon is not None:
+        return (kind, "coords", round(float(lat), 2), round(float(lon), 2))
+    if city_name:
+        return (kind, "city", " ".join(city_name.split()).casefold())
+    return None
+
+
+async def resolve_location(api_key: str, city_name: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None) -> tuple:
+    """
+    Turns a city-only lookup into a coordinate lookup via the geocoding cache.
+    Returns (city_name, lat, lon); city_name is dropped once coordinates are known.
+    If geocoding fails, the city name is kept and OpenWeatherMap resolves it itself.
+    """
+    if city_name and (lat is None or lon is None):
+        place = await resolve_city(api_key, city_name)
+        if place:
+            lat, lon = place['lat'], place['lon']
+    if lat is not None and lon is not None:
+        return None, lat, lon
+    return city_name, lat, lon
+
+
 # --- Helper function to call OpenWeatherMap API ---
 async def get_weather_data(api_key: str, city_name: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None, is_forecast: bool = False) -> Optional[Dict[str, Any]]:
     """
-    Calls the OpenWeatherMap API to get current weather or forecast.
+    Returns current weather or forecast, served from weather_cache when possible.
+    City names are resolved to coordinates through the geocoding cache first.
+    """
+    city_name, lat, lon = await resolve_location(api_key, city_name, lat, lon)
+    return await get_cached_weather_data(api_key, city_name=city_name, lat=lat, lon=lon, is_forecast=is_forecast)
+
+
+async def get_cached_weather_data(api_key: str, city_name: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None, is_forecast: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Returns current weather or forecast from weather_cache without geocoding.
+    Concurrent misses for the same location result in a single OpenWeatherMap call.
+    """
+    key = weather_cache_key(city_name, lat, lon, is_forecast)
+    if key is None:
+        logger.error("Both city_name and lat/lon are missing for weather API call.")
+        return None
+
+    ttl = config.WEATHER_FORECAST_CACHE_TTL if is_forecast else config.WEATHER_CURRENT_CACHE_TTL
+    return await weather_cache.get_or_fetch(
+        key,
+        lambda: fetch_weather_data(api_key, city_name=city_name, lat=lat, lon=lon, is_forecast=is_forecast),
+        ttl,
+    )
+
+
+async def fetch_weather_data(api_key: str, city_name: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None, is_forecast: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Calls the OpenWeatherMap API to get current weather or forecast (bypasses the cache).
     Requires either city_name or lat/lon.
     Returns parsed JSON response or None on error.
     """
@@ -125,107 +188,165 @@ def format_weather_data(data: Dict[str, Any], period: str = "now") -> str:
         return text
 
     # --- Formatting for Forecast ---
-    elif period in ['3h', 'today', '1d', '3d', '7d', '30d'] and 'list' in data and 'city' in data:
-        forecast_list = data['list']
-        city_name = data['city'].get('name', 'Неизвестный город')
-
-        text = f"☀️ Прогноз погоды для города <b>{city_name}</b> ({period}):\n\n"
-
-        now = datetime.now(datetime.now().astimezone().tzinfo) # Get current time with timezone
-
-        if period == '3h':
-            # Take the next forecast entry (usually starts soon after 'now')
-            if forecast_list:
-                 entry = forecast_list[0]
-                 dt_txt = entry.get('dt_txt', 'N/A')
-                 temp = entry['main'].get('temp', 'N/A') if 'main' in entry else 'N/A'
-                 desc = entry['weather'][0].get('description', 'N/A') if 'weather' in entry and entry['weather'] else 'N/A'
-                 wind_speed = entry.get('wind', {}).get('speed', 'N/A')
-                 text += f"{dt_txt}: {temp}°C, {desc}, Ветер: {wind_speed} м/с"
-            else:
-                 text += "Прогноз на ближайшие 3 часа недоступен."
+    elif period in FORECAST_PERIODS and 'list' in data and 'city' in data:
+        return format_forecast_summary(build_forecast_summary(data), period)
 
-        elif period == 'today':
-            # Summarize forecast until the end of the current day
-            end_of_day = now.replace(hour=23, minute=59, second=59)
-            today_forecast = [entry for entry in forecast_list if datetime.fromisoformat(entry['dt_txt']) <= end_of_day]
+    else:
+        # Handle unexpected data structure
+        logger.error(f"Unexpected weather data structure for period '{period}': {data}")
+        return "Не удалось обработать данные о погоде."
 
-            if today_forecast:
-                # Calculate min/max temp, average wind, summarize conditions
-                min_temp = min(entry['main']['temp_min'] for entry in today_forecast if 'main' in entry and 'temp_min' in entry['main']) if today_forecast else 'N/A'
-                max_temp = max(entry['main']['temp_max'] for entry in today_forecast if 'main' in entry and 'temp_max' in entry['main']) if today_forecast else 'N/A'
-                avg_wind = sum(entry['wind']['speed'] for entry in today_forecast if 'wind' in entry and 'speed' in entry['wind']) / len(today_forecast) if today_forecast and any('wind' in entry and 'speed' in entry['wind'] for entry in today_forecast) else 'N/A'
-                # Simple mode summary (take most frequent description)
-                descriptions = [entry['weather'][0]['description'] for entry in today_forecast if 'weather' in entry and entry['weather'] and entry['weather'][0].get('description')]
-                desc_summary = max(set(descriptions), key=descriptions.count) if descriptions else 'Различно'
 
+# Periods rendered from the forecast summary ('1d' is kept as an alias of 'tomorrow')
+FORECAST_PERIODS = ['1h', '3h', 'today', 'tomorrow', '1d', '3d', '7d', '30d']
 
-                text += f"Минимальная темп.: {min_temp}°C\n"
-                text += f"Максимальная темп.: {max_temp}°C\n"
-                text += f"Средний ветер: {avg_wind:.2f} м/с\n" if isinstance(avg_wind, (int, float)) else f"Средний ветер: {avg_wind} м/с\n"
-                text += f"Условия: {desc_summary}"
 
-            else:
-                 text += "Прогноз на сегодня недоступен."
+# --- Forecast model: the 3-hour /forecast list is parsed once into per-day aggregates ---
+def build_forecast_summary(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Parses an OpenWeatherMap /forecast response into a compact, JSON-serializable summary:
+    the nearest 3-hour entry plus per-day aggregates (min/max/mean temperature,
+    dominant description, max wind). Days are split in the city's local time; "today" is
+    determined when the summary is rendered. fetched_at - when the response was parsed (epoch seconds).
+    Returns None if the response has no forecast entries.
+    """
+    forecast_list = data.get('list') or []
+    if not forecast_list:
+        return None
+
+    city = data.get('city', {})
+    tz_offset = timedelta(seconds=city.get('timezone', 0))
+
+    first = forecast_list[0]
+    next_entry = {
+        'dt_txt': first.get('dt_txt', 'N/A'),
+        'temp': first.get('main', {}).get('temp'),
+        'description': first['weather'][0].get('description') if first.get('weather') else None,
+        'wind_speed': first.get('wind', {}).get('speed'),
+    }
+
+    days: Dict[str, Dict[str, Any]] = {}
+    for entry in forecast_list:
+        if 'dt' in entry:
+            local_dt = datetime.fromtimestamp(entry['dt'], timezone.utc) + tz_offset
+        else:
+            local_dt = datetime.fromisoformat(entry['dt_txt']) + tz_offset
+        day = days.setdefault(local_dt.date().isoformat(), {
+            'temp_min': None, 'temp_max': None, 'temp_sum': 0.0, 'temp_count': 0,
+            'wind_max': None, 'descriptions': {},
+        })
+
+        main_data = entry.get('main', {})
+        temp_min = main_data.get('temp_min', main_data.get('temp'))
+        temp_max = main_data.get('temp_max', main_data.get('temp'))
+        if temp_min is not None:
+            day['temp_min'] = temp_min if day['temp_min'] is None else min(day['temp_min'], temp_min)
+        if temp_max is not None:
+            day['temp_max'] = temp_max if day['temp_max'] is None else max(day['temp_max'], temp_max)
+        if main_data.get('temp') is not None:
+            day['temp_sum'] += main_data['temp']
+            day['temp_count'] += 1
+
+        wind_speed = entry.get('wind', {}).get('speed')
+        if wind_speed is not None:
+            day['wind_max'] = wind_speed if day['wind_max'] is None else max(day['wind_max'], wind_speed)
+
+        if entry.get('weather') and entry['weather'][0].get('description'):
+            description = entry['weather'][0]['description']
+            day['descriptions'][description] = day['descriptions'].get(description, 0) + 1
+
+    daily = []
+    for date_str, day in days.items():
+        daily.append({
+            'date': date_str,
+            'temp_min': day['temp_min'],
+            'temp_max': day['temp_max'],
+            'temp_mean': round(day['temp_sum'] / day['temp_count'], 1) if day['temp_count'] else None,
+            'description': max(day['descriptions'], key=day['descriptions'].get) if day['descriptions'] else 'Различно',
+            'wind_max': day['wind_max'],
+        })
+
+    return {
+        'city_name': city.get('name', 'Неизвестный город'),
+        'tz_offset_seconds': city.get('timezone', 0),
+        'fetched_at': time.time(),
+        'next_entry': next_entry,
+        'days': daily,
+    }
+
 
+def _city_today(summary: Dict[str, Any]) -> str:
+    """Current date in the forecast city's local time (ISO)."""
+    return (datetime.now(timezone.utc) + timedelta(seconds=summary['tz_offset_seconds'])).date().isoformat()
 
-    elif period in ['1d', '3d', '7d', '30d']:
-        # Summarize forecast for X days
-        days = int(period[:-1]) # Extract number of days (1, 3, 7, 30)
-        end_date = now + timedelta(days=days)
 
-        # Filter forecast entries within the requested period
-        period_forecast = [entry for entry in forecast_list if datetime.fromisoformat(entry['dt_txt']) <= end_date]
+def _format_value(value: Any) -> str:
+    return 'N/A' if value is None else str(value)
 
-        if not period_forecast:
-             text += f"Прогноз на {days} дней недоступен."
-             if days > 5: text += " (Бесплатная API предоставляет прогноз максимум на 5 дней)."
+
+def _format_forecast_day(day: Dict[str, Any]) -> str:
+    return (
+        f"<b>{day['date']}</b>: {_format_value(day['temp_min'])}°C ... {_format_value(day['temp_max'])}°C "
+        f"(в среднем {_format_value(day['temp_mean'])}°C), {day['description']}, "
+        f"Ветер до {_format_value(day['wind_max'])} м/с"
+    )
+
+
+def format_forecast_summary(summary: Optional[Dict[str, Any]], period: str) -> str:
+    """Renders a forecast period from the summary built by build_forecast_summary (no parsing, no network)."""
+    if not summary:
+        return "Прогноз погоды недоступен."
+
+    text = f"☀️ Прогноз погоды для города <b>{summary['city_name']}</b> ({period}):\n\n"
+    days = summary['days']
+
+    if period in ('1h', '3h'):
+        entry = summary['next_entry']
+        label = "Прогноз на следующий час" if period == '1h' else "Ближайшие 3 часа"
+        text += (
+            f"{label} ({entry['dt_txt']}): {_format_value(entry['temp'])}°C, "
+            f"{_format_value(entry['description'])}, Ветер: {_format_value(entry['wind_speed'])} м/с"
+        )
+
+    elif period in ('today', 'tomorrow', '1d'):
+        target_date = datetime.fromisoformat(_city_today(summary)).date()
+        if period != 'today':
+            target_date += timedelta(days=1)
+        day = next((d for d in days if d['date'] == target_date.isoformat()), None)
+        if day:
+            text += _format_forecast_day(day)
         else:
-            # Group forecast entries by day
-            forecast_by_day: Dict[str, List[Dict[str, Any]]] = {}
-            for entry in period_forecast:
-                date_str = entry['dt_txt'].split(' ')[0] # 'YYYY-MM-DD'
-                if date_str not in forecast_by_day:
-                    forecast_by_day[date_str] = []
-                forecast_by_day[date_str].append(entry)
-
-            # Summarize each day
-            for date_str, daily_entries in forecast_by_day.items():
-                try:
-                     min_temp = min(entry['main']['temp_min'] for entry in daily_entries if 'main' in entry and 'temp_min' in entry['main']) if daily_entries else 'N/A'
-                     max_temp = max(entry['main']['temp_max'] for entry in daily_entries if 'main' in entry and 'temp_max' in entry['main']) if daily_entries else 'N/A'
-                     avg_wind = sum(entry['wind']['speed'] for entry in daily_entries if 'wind' in entry and 'speed' in entry['wind']) / len(daily_entries) if daily_entries and any('wind' in entry and 'speed' in entry['wind'] for entry in daily_entries) else 'N/A'
-                     descriptions = [entry['weather'][0]['description'] for entry in daily_entries if 'weather' in entry and entry['weather'] and entry['weather'][0].get('description')]
-                     desc_summary = max(set(descriptions), key=descriptions.count) if descriptions else 'Различно'
-
-                     text += f"<b>{date_str}</b>: {min_temp}°C ... {max_temp}°C, {desc_summary}, Ветер: {avg_wind:.2f} м/с\n" if isinstance(avg_wind, (int, float)) else f"<b>{date_str}</b>: {min_temp}°C ... {max_temp}°C, {desc_summary}, Ветер: {avg_wind} м/с\n"
-                except Exception as e:
-                     logger.error(f"Error summarizing daily forecast for {date_str}: {e}", exc_info=True)
-                     text += f"<b>{date_str}</b>: Ошибка суммирования данных.\n"
-    elif period == '1h':
-        # Summarize forecast for next 1 hour (approximate using first forecast entry)
-        if forecast_list:
-            entry = forecast_list[0]
-            dt_txt = entry.get('dt_txt', 'N/A')
-            temp = entry['main'].get('temp', 'N/A') if 'main' in entry else 'N/A'
-            desc = entry['weather'][0].get('description', 'N/A') if 'weather' in entry and entry['weather'] else 'N/A'
-            wind_speed = entry.get('wind', {}).get('speed', 'N/A')
-            text += f"Прогноз на следующий час ({dt_txt}): {temp}°C, {desc}, Ветер: {wind_speed} м/с"
+            text += "Прогноз на сегодня недоступен." if period == 'today' else "Прогноз на завтра недоступен."
+
+    else:
+        requested_days = int(period[:-1])
+        selected = [d for d in days if d['date'] >= _city_today(summary)][:requested_days]
+        if selected:
+            text += "\n".join(_format_forecast_day(day) for day in selected)
         else:
-            text += "Прогноз на следующий час недоступен."
+            text += f"Прогноз на {requested_days} дней недоступен."
+        if requested_days > 5:
+            text += "\n<i>(Бесплатная API предоставляет прогноз максимум на 5 дней)</i>"
 
-        # Add note about API limitations if applicable
-        if days > 5 and period in ['7d', '30d']: # Assuming 5-day limit for free API
-             text += "\n<i>(Прогноз на >5 дней может быть неточным или недоступен в бесплатной версии API)</i>"
+    return text
 
 
-        return text
+async def get_forecast_summary(api_key: str, city_name: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    Returns the parsed forecast summary for a location. The /forecast endpoint is called once
+    per location and TTL; the summary (not the raw 40-entry response) is what gets cached.
+    """
+    city_name, lat, lon = await resolve_location(api_key, city_name, lat, lon)
+    key = weather_cache_key(city_name, lat, lon, is_forecast=True)
+    if key is None:
+        logger.error("Both city_name and lat/lon are missing for forecast lookup.")
+        return None
 
+    async def fetch_summary() -> Optional[Dict[str, Any]]:
+        data = await fetch_weather_data(api_key, city_name=city_name, lat=lat, lon=lon, is_forecast=True)
+        return build_forecast_summary(data) if data else None
 
-    else:
-        # Handle unexpected data structure
-        logger.error(f"Unexpected weather data structure for period '{period}': {data}")
-        return "Не удалось обработать данные о погоде."
+    return await weather_cache.get_or_fetch(("summary",) + key, fetch_summary, config.WEATHER_FORECAST_CACHE_TTL)
 
 
 # --- Handlers for Weather Feature ---
@@ -261,8 +382,13 @@ async def process_city_name_for_weather(message: Message, state: FSMContext):
         await message.answer("Название города не может быть пустым. Введите название города:")
         return
 
-    # Fetch current weather data by city name
-    weather_data = await get_weather_data(config.WEATHER_API_KEY, city_name=city_name)
+    # Resolve the city through the geocoding cache (memory -> SQLite -> API), then look weather up by coordinates
+    place = await resolve_city(config.WEATHER_API_KEY, city_name)
+    if place:
+        weather_data = await get_cached_weather_data(config.WEATHER_API_KEY, lat=place['lat'], lon=place['lon'])
+    else:
+        # Geocoding failed: let OpenWeatherMap resolve the name itself (no second geocoding attempt)
+        weather_data = await get_cached_weather_data(config.WEATHER_API_KEY, city_name=city_name)
 
     if weather_data is None:
         # Handle API errors or city not found
@@ -278,12 +404,14 @@ async def process_city_name_for_weather(message: Message, state: FSMContext):
     current_weather_text = format_weather_data(weather_data, period='now')
     await message.answer(current_weather_text, parse_mode='HTML')
 
-    # Store location data for forecast step
-    # We need city name or lat/lon for forecast API call later
-    # If we got weather data, OpenWeatherMap response for city includes lat/lon
-    lat = weather_data.get('coord', {}).get('lat')
-    lon = weather_data.get('coord', {}).get('lon')
-    await state.update_data(weather_location={'city_name': city_name, 'lat': lat, 'lon': lon})
+    # Store location data for forecast step (coordinates from the geocoder or from the weather response)
+    if place:
+        city_name, lat, lon = place['name'], place['lat'], place['lon']
+    else:
+        lat = weather_data.get('coord', {}).get('lat')
+        lon = weather_data.get('coord', {}).get('lon')
+    # The forecast summary is built lazily on the first period selection and reused afterwards
+    await state.update_data(weather_location={'city_name': city_name, 'lat': lat, 'lon': lon}, weather_forecast=None)
 
 
     # Transition to selecting forecast period
@@ -333,7 +461,7 @@ async def process_coordinates_for_weather(message: Message, state: FSMContext):
     await message.answer(current_weather_text, parse_mode='HTML')
 
     # Store location data for forecast step
-    await state.update_data(weather_location={'lat': lat, 'lon': lon}) # Don't have city name easily from coords API response
+    await state.update_data(weather_location={'lat': lat, 'lon': lon}, weather_forecast=None) # Don't have city name easily from coords API response
 
 
     # Transition to selecting forecast period
@@ -372,7 +500,7 @@ async def process_forecast_period(callback: CallbackQuery, state: FSMContext):
         return
 
 
-    # For any other period, fetch forecast data
+    # For any other period, render from the forecast summary (fetched and parsed once per location)
     state_data = await state.get_data()
     location = state_data.get('weather_location')
 
@@ -382,18 +510,29 @@ async def process_forecast_period(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    # Fetch forecast data
-    forecast_data = await get_weather_data(config.WEATHER_API_KEY, city_name=location.get('city_name'), lat=location.get('lat'), lon=location.get('lon'), is_forecast=True)
+    forecast_summary = state_data.get('weather_forecast')
+    # Сводка в состоянии FSM живет не дольше кэша прогноза, иначе "сегодня" и "завтра" показывают устаревшие данные
+    if forecast_summary is None or time.time() - forecast_summary.get('fetched_at', 0) >= config.WEATHER_FORECAST_CACHE_TTL:
+        forecast_summary = await get_forecast_summary(config.WEATHER_API_KEY, city_name=location.get('city_name'), lat=location.get('lat'), lon=location.get('lon'))
 
-    if forecast_data is None:
-        await callback.message.edit_text(f"Не удалось получить прогноз погоды на период {period}.", reply_markup=weather_menu_keyboard())
-        await state.clear() # Clear state
-        await callback.answer()
-        return
+        if forecast_summary is None:
+            await callback.message.edit_text(f"Не удалось получить прогноз погоды на период {period}.", reply_markup=weather_menu_keyboard())
+            await state.clear() # Clear state
+            await callback.answer()
+            return
+
+        # Keep the summary in FSM state so switching periods doesn't touch the cache or the API
+        await state.update_data(weather_forecast=forecast_summary)
 
     # Format and send forecast
-    forecast_text = format_weather_data(forecast_data, period=period)
-    await callback.message.edit_text(forecast_text, reply_markup=select_forecast_period_keyboard(), parse_mode='HTML') # Stay in select_forecast_period state
+    forecast_text = format_forecast_summary(forecast_summary, period=period)
+    try:
+        await callback.message.edit_text(forecast_text, reply_markup=select_forecast_period_keyboard(), parse_mode='HTML') # Stay in select_forecast_period state
+    except TelegramBadRequest as e:
+        # '1d' and 'tomorrow' render the same text; Telegram rejects an edit without changes
+        if "message is not modified" not in str(e):
+            raise
+        logger.debug(f"Forecast message was not modified: {e}")
     await callback.answer()
 
 
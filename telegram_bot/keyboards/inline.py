@@ -201,6 +201,7 @@ def select_schedule_trigger_type_keyboard() -> InlineKeyboardMarkup:
     builder.row(InlineKeyboardButton(text="По интервалу (Interval)", callback_data="select_trigger_type:interval"))
     builder.row(InlineKeyboardButton(text="По расписанию (Cron)", callback_data="select_trigger_type:cron"))
     builder.row(InlineKeyboardButton(text="Один раз в дату/время (Date)", callback_data="select_trigger_type:date"))
+    builder.row(InlineKeyboardButton(text="После других заданий (конвейер)", callback_data="select_trigger_type:after"))
 
     builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
     return builder.as_markup()
@@ -239,8 +240,8 @@ def select_forecast_period_keyboard() -> InlineKeyboardMarkup:
         InlineKeyboardButton(text="На сегодня (до конца дня)", callback_data="weather_period:today"), # Will require summarizing 3h intervals
     )
     builder.row(
-        InlineKeyboardButton(text="На 1 день", callback_data="weather_period:1d"), # Will require summarizing from forecast
-        InlineKeyboardButton(text="На 3 дня", callback_data="weather_period:3d"), # Will require summarizing from forecast
+        InlineKeyboardButton(text="На завтра", callback_data="weather_period:tomorrow"), # Daily aggregate from forecast summary
+        InlineKeyboardButton(text="На 3 дня", callback_data="weather_period:3d"), # Daily aggregates from forecast summary
     )
     # Consider if Week/Month are feasible with paid API or need external logic
     builder.row(
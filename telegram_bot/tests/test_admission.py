@@ -0,0 +1,142 @@
+import asyncio
+
+from telegram_bot.utils.admission import AdmissionController, RunCost
+
+
+async def _hold(controller: AdmissionController, cost: RunCost, gate: asyncio.Event, admitted: list):
+    async with controller.slot(cost):
+        admitted.append(cost.job_id)
+        await gate.wait()
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def _assert_idle(controller: AdmissionController):
+    stats = controller.stats()
+    assert stats['running'] == 0
+    assert stats['waiting'] == 0
+    assert stats['memory_kb'] == 0
+
+
+def test_cancelled_waiter_then_release():
+    async def scenario():
+        controller = AdmissionController(1)
+        gate, admitted = asyncio.Event(), []
+        holder = asyncio.create_task(_hold(controller, RunCost('a', 1, 0), gate, admitted))
+        await _settle()
+        waiter = asyncio.create_task(_hold(controller, RunCost('w', 1, 0), asyncio.Event(), admitted))
+        await _settle()
+        # Отмена обрабатывается ожидающим раньше, чем освобождается слот
+        waiter.cancel()
+        gate.set()
+        await asyncio.gather(holder, waiter, return_exceptions=True)
+        assert waiter.cancelled() and not holder.cancelled()
+        assert admitted == ['a']
+        _assert_idle(controller)
+
+    asyncio.run(scenario())
+
+
+def test_release_before_cancelled_waiter_cleans_up():
+    async def scenario():
+        controller = AdmissionController(1)
+        gate, admitted = asyncio.Event(), []
+        holder = asyncio.create_task(_hold(controller, RunCost('a', 1, 0), gate, admitted))
+        await _settle()
+        waiter = asyncio.create_task(_hold(controller, RunCost('w', 1, 0), asyncio.Event(), admitted))
+        await _settle()
+        # Слот освобождается, когда future ожидающего уже отменен, но отмена еще не обработана
+        gate.set()
+        waiter.cancel()
+        results = await asyncio.gather(holder, waiter, return_exceptions=True)
+        assert results[0] is None
+        assert waiter.cancelled()
+        assert admitted == ['a']
+        _assert_idle(controller)
+
+        # Слот не утек: следующий запуск допускается сразу
+        async with controller.slot(RunCost('next', 1, 0)) as waited:
+            assert waited < 1
+        _assert_idle(controller)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_head_of_line_waiter_admits_the_next():
+    async def scenario():
+        controller = AdmissionController(2, memory_budget_kb=100)
+        gate, admitted = asyncio.Event(), []
+        holder = asyncio.create_task(_hold(controller, RunCost('a', 1, 60), gate, admitted))
+        await _settle()
+        # Короткий, но тяжелый запуск первый по приоритету и не помещается в бюджет памяти
+        heavy = asyncio.create_task(_hold(controller, RunCost('heavy', 0.5, 80), gate, admitted))
+        await _settle()
+        light = asyncio.create_task(_hold(controller, RunCost('light', 5, 30), gate, admitted))
+        await _settle()
+        assert admitted == ['a']
+        assert controller.stats()['waiting'] == 2
+
+        heavy.cancel()
+        await _settle()
+        assert admitted == ['a', 'light']
+        assert controller.stats()['running'] == 2
+
+        gate.set()
+        await asyncio.gather(holder, heavy, light, return_exceptions=True)
+        _assert_idle(controller)
+
+    asyncio.run(scenario())
+
+
+def test_memory_budget_blocks_until_release():
+    async def scenario():
+        controller = AdmissionController(3, memory_budget_kb=100)
+        first_gate, second_gate, admitted = asyncio.Event(), asyncio.Event(), []
+        first = asyncio.create_task(_hold(controller, RunCost('first', 1, 70), first_gate, admitted))
+        await _settle()
+        second = asyncio.create_task(_hold(controller, RunCost('second', 1, 50), second_gate, admitted))
+        await _settle()
+        # Свободный слот есть, но вместе запуски не помещаются в бюджет
+        assert admitted == ['first']
+        assert controller.stats()['memory_kb'] == 70
+
+        first_gate.set()
+        await _settle()
+        assert admitted == ['first', 'second']
+        assert controller.stats()['memory_kb'] == 50
+
+        second_gate.set()
+        await asyncio.gather(first, second)
+        _assert_idle(controller)
+
+    asyncio.run(scenario())
+
+
+def test_run_heavier_than_budget_runs_alone():
+    async def scenario():
+        controller = AdmissionController(2, memory_budget_kb=100)
+        async with controller.slot(RunCost('huge', 1, 500)):
+            assert controller.stats()['running'] == 1
+        _assert_idle(controller)
+
+    asyncio.run(scenario())
+
+
+def test_shortest_expected_run_first():
+    async def scenario():
+        controller = AdmissionController(1, aging_rate=0.0)
+        gate, admitted = asyncio.Event(), []
+        holder = asyncio.create_task(_hold(controller, RunCost('a', 1, 0), gate, admitted))
+        await _settle()
+        slow = asyncio.create_task(_hold(controller, RunCost('slow', 300, 0), gate, admitted))
+        fast = asyncio.create_task(_hold(controller, RunCost('fast', 5, 0), gate, admitted))
+        await _settle()
+        gate.set()
+        await asyncio.gather(holder, slow, fast)
+        assert admitted == ['a', 'fast', 'slow']
+        _assert_idle(controller)
+
+    asyncio.run(scenario())
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta, timezone
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from telegram_bot import config
+from telegram_bot.utils.scheduling import OffsetTrigger, backoff_delay_seconds, missed_fire_times
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _hourly():
+    return IntervalTrigger(hours=1, start_date=START, timezone=timezone.utc)
+
+
+def test_offset_trigger_shifts_interval_fire_times():
+    trigger = OffsetTrigger(IntervalTrigger(minutes=10, start_date=START, timezone=timezone.utc), 30)
+    first = trigger.get_next_fire_time(None, START + timedelta(minutes=5))
+    assert first == START + timedelta(minutes=10, seconds=30)
+    assert trigger.get_next_fire_time(first, first) == START + timedelta(minutes=20, seconds=30)
+
+
+def test_offset_trigger_shifts_cron_fire_times():
+    trigger = OffsetTrigger(CronTrigger(hour=3, minute=0, timezone=timezone.utc), 90)
+    assert trigger.get_next_fire_time(None, START) == START + timedelta(hours=3, seconds=90)
+    # Внутри окна сдвига срабатывание еще впереди
+    assert trigger.get_next_fire_time(None, START + timedelta(hours=3, seconds=30)) == START + timedelta(hours=3, seconds=90)
+
+
+def test_missed_fire_times_short_outage():
+    now = START + timedelta(hours=5, minutes=30)
+    total, times = missed_fire_times(_hourly(), START + timedelta(hours=1), now, 10)
+    assert total == 5
+    assert times == [START + timedelta(hours=hour) for hour in range(1, 6)]
+
+
+def test_missed_fire_times_keeps_the_latest():
+    now = START + timedelta(hours=5, minutes=30)
+    total, times = missed_fire_times(_hourly(), START + timedelta(hours=1), now, 2)
+    assert total == 5
+    assert times == [START + timedelta(hours=4), START + timedelta(hours=5)]
+
+
+def test_missed_fire_times_long_outage_counts_without_enumerating():
+    now = START + timedelta(hours=1000, minutes=30)
+    total, times = missed_fire_times(_hourly(), START + timedelta(hours=1), now, 3)
+    assert total == 1000
+    assert times == [START + timedelta(hours=hour) for hour in (998, 999, 1000)]
+
+
+def test_missed_fire_times_nothing_missed():
+    now = START + timedelta(minutes=30)
+    assert missed_fire_times(_hourly(), START + timedelta(hours=1), now, 5) == (0, [])
+
+
+def test_backoff_doubles_per_failure():
+    assert backoff_delay_seconds(60, 0) == 60
+    assert backoff_delay_seconds(60, 1) == 120
+    assert backoff_delay_seconds(60, 3) == 480
+
+
+def test_backoff_is_capped():
+    assert backoff_delay_seconds(60, 100) == config.SCHEDULE_BACKOFF_MAX_SECONDS
+    # Период длиннее предела не сокращается
+    period = config.SCHEDULE_BACKOFF_MAX_SECONDS * 2
+    assert backoff_delay_seconds(period, 2) == period
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from .. import config
+
+# Допуск запусков запланированных заданий к выполнению. Вместо общей очереди FIFO ожидающие запуски
+# упорядочены по ожидаемой длительности (сначала короткие), а ожидание постепенно повышает приоритет,
+# чтобы тяжелые задания тоже выполнялись. Одновременно выполняется не больше max_runs запусков,
+# и их суммарная ожидаемая пиковая память не превышает бюджет.
+
+# Оценка для задания без успешных запусков в журнале
+DEFAULT_ESTIMATE_SECONDS = 60.0
+
+
+class RunCost(NamedTuple):
+    """Expected cost of one run (estimates kept on scheduled_jobs, see sqlite_db.finish_schedule_run)."""
+    job_id: Optional[str]
+    duration_seconds: float
+    memory_kb: int
+
+
+def estimate_run_cost(job: Optional[Dict[str, Any]]) -> RunCost:
+    if not job:
+        return RunCost(None, DEFAULT_ESTIMATE_SECONDS, 0)
+    return RunCost(
+        job['job_id'],
+        job.get('est_duration_seconds') or DEFAULT_ESTIMATE_SECONDS,
+        int(job.get('est_peak_memory_kb') or 0),
+    )
+
+
+class _Waiter:
+    __slots__ = ('cost', 'enqueued_at', 'future')
+
+    def __init__(self, cost: RunCost, future: asyncio.Future):
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+        self.future = future
+
+
+class AdmissionController:
+    """Admits runs in shortest-expected-first order with aging, within run and memory budgets."""
+
+    def __init__(self, max_runs: int, memory_budget_kb: int = 0, aging_rate: float = 1.0):
+        self.max_runs = max_runs
+        self.memory_budget_kb = memory_budget_kb # 0 - память не ограничивается
+        self.aging_rate = aging_rate # На сколько секунд ожидаемой длительности "дешевеет" запуск за секунду ожидания
+        self._waiters: List[_Waiter] = []
+        self._running = 0
+        self._memory_kb = 0
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _priority(self, waiter: _Waiter, now: float) -> float:
+        return waiter.cost.duration_seconds - (now - waiter.enqueued_at) * self.aging_rate
+
+    def _fits(self, cost: RunCost) -> bool:
+        if self._running >= self.max_runs:
+            return False
+        # Запуск тяжелее всего бюджета выполняется один, иначе он не выполнится никогда
+        if self.memory_budget_kb and self._running and self._memory_kb + cost.memory_kb > self.memory_budget_kb:
+            return False
+        return True
+
+    def _dispatch(self) -> None:
+        # Ожидающие, чей future уже отменен (задача отменена до допуска), слот не получают
+        self._waiters = [waiter for waiter in self._waiters if not waiter.future.done()]
+        while self._waiters:
+            now = time.monotonic()
+            best = min(self._waiters, key=lambda waiter: self._priority(waiter, now))
+            # Первый по приоритету ждет освобождения ресурсов, остальные его не обгоняют
+            if not self._fits(best.cost):
+                return
+            self._waiters.remove(best)
+            self._running += 1
+            self._memory_kb += best.cost.memory_kb
+            waited = now - best.enqueued_at
+            self.admitted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            best.future.set_result(waited)
+
+    def _release(self, cost: RunCost) -> None:
+        self._running -= 1
+        self._memory_kb -= cost.memory_kb
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, cost: RunCost):
+        """Waits for admission; yields the time spent waiting (seconds)."""
+        waiter = _Waiter(cost, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._dispatch()
+        try:
+            waited = await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(cost) # Допущен, но отменен до начала выполнения
+            else:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                self._dispatch() # Ушедший мог быть первым по приоритету и задерживать остальных
+            raise
+        try:
+            yield waited
+        finally:
+            self._release(cost)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._running,
+            'max_runs': self.max_runs,
+            'memory_kb': self._memory_kb,
+            'memory_budget_kb': self.memory_budget_kb,
+            'waiting': len(self._waiters),
+            'admitted': self.admitted,
+            'avg_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+def format_admission_stats(stats: Dict[str, Any]) -> str:
+    memory = f"{stats['memory_kb'] // 1024} МиБ"
+    if stats['memory_budget_kb']:
+        memory += f" из {stats['memory_budget_kb'] // 1024} МиБ"
+    return (
+        f"Запуски заданий: выполняется {stats['running']} из {stats['max_runs']}, ожидаемая память {memory}, "
+        f"в очереди {stats['waiting']}; допущено {stats['admitted']}, "
+        f"ожидание в среднем {stats['avg_wait']:.1f} с (макс. {stats['max_wait']:.1f} с)"
+    )
+
+
+run_admission = AdmissionController(
+    config.SCHEDULED_MAX_CONCURRENT_RUNS,
+    config.SCHEDULED_MEMORY_BUDGET_MB * 1024,
+    config.SCHEDULED_AGING_RATE,
+)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    In-memory TTL cache for async fetch results with single-flight de-duplication.
+
+    Concurrent misses for the same key share one in-flight fetch, so only one upstream
+    call is made. Results equal to None are treated as errors and are not cached.
+    """
+
+    def __init__(self, name: str, max_entries: int = 1024):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}  # key -> (expires_at, value)
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # Misses served by someone else's in-flight fetch
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns a fresh cached value or None (does not touch the metrics)."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        if len(self._entries) >= self.max_entries and key not in self._entries:
+            self._evict()
+        self._entries[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def _evict(self) -> None:
+        """Drops expired entries; if still full, drops the entry closest to expiry."""
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            oldest_key = min(self._entries, key=lambda k: self._entries[k][0])
+            del self._entries[oldest_key]
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], ttl: float) -> Optional[Any]:
+        """
+        Returns the cached value for key, or awaits fetch() once for all concurrent callers
+        and caches its result for ttl seconds.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+        else:
+            # The fetch runs in its own task, not in the first caller's, so no caller's cancellation reaches it
+            in_flight = asyncio.create_task(self._fetch_and_store(key, fetch, ttl))
+            self._in_flight[key] = in_flight
+            in_flight.add_done_callback(lambda task: self._fetch_done(key, task))
+        # shield: cancelling one waiter must not cancel the fetch for the others
+        return await asyncio.shield(in_flight)
+
+    async def _fetch_and_store(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], ttl: float) -> Optional[Any]:
+        value = await fetch()
+        if value is not None:
+            self.set(key, value, ttl)
+        return value
+
+    def _fetch_done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Waiters get the exception; mark it retrieved in case all of them were cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class LRUCache:
+    """Bounded in-memory LRU map (no expiry) for values that rarely change, e.g. geocoding results."""
+
+    def __init__(self, name: str, max_entries: int = 1024):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': 0,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
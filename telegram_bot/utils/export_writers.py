@@ -0,0 +1,97 @@
+import csv
+import json
+import os
+import tempfile
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from .offload import run_in_process
+
+# Экспорт в два прохода через временный JSONL-файл: первый проход собирает объединение полей
+# всех записей (заголовки), второй пишет CSV/XLSX построчно. В памяти - только одна запись.
+
+
+async def spool_records(records: AsyncIterator[Dict[str, Any]], directory: str) -> Tuple[str, List[str], int]:
+    """
+    Writes record fields to a temporary JSONL file as they arrive.
+    Returns (spool_path, headers, record_count); headers are the union of all field names in first-seen order.
+    """
+    headers: Dict[str, None] = {}  # dict as an ordered set
+    count = 0
+    fd, spool_path = tempfile.mkstemp(prefix="export_", suffix=".jsonl", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as spool:
+            async for record in records:
+                fields = record.get("fields", {})
+                for name in fields:
+                    headers.setdefault(name, None)
+                spool.write(json.dumps(fields, ensure_ascii=False))
+                spool.write("\n")
+                count += 1
+    except BaseException:
+        os.remove(spool_path)
+        raise
+    return spool_path, list(headers), count
+
+
+def _iter_spooled_rows(spool_path: str, headers: List[str]):
+    with open(spool_path, "r", encoding="utf-8") as spool:
+        for line in spool:
+            fields = json.loads(line)
+            yield [_cell_value(fields.get(h, "")) for h in headers]
+
+
+def _cell_value(value: Any) -> Any:
+    """Lists/dicts (attachments, links, multi-select) are written as JSON text."""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def write_csv(spool_path: str, headers: List[str], output_path: str) -> str:
+    with open(output_path, "w", newline="", encoding="utf-8-sig") as output:
+        writer = csv.writer(output)
+        writer.writerow(headers)
+        writer.writerows(_iter_spooled_rows(spool_path, headers))
+    return output_path
+
+
+def write_xlsx(spool_path: str, headers: List[str], output_path: str) -> str:
+    import openpyxl
+    from openpyxl.utils import get_column_letter
+
+    # write_only: rows are streamed to disk, the workbook is never kept in memory
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for i, _ in enumerate(headers, 1):
+        ws.column_dimensions[get_column_letter(i)].width = 20
+    ws.append(headers)
+    for row in _iter_spooled_rows(spool_path, headers):
+        ws.append(row)
+    wb.save(output_path)
+    return output_path
+
+
+EXPORT_WRITERS = {
+    "csv": write_csv,
+    "xlsx": write_xlsx,
+}
+
+
+async def export_records(records: AsyncIterator[Dict[str, Any]], export_format: str, directory: str) -> Tuple[str, int]:
+    """
+    Streams records into a CSV/XLSX file in directory.
+    Returns (file_path, record_count); the caller is responsible for removing the file.
+    """
+    writer = EXPORT_WRITERS[export_format]
+    spool_path, headers, count = await spool_records(records, directory)
+    fd, output_path = tempfile.mkstemp(prefix="export_", suffix=f".{export_format}", dir=directory)
+    os.close(fd)
+    try:
+        # Запись файла - чистая CPU-работа (особенно openpyxl), выполняется в пуле процессов
+        await run_in_process(writer, spool_path, headers, output_path)
+    except BaseException:
+        os.remove(output_path)
+        raise
+    finally:
+        os.remove(spool_path)
+    return output_path, count
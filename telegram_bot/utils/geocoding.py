@@ -0,0 +1,71 @@
+import logging
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from .cache import LRUCache
+from ..database import sqlite_db
+
+logger = logging.getLogger(__name__)
+
+GEOCODING_URL = "http://api.openweathermap.org/geo/1.0/direct"
+
+# In-memory LRU in front of the geocode_cache table (city coordinates practically never change)
+geocode_lru = LRUCache("geocoding", max_entries=2048)
+
+
+def normalize_city_query(city_name: str) -> str:
+    """Normalizes free-text city input (case and whitespace) into the geocoding cache key."""
+    return " ".join(city_name.split()).casefold()
+
+
+async def fetch_geocode(api_key: str, city_name: str) -> Optional[Dict[str, Any]]:
+    """
+    Calls the OpenWeatherMap geocoding API (bypasses the caches).
+    Returns {'name', 'country', 'lat', 'lon'} or None if the city is not found or on error.
+    """
+    params = {"q": city_name, "limit": 1, "appid": api_key}
+    async with aiohttp.ClientSession() as session:
+        try:
+            async with session.get(GEOCODING_URL, params=params) as response:
+                response.raise_for_status()
+                results = await response.json()
+        except Exception as e:
+            logger.error(f"OpenWeatherMap geocoding error for '{city_name}': {e}", exc_info=True)
+            return None
+
+    if not results:
+        logger.info(f"OpenWeatherMap geocoding found nothing for '{city_name}'.")
+        return None
+
+    place = results[0]
+    return {
+        'name': place.get('local_names', {}).get('ru') or place.get('name') or city_name,
+        'country': place.get('country'),
+        'lat': place['lat'],
+        'lon': place['lon'],
+    }
+
+
+async def resolve_city(api_key: str, city_name: str) -> Optional[Dict[str, Any]]:
+    """
+    Resolves a city name to coordinates and canonical name: LRU -> geocode_cache table -> API.
+    Successful API results are written back to both layers; misses are not cached.
+    """
+    query_key = normalize_city_query(city_name)
+    if not query_key:
+        return None
+
+    place = geocode_lru.get(query_key)
+    if place is not None:
+        return place
+
+    place = await sqlite_db.get_geocode(query_key)
+    if place is None:
+        place = await fetch_geocode(api_key, city_name)
+        if place is None:
+            return None
+        await sqlite_db.save_geocode(query_key, place['name'], place['country'], place['lat'], place['lon'])
+
+    geocode_lru.set(query_key, place)
+    return place
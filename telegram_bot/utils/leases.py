@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from apscheduler.events import JobSubmissionEvent
+
+from .. import config
+from ..database import sqlite_db
+
+logger = logging.getLogger(__name__)
+
+# Несколько экземпляров бота работают с одной БД и одним хранилищем заданий APScheduler (SQLAlchemyJobStore).
+# Срабатывание обычно получает один экземпляр: планировщик, проснувшийся первым, выбирает задание из общего
+# хранилища и сдвигает его next_run_time, и остальные видят уже следующее срабатывание. Но выборка и сдвиг
+# не атомарны между процессами, поэтому два планировщика, проснувшиеся одновременно, могут запустить одно
+# срабатывание оба. Запуск выполняет тот, кто первым вставил строку (job_id, плановое время) в run_leases;
+# второй видит занятую аренду и пропускает запуск. Запуск никогда не откладывается.
+# Аренда открыта, пока запуск идет (finish_run). Экземпляр без heartbeat дольше SCHEDULER_INSTANCE_TTL_SECONDS
+# считается остановленным: его открытые аренды и запуски в журнале закрывает с ошибкой другой экземпляр
+# (sqlite_db.recover_lost_runs), а о потерянных запусках сообщает on_lost_runs.
+
+INSTANCE_ID = config.SCHEDULER_INSTANCE_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+# Старые аренды нужны только на время срабатывания, храним сутки
+LEASE_KEEP_SECONDS = 24 * 3600
+
+# Живые экземпляры по последнему heartbeat (этот экземпляр - всегда)
+_live_instances: List[str] = [INSTANCE_ID]
+# Плановое время срабатывания по job_id: записывается при отправке задания исполнителю (EVENT_JOB_SUBMITTED)
+# и забирается функцией задания, которая запускается уже после события
+_scheduled_times: Dict[str, datetime] = {}
+
+lease_stats = {'claimed': 0, 'yielded': 0, 'recovered': 0}
+
+# Сообщает о запусках остановившихся экземпляров (назначается в bot.py: scheduled_handlers.report_lost_runs)
+on_lost_runs: Optional[Callable[[List[Dict[str, Any]]], Awaitable[None]]] = None
+
+
+def on_job_submitted(event: JobSubmissionEvent) -> None:
+    """Listener for EVENT_JOB_SUBMITTED: remembers the scheduled run time of the submitted job."""
+    if event.scheduled_run_times:
+        # При coalesce несколько пропущенных срабатываний выполняются одним запуском - берем последнее
+        _scheduled_times[event.job_id] = event.scheduled_run_times[-1]
+
+
+def take_scheduled_time(job_id: str) -> Optional[datetime]:
+    """Scheduled run time of the current run of job_id (None if the job was not started by the scheduler)."""
+    return _scheduled_times.pop(job_id, None)
+
+
+async def heartbeat() -> None:
+    """
+    Records this instance's heartbeat, refreshes the list of live instances, closes the runs of
+    instances that stopped (reporting them to on_lost_runs) and prunes stale state.
+    """
+    global _live_instances
+    now = time.time()
+    await sqlite_db.record_scheduler_heartbeat(INSTANCE_ID, socket.gethostname(), os.getpid(), now)
+    min_heartbeat_at = now - config.SCHEDULER_INSTANCE_TTL_SECONDS
+    live = await sqlite_db.list_live_scheduler_instances(min_heartbeat_at)
+    if INSTANCE_ID not in live:
+        live.append(INSTANCE_ID)
+    if live != _live_instances:
+        logger.info(f"Экземпляры планировщика: {', '.join(live)}")
+    _live_instances = live
+    lost = await sqlite_db.recover_lost_runs(live, now)
+    if lost:
+        lease_stats['recovered'] += len(lost)
+        logger.warning(f"Закрыто запусков остановившихся экземпляров: {len(lost)}")
+        if on_lost_runs is not None:
+            await on_lost_runs(lost)
+    await sqlite_db.prune_scheduler_state(min_heartbeat_at, now - LEASE_KEEP_SECONDS)
+
+
+async def run_heartbeat() -> None:
+    """Heartbeat loop (started in bot.py, cancelled on shutdown)."""
+    while True:
+        await asyncio.sleep(config.SCHEDULER_HEARTBEAT_SECONDS)
+        try:
+            await heartbeat()
+        except Exception as e:
+            logger.error(f"Ошибка heartbeat экземпляра {INSTANCE_ID}: {e}")
+
+
+async def leave() -> None:
+    """Removes this instance from the list of live instances at shutdown without waiting for the TTL."""
+    try:
+        await sqlite_db.remove_scheduler_instance(INSTANCE_ID)
+    except Exception as e:
+        logger.error(f"Не удалось удалить экземпляр {INSTANCE_ID} из списка: {e}")
+
+
+async def finish_run(job_id: str, scheduled_for: datetime) -> None:
+    """Closes the lease of a claimed run once it is over; errors are logged (the lease is then closed by recovery)."""
+    try:
+        await sqlite_db.finish_run_lease(job_id, scheduled_for.isoformat(), time.time())
+    except Exception as e:
+        logger.error(f"Не удалось закрыть аренду запуска {job_id} ({scheduled_for.isoformat()}): {e}")
+
+
+async def claim_run(job_id: str, scheduled_for: datetime) -> bool:
+    """
+    Claims the run of job_id scheduled for scheduled_for. True - this instance executes it,
+    False - another instance that received the same fire already has.
+    """
+    scheduled_for_str = scheduled_for.isoformat()
+    claimed = await sqlite_db.claim_scheduled_run(job_id, scheduled_for_str, INSTANCE_ID, time.time())
+    if claimed:
+        lease_stats['claimed'] += 1
+    else:
+        lease_stats['yielded'] += 1
+        logger.info(f"Запуск {job_id} ({scheduled_for_str}) уже выполняется другим экземпляром")
+    return claimed
+
+
+def format_lease_stats() -> str:
+    return (
+        f"Экземпляры планировщика: {len(_live_instances)} (этот: {INSTANCE_ID}); "
+        f"запусков выполнено: {lease_stats['claimed']}, пропущено повторных срабатываний: {lease_stats['yielded']}, "
+        f"закрыто потерянных запусков остановившихся экземпляров: {lease_stats['recovered']}"
+    )
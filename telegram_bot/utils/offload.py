@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .. import config
+
+logger = logging.getLogger(__name__)
+
+# Вынос тяжелой работы из event loop aiogram:
+# - поток: блокирующий ввод-вывод (удаление временных директорий, запись файлов);
+# - процесс: чистые CPU-задачи (запись XLSX, разбор больших JSON). Функции и аргументы должны быть picklable.
+
+
+def _timed_call(func: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Tuple[Any, float, float]:
+    """Runs func in the worker and reports when it started (wall clock) and how long it ran."""
+    started_at = time.time()
+    result = func(*args, **kwargs)
+    return result, started_at, time.time() - started_at
+
+
+class OffloadPool:
+    """Executor wrapper that tracks queue depth, queue wait and run time of offloaded tasks."""
+
+    def __init__(self, name: str, executor_factory: Callable[[], Executor]):
+        self.name = name
+        self._executor_factory = executor_factory
+        self._executor: Optional[Executor] = None
+        self.pending = 0  # Submitted and not finished yet (queued + running)
+        self.peak_pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = self._executor_factory()
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        submitted_at = time.time()
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            result, started_at, run_time = await loop.run_in_executor(self._get_executor(), _timed_call, func, args, kwargs)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.total_wait += max(started_at - submitted_at, 0.0)
+        self.total_run += run_time
+        self.max_run = max(self.max_run, run_time)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'pending': self.pending,
+            'peak_pending': self.peak_pending,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'avg_run': self.total_run / self.completed if self.completed else 0.0,
+            'max_run': self.max_run,
+        }
+
+
+thread_pool = OffloadPool("threads", lambda: ThreadPoolExecutor(max_workers=config.OFFLOAD_THREAD_WORKERS, thread_name_prefix="offload"))
+process_pool = OffloadPool("processes", lambda: ProcessPoolExecutor(max_workers=config.OFFLOAD_PROCESS_WORKERS))
+
+
+async def run_in_thread(func: Callable, *args, **kwargs) -> Any:
+    """Runs blocking I/O-ish work in the shared thread pool."""
+    return await thread_pool.run(func, *args, **kwargs)
+
+
+async def run_in_process(func: Callable, *args, **kwargs) -> Any:
+    """Runs pure-CPU work in the shared process pool."""
+    return await process_pool.run(func, *args, **kwargs)
+
+
+async def loads_json(text: str) -> Any:
+    """json.loads that moves large payloads (OFFLOAD_JSON_MIN_BYTES and up) to the process pool."""
+    if len(text) < config.OFFLOAD_JSON_MIN_BYTES:
+        return json.loads(text)
+    return await run_in_process(json.loads, text)
+
+
+def offload_stats() -> list:
+    return [thread_pool.stats(), process_pool.stats()]
+
+
+def shutdown_offload() -> None:
+    thread_pool.shutdown()
+    process_pool.shutdown()
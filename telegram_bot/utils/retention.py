@@ -0,0 +1,105 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Set, Tuple
+
+from .. import config
+from ..database import sqlite_db
+from .leases import claim_run, take_scheduled_time
+from .offload import run_in_thread
+
+logger = logging.getLogger(__name__)
+
+# Ежедневная очистка: старые записи истории сворачиваются в дневные итоги по источникам,
+# длинные сообщения об ошибках сжимаются в архив, файлы результатов без ссылок из истории удаляются.
+
+RETENTION_JOB_ID = "history_retention"
+
+# Отчет последнего запуска (для /stats)
+last_retention_report: Optional[Dict[str, Any]] = None
+
+
+def _remove_unreferenced_files(directory: str, referenced: Set[str], min_age_seconds: float) -> Tuple[int, int]:
+    """Deletes files under directory that the history does not reference; returns (files, bytes)."""
+    removed = 0
+    removed_bytes = 0
+    now = time.time()
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for name in files:
+            path = os.path.abspath(os.path.join(root, name))
+            if path in referenced:
+                continue
+            try:
+                stat = os.stat(path)
+                # Свежие файлы могут принадлежать операции, которая еще выполняется
+                if now - stat.st_mtime < min_age_seconds:
+                    continue
+                os.remove(path)
+                removed += 1
+                removed_bytes += stat.st_size
+            except OSError as e:
+                logger.warning(f"Не удалось удалить файл {path}: {e}")
+        if root != directory and not os.listdir(root):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+    return removed, removed_bytes
+
+
+async def run_retention() -> Optional[Dict[str, Any]]:
+    """Runs all retention steps and returns a report of what was removed and how much space was reclaimed."""
+    global last_retention_report
+    scheduled_for = take_scheduled_time(RETENTION_JOB_ID)
+    if scheduled_for is not None and not await claim_run(RETENTION_JOB_ID, scheduled_for):
+        return last_retention_report # Очистку выполнил другой экземпляр
+    started = time.monotonic()
+    cutoff = (datetime.now() - timedelta(days=config.HISTORY_RETENTION_DAYS)).isoformat()
+
+    rolled_up = await sqlite_db.rollup_upload_history(cutoff)
+    archived, message_bytes = await sqlite_db.archive_long_error_messages(config.ERROR_MESSAGE_INLINE_CHARS)
+    runs_pruned = await sqlite_db.prune_schedule_runs(cutoff)
+    referenced = await sqlite_db.list_referenced_upload_files()
+    files_removed, file_bytes = 0, 0
+    if os.path.isdir(config.TEMP_FILES_DIR):
+        files_removed, file_bytes = await run_in_thread(
+            _remove_unreferenced_files, config.TEMP_FILES_DIR, referenced, config.RESULT_FILE_GRACE_HOURS * 3600
+        )
+
+    report = {
+        'finished_at': datetime.now().isoformat(),
+        'rows_rolled_up': rolled_up,
+        'messages_archived': archived,
+        'schedule_runs_pruned': runs_pruned,
+        'message_bytes_saved': max(message_bytes, 0),
+        'files_removed': files_removed,
+        'file_bytes_removed': file_bytes,
+        # Удаленные строки освобождают страницы внутри файла БД; размер файла уменьшит только VACUUM
+        'db_free_bytes': await sqlite_db.get_database_free_bytes(),
+        'duration_seconds': time.monotonic() - started,
+    }
+    last_retention_report = report
+    logger.info(f"Очистка истории: {format_retention_report(report)}")
+    return report
+
+
+def _format_bytes(size: int) -> str:
+    for unit in ("Б", "КиБ", "МиБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГиБ"
+
+
+def format_retention_report(report: Optional[Dict[str, Any]]) -> str:
+    if report is None:
+        return "Очистка истории еще не запускалась."
+    return (
+        f"свернуто записей {report['rows_rolled_up']}, "
+        f"сжато сообщений {report['messages_archived']} ({_format_bytes(report['message_bytes_saved'])}), "
+        f"удалено из журнала запусков {report['schedule_runs_pruned']}, "
+        f"удалено файлов {report['files_removed']} ({_format_bytes(report['file_bytes_removed'])}), "
+        f"свободно в БД {_format_bytes(report['db_free_bytes'])}, "
+        f"за {report['duration_seconds']:.1f} с"
+    )
@@ -0,0 +1,89 @@
+import json
+from typing import Any, Dict, List, Optional
+
+# Формирование аргументов командной строки data_extractor из параметров бота.
+# Используется и ручным запуском (handle_confirm_upload), и запланированными заданиями.
+
+# Маппинг ключей параметров источника на аргументы Rust (должен совпадать с Args в data_extractor)
+SOURCE_ARG_MAP = {
+    'source_url': '--connection',
+    'source_user': '--user', 'source_pass': '--pass',
+    'source_query': '--query',
+    'db_name': '--db-name', 'collection_name': '--collection', # Для MongoDB
+    'key_pattern': '--key-pattern', # Для Redis
+    'org': '--org', 'bucket': '--bucket', 'index': '--index', # Для Elasticsearch (или других)
+    'es_query': '--query', # Для Elasticsearch
+    'redis_pattern': '--key-pattern', # Для Redis
+    'mongo_db': '--db-name', # Для MongoDB
+    'mongo_collection': '--collection', # Для MongoDB
+    'specific_params': '--specific-params-json', # Для других специфических параметров
+}
+
+# Маппинг параметров True Tabs на аргументы действия 'update'
+TT_ARG_MAP = {
+    'upload_api_token': '--api-token',
+    'upload_datasheet_id': '--datasheet-id',
+    'upload_field_map_json': '--field-map-json',
+    'record_id': '--record-id',
+    'field_updates_json': '--field-updates-json',
+}
+
+# Параметры, которые передаются JSON-строкой
+JSON_SOURCE_PARAMS = ('es_query', 'specific_params')
+
+# Служебные ключи сохраненной конфигурации, не являющиеся параметрами источника
+CONFIG_SERVICE_KEYS = ('id', 'name', 'source_type', 'is_default')
+
+
+class RustArgsError(ValueError):
+    """Параметр нельзя передать утилите (например, некорректный JSON). param - ключ параметра."""
+
+    def __init__(self, message: str, param: str):
+        super().__init__(message)
+        self.param = param
+
+
+def _json_value(key: str, value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            raise RustArgsError(f"Неверный JSON в параметре {key}", key)
+    raise RustArgsError(f"Неожиданный тип ({type(value).__name__}) параметра {key}", key)
+
+
+def build_rust_args(action: str, source_type: str, source_params: Dict[str, Any], tt_params: Optional[Dict[str, Any]] = None,
+                    output_filepath: Optional[str] = None) -> List[str]:
+    """
+    Builds data_extractor arguments for the action ('extract' / 'update').
+    Raises RustArgsError if a parameter cannot be converted.
+    """
+    rust_args = ["--action", action, "--source", source_type]
+
+    if action == 'update':
+        for key, value in (tt_params or {}).items():
+            if value is None or value == "":
+                continue
+            rust_arg_name = TT_ARG_MAP.get(key)
+            if rust_arg_name:
+                rust_args.extend([rust_arg_name, str(value)])
+
+    for key, value in source_params.items():
+        # Пропускаем None, пустые строки, ключи, которые не маппятся, или служебные ключи
+        if value is None or value == "" or key not in SOURCE_ARG_MAP or key in CONFIG_SERVICE_KEYS:
+            continue
+        if key in JSON_SOURCE_PARAMS:
+            rust_args.extend([SOURCE_ARG_MAP[key], json.dumps(_json_value(key, value))])
+        else:
+            rust_args.extend([SOURCE_ARG_MAP[key], str(value)])
+
+    if output_filepath:
+        rust_args.extend(["--output-xlsx-path", str(output_filepath)])
+
+    expected_headers = source_params.get('upload_expected_headers')
+    if expected_headers:
+        rust_args.extend(["--expected-headers", json.dumps(_json_value('upload_expected_headers', expected_headers))])
+
+    return rust_args
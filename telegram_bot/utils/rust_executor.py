@@ -1,15 +1,125 @@
 import subprocess
 import shlex
 import asyncio
+import logging
+import signal
 import time
 import os
 import json
-from ..config import RUST_EXECUTABLE_PATH
-from typing import Dict, Any, Optional
+import uuid
+from ..config import RUST_EXECUTABLE_PATH, RUST_RUN_TIMEOUT_SECONDS, RUST_TERMINATE_GRACE_SECONDS
+from .offload import loads_json
+from typing import Dict, Any, List, Optional
 import sys
 
+logger = logging.getLogger(__name__)
+
+# Как часто снимать пиковую память работающего процесса (секунды)
+MEMORY_SAMPLE_SECONDS = 0.5
+
+# Каждый процесс запускается в своей сессии (своей группе процессов): остановка завершает и все его дочерние процессы,
+# иначе они держат stdout открытым и communicate() не завершается
+_PROCESS_GROUPS = os.name == 'posix'
+
+# Запущенные процессы Rust по уникальному ID запуска (у одного чата может быть несколько запусков):
+# run_id -> {run_id, process, chat_id, origin, started_at, timeout_seconds, stop_reason, watchdog}.
+# Запись удаляется, когда завершается communicate(). stop_reason: 'timeout' или 'cancel', если процесс остановлен.
+running_processes: Dict[str, Dict[str, Any]] = {}
+# Задачи остановки, запущенные сторожевым таймером (ссылки, пока они выполняются)
+_watchdog_tasks: set = set()
+
+run_stats = {'started': 0, 'timed_out': 0, 'cancelled': 0}
+
+
+def _signal_group(process, sig: int) -> None:
+    try:
+        if _PROCESS_GROUPS:
+            os.killpg(process.pid, sig)
+        else:
+            process.send_signal(sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def terminate_process_group(process, grace_seconds: Optional[float] = None) -> None:
+    """SIGTERM to the process group, SIGKILL if the process has not exited within grace_seconds."""
+    grace_seconds = RUST_TERMINATE_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    if process.returncode is None:
+        _signal_group(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), grace_seconds)
+        except asyncio.TimeoutError:
+            logger.warning(f"Процесс Rust (PID {process.pid}) не завершился за {grace_seconds} сек после SIGTERM, отправляем SIGKILL")
+    # Дочерние процессы могли пережить основной - добиваем всю группу
+    if _PROCESS_GROUPS:
+        _signal_group(process, signal.SIGKILL)
+    elif process.returncode is None:
+        process.kill()
+    await process.wait()
+
+
+async def terminate_run(run_id: str, reason: str = 'cancel') -> bool:
+    """Stops a registered run (reason: 'cancel' or 'timeout'). False if the run has already finished."""
+    run = running_processes.get(run_id)
+    if run is None or run['process'].returncode is not None:
+        return False
+    if run['stop_reason'] is None:
+        run['stop_reason'] = reason
+        run_stats['timed_out' if reason == 'timeout' else 'cancelled'] += 1
+    logger.warning(f"Остановка запуска Rust {run_id} (PID {run['process'].pid}, чат {run['chat_id']}): {reason}")
+    await terminate_process_group(run['process'])
+    return True
+
+
+def runs_for_chat(chat_id: int, origin: Optional[str] = None) -> List[str]:
+    """IDs of the chat's running runs (origin: 'upload', 'scheduled' or None for all)."""
+    return [run_id for run_id, run in running_processes.items()
+            if run['chat_id'] == chat_id and (origin is None or run['origin'] == origin)]
+
+
+def _on_run_timeout(run_id: str) -> None:
+    task = asyncio.create_task(terminate_run(run_id, 'timeout'))
+    _watchdog_tasks.add(task)
+    task.add_done_callback(_watchdog_tasks.discard)
+
+
+def _register_run(process, communicate_future: asyncio.Future, chat_id: Optional[int], origin: str,
+                  timeout_seconds: Optional[int]) -> Dict[str, Any]:
+    run_id = uuid.uuid4().hex
+    timeout_seconds = RUST_RUN_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+    run = {
+        'run_id': run_id, 'process': process, 'chat_id': chat_id, 'origin': origin, 'started_at': time.time(),
+        'timeout_seconds': timeout_seconds, 'stop_reason': None, 'watchdog': None,
+    }
+    if timeout_seconds and timeout_seconds > 0:
+        run['watchdog'] = asyncio.get_running_loop().call_later(timeout_seconds, _on_run_timeout, run_id)
+    running_processes[run_id] = run
+    run_stats['started'] += 1
+
+    def _unregister(_future):
+        if run['watchdog'] is not None:
+            run['watchdog'].cancel()
+        running_processes.pop(run_id, None)
+
+    communicate_future.add_done_callback(_unregister)
+    return run
+
+
+def format_run_stats() -> str:
+    return (
+        f"Процессы Rust: выполняется {len(running_processes)}, запущено {run_stats['started']}, "
+        f"остановлено по времени {run_stats['timed_out']}, отменено {run_stats['cancelled']}"
+    )
+
+
 # Изменена возвращаемая структура
-async def execute_rust_command(args: list) -> Dict[str, Any]:
+async def execute_rust_command(args: list, chat_id: Optional[int] = None, origin: str = 'upload',
+                               timeout_seconds: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Запускает Rust утилиту и регистрирует запуск в running_processes (run_id в результате).
+    timeout_seconds - ограничение времени (None - RUST_RUN_TIMEOUT_SECONDS, 0 - без ограничения):
+    по его истечении сторожевой таймер останавливает группу процессов (stop_reason 'timeout').
+    """
     if not os.path.exists(RUST_EXECUTABLE_PATH):
         # Если исполняемый файл не найден, возвращаем ошибку сразу
         return {
@@ -34,15 +144,19 @@ async def execute_rust_command(args: list) -> Dict[str, Any]:
         process = await asyncio.create_subprocess_exec(
             *command,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            start_new_session=_PROCESS_GROUPS,
         )
         # Создаем задачу для communicate(), но НЕ ЖДЕМ ее завершения здесь
         communicate_future = asyncio.create_task(process.communicate())
+        run = _register_run(process, communicate_future, chat_id, origin, timeout_seconds)
 
         # Возвращаем информацию о запущенном процессе, включая сам объект process и future
         return {
             "status": "PROCESS_STARTED", # Новый статус, указывающий, что процесс запущен
             "process": process, # Возвращаем объект процесса
+            "run_id": run['run_id'], # Запись запуска в running_processes
+            "run": run,
             "communicate_future": communicate_future, # Возвращаем future для communicate
             "start_time": start_time, # Возвращаем время старта для расчета длительности
             "command_string": command_string, # Возвращаем строку команды для логов/отладки
@@ -64,4 +178,81 @@ async def execute_rust_command(args: list) -> Dict[str, Any]:
             "extracted_rows": None,
             "uploaded_records": None,
             "datasheet_id": None,
-        }
\ No newline at end of file
+        }
+
+
+def _read_peak_rss_kb(pid: int) -> Optional[int]:
+    """Peak resident memory of a running process (VmHWM, Linux only), None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
+
+
+async def _watch_peak_memory(pid: int, peak: Dict[str, int]) -> None:
+    # VmHWM сам хранит максимум, но после завершения процесса /proc/<pid> уже не прочитать - запоминаем последнее значение
+    while True:
+        value = _read_peak_rss_kb(pid)
+        if value is None:
+            return
+        peak["kb"] = max(peak.get("kb", 0), value)
+        await asyncio.sleep(MEMORY_SAMPLE_SECONDS)
+
+
+async def run_rust_command(args: list, chat_id: Optional[int] = None, origin: str = 'scheduled',
+                           timeout_seconds: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Запускает Rust утилиту, дожидается завершения и разбирает JSON-результат из stdout.
+    Возвращает словарь со status ('SUCCESS' / 'ERROR' / 'TIMEOUT' / 'CANCELLED'), message, duration_seconds,
+    file_path, extracted_rows, uploaded_records, datasheet_id и peak_memory_kb
+    (пиковая память процесса по замерам, None - замерить не удалось).
+    """
+    execution_info = await execute_rust_command(args, chat_id, origin, timeout_seconds)
+    if execution_info["status"] == "ERROR":
+        return execution_info
+
+    process = execution_info["process"]
+    peak: Dict[str, int] = {}
+    memory_watcher = asyncio.create_task(_watch_peak_memory(process.pid, peak))
+    try:
+        stdout_data, stderr_data = await execution_info["communicate_future"]
+    except asyncio.CancelledError:
+        # Запуск отменен (например, его сменил следующий запуск задания) - процесс не должен работать дальше
+        await terminate_process_group(process)
+        raise
+    finally:
+        memory_watcher.cancel()
+    duration = time.time() - execution_info["start_time"]
+    stdout_str = stdout_data.decode('utf-8', errors='ignore')
+    stderr_str = stderr_data.decode('utf-8', errors='ignore')
+
+    result = {"status": "ERROR", "message": None, "duration_seconds": duration, "file_path": None,
+              "extracted_rows": None, "uploaded_records": None, "datasheet_id": None,
+              "peak_memory_kb": peak.get("kb")}
+    stop_reason = execution_info["run"]["stop_reason"]
+    if stop_reason == 'timeout':
+        result["status"] = "TIMEOUT"
+        result["message"] = f"Запуск остановлен: превышено ограничение времени ({execution_info['run']['timeout_seconds']} сек)."
+        return result
+    if stop_reason == 'cancel':
+        result["status"] = "CANCELLED"
+        result["message"] = "Запуск остановлен по запросу."
+        return result
+    try:
+        json_result = await loads_json(stdout_str)
+        for key in ("status", "message", "file_path", "extracted_rows", "uploaded_records", "datasheet_id"):
+            if json_result.get(key) is not None:
+                result[key] = json_result[key]
+    except (json.JSONDecodeError, AttributeError):
+        result["message"] = f"Rust процесс завершился с кодом {process.returncode}, но stdout не является валидным JSON. Stderr:\n{stderr_str}\nStdout:\n{stdout_str}"
+        return result
+
+    if result["status"] != "SUCCESS" and process.returncode != 0 and not result["message"]:
+        result["message"] = f"Rust процесс завершился с ошибкой (код {process.returncode}). Stderr:\n{stderr_str}\nStdout:\n{stdout_str}"
+    if not result["message"]:
+        result["message"] = "Операция выполнена успешно." if result["status"] == "SUCCESS" else "Сообщение от утилиты отсутствует."
+    return result
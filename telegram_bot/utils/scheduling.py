@@ -0,0 +1,300 @@
+import hashlib
+import json
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from .. import config
+
+# Общие правила для запланированных заданий: создание триггера из сохраненных в БД аргументов
+# и политика запуска, одинаковые для загрузки на старте, создания и редактирования задания.
+
+# Тип "после других заданий": задание не имеет своего расписания и запускается, когда успешно завершились все его предшественники
+AFTER_TRIGGER_TYPE = 'after'
+
+
+# Что делать, если срабатывание пришло, а предыдущий запуск задания еще идет (trigger_args['overrun'])
+OVERRUN_POLICIES = {
+    'skip': "пропустить новый запуск",
+    'queue': "выполнить после текущего (в очереди не больше одного)",
+    'cancel': "остановить текущий и начать новый",
+}
+DEFAULT_OVERRUN_POLICY = 'skip'
+
+# Что делать с запусками, пропущенными, пока бот не работал (trigger_args['catchup'], trigger_args['catchup_limit']).
+# 'skip' - как раньше: выполняется только запуск, опоздавший не больше чем на SCHEDULED_MISFIRE_GRACE_SECONDS
+CATCHUP_POLICIES = {
+    'skip': "пропустить",
+    'once': "выполнить один раз",
+    'all': "выполнить все (но не больше лимита)",
+}
+DEFAULT_CATCHUP_POLICY = 'skip'
+
+
+def job_policy() -> Dict[str, Any]:
+    """
+    max_instances=2 - выполняющийся запуск и еще одно срабатывание: его судьбу решает политика наложения
+    задания (scheduled_task_executor), остальные срабатывания отбрасывает планировщик;
+    coalesce - несколько пропущенных срабатываний выполняются одним запуском;
+    misfire_grace_time - насколько поздно (в секундах) запуск еще имеет смысл.
+    """
+    return {
+        'max_instances': 2,
+        'coalesce': True,
+        'misfire_grace_time': config.SCHEDULED_MISFIRE_GRACE_SECONDS,
+    }
+
+
+class OffsetTrigger(BaseTrigger):
+    """
+    Shifts every fire time of the wrapped trigger by a constant offset, so the job keeps its cadence
+    but does not start at the same second as all other jobs on a round schedule.
+    """
+
+    def __init__(self, trigger: BaseTrigger, offset_seconds: int):
+        self.trigger = trigger
+        self.offset = timedelta(seconds=offset_seconds)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        # Внутренний триггер считает время без сдвига
+        if previous_fire_time is not None:
+            previous_fire_time = previous_fire_time - self.offset
+        next_fire_time = self.trigger.get_next_fire_time(previous_fire_time, now - self.offset)
+        return next_fire_time + self.offset if next_fire_time is not None else None
+
+    def __str__(self):
+        return f"{self.trigger} +{int(self.offset.total_seconds())}s"
+
+    def __repr__(self):
+        return f"<OffsetTrigger ({self.trigger!r}, offset={int(self.offset.total_seconds())}s)>"
+
+
+def spread_offset(job_id: str, window_seconds: int) -> int:
+    """Deterministic offset in [0, window_seconds) derived from the job id (same on every restart)."""
+    if window_seconds <= 0:
+        return 0
+    digest = hashlib.sha256(job_id.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % window_seconds
+
+
+def build_trigger(trigger_type: str, trigger_args: Dict[str, Any], job_id: Optional[str] = None):
+    """
+    Creates an APScheduler trigger from the trigger_type / trigger_args stored in scheduled_jobs. Raises ValueError.
+
+    Повторяющиеся задания (interval, cron) с job_id сдвигаются на постоянную величину внутри окна:
+    trigger_args['jitter_seconds'] задает окно задания (0 - без сдвига), иначе действует SCHEDULE_SPREAD_SECONDS.
+    """
+    trigger_args = dict(trigger_args)
+    jitter_seconds = trigger_args.pop('jitter_seconds', None)
+    for key in ('overrun', 'catchup', 'catchup_limit', 'timeout_seconds'):
+        trigger_args.pop(key, None)
+    if trigger_type == 'interval':
+        trigger = IntervalTrigger(**trigger_args)
+    elif trigger_type == 'cron':
+        # UI сохраняет выражение crontab; поля CronTrigger (hour=..., minute=...) тоже поддерживаются
+        if 'cron_expression' in trigger_args:
+            if not trigger_args['cron_expression']:
+                raise ValueError("Cron expression is missing.")
+            trigger = CronTrigger.from_crontab(trigger_args['cron_expression'])
+        else:
+            trigger = CronTrigger(**trigger_args)
+    elif trigger_type == AFTER_TRIGGER_TYPE:
+        raise ValueError("Задание запускается после других заданий, а не по времени.")
+    elif trigger_type == 'date':
+        run_date_str = trigger_args.get('run_date')
+        if not run_date_str:
+            raise ValueError("Run date is missing.")
+        return DateTrigger(run_date=datetime.fromisoformat(run_date_str))
+    else:
+        raise ValueError(f"Неподдерживаемый тип триггера: {trigger_type}")
+
+    window = config.SCHEDULE_SPREAD_SECONDS if jitter_seconds is None else int(jitter_seconds)
+    if isinstance(trigger, IntervalTrigger):
+        # Сдвиг больше интервала ничего не разносит, только откладывает первый запуск
+        window = min(window, int(trigger.interval_length))
+    offset = spread_offset(job_id, window) if job_id else 0
+    return OffsetTrigger(trigger, offset) if offset else trigger
+
+
+def overrun_policy(job: Dict[str, Any]) -> str:
+    policy = json.loads(job.get('trigger_args_json') or '{}').get('overrun')
+    return policy if policy in OVERRUN_POLICIES else DEFAULT_OVERRUN_POLICY
+
+
+def catchup_policy(job: Dict[str, Any]) -> str:
+    policy = json.loads(job.get('trigger_args_json') or '{}').get('catchup')
+    return policy if policy in CATCHUP_POLICIES else DEFAULT_CATCHUP_POLICY
+
+
+def catchup_limit(job: Dict[str, Any]) -> int:
+    """Сколько последних пропущенных запусков выполняет политика 'all'."""
+    limit = json.loads(job.get('trigger_args_json') or '{}').get('catchup_limit')
+    return int(limit) if limit else config.SCHEDULE_CATCHUP_MAX_RUNS
+
+
+def missed_fire_times(trigger: BaseTrigger, first_missed: datetime, now: datetime, limit: int) -> tuple:
+    """
+    Fire times of trigger from first_missed up to now: (number of missed runs, the last `limit` of them in time order).
+    After a long outage only the tail is enumerated, the number of earlier runs is estimated from the period.
+    """
+    limit = max(limit, 1)
+    start, total = first_missed, 0
+    period = trigger_period_seconds(trigger, now)
+    if period and (now - first_missed).total_seconds() > period * (limit + 1):
+        tail_start = trigger.get_next_fire_time(None, now - timedelta(seconds=period * (limit + 1)))
+        if tail_start is not None and first_missed < tail_start <= now:
+            start = tail_start
+            total = int((start - first_missed).total_seconds() // period)
+    times: deque = deque(maxlen=limit)
+    fire_time = start
+    while fire_time is not None and fire_time <= now:
+        times.append(fire_time)
+        total += 1
+        fire_time = trigger.get_next_fire_time(fire_time, now)
+    return total, list(times)
+
+
+def run_timeout_seconds(job: Optional[Dict[str, Any]]) -> int:
+    """Ограничение времени запуска задания (trigger_args['timeout_seconds'], иначе RUST_RUN_TIMEOUT_SECONDS; 0 - без ограничения)."""
+    timeout = json.loads(job.get('trigger_args_json') or '{}').get('timeout_seconds') if job else None
+    return config.RUST_RUN_TIMEOUT_SECONDS if timeout is None else int(timeout)
+
+
+def trigger_period_seconds(trigger: BaseTrigger, now: datetime) -> Optional[float]:
+    """Time between two consecutive fire times from now (None for one-off triggers)."""
+    if isinstance(trigger, OffsetTrigger):
+        trigger = trigger.trigger
+    if isinstance(trigger, IntervalTrigger):
+        return trigger.interval_length
+    if isinstance(trigger, DateTrigger):
+        return None
+    first = trigger.get_next_fire_time(None, now)
+    if first is None:
+        return None
+    second = trigger.get_next_fire_time(first, first + timedelta(seconds=1))
+    return (second - first).total_seconds() if second is not None else None
+
+
+def backoff_delay_seconds(period_seconds: float, consecutive_failures: int) -> float:
+    """Effective interval after consecutive failures: period * 2^failures, capped at SCHEDULE_BACKOFF_MAX_SECONDS."""
+    if consecutive_failures <= 0:
+        return period_seconds
+    delay = period_seconds * 2 ** min(consecutive_failures, 30)
+    return max(period_seconds, min(delay, config.SCHEDULE_BACKOFF_MAX_SECONDS))
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} сек"
+    parts = []
+    for unit_seconds, unit in ((86400, "д"), (3600, "ч"), (60, "мин")):
+        if seconds >= unit_seconds:
+            parts.append(f"{seconds // unit_seconds} {unit}")
+            seconds %= unit_seconds
+    return " ".join(parts)
+
+
+def definition_fingerprint(job_data: Dict[str, Any]) -> str:
+    """
+    Hash of everything that ends up in the APScheduler job for this scheduled_jobs row: the definition
+    plus the global settings that shape the trigger and the run policy. Stored in the job kwargs.
+    """
+    definition = {key: job_data.get(key) for key in (
+        'name', 'chat_id', 'source_config_name', 'tt_config_name', 'action', 'trigger_type', 'trigger_args_json'
+    )}
+    definition['spread_seconds'] = config.SCHEDULE_SPREAD_SECONDS
+    definition['policy'] = job_policy()
+    return hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def upstream_job_ids(job: Dict[str, Any]) -> List[str]:
+    """
+    Задания, после успешного завершения которых запускается job (trigger_type 'after', trigger_args {'job_ids': [...]}).
+    Для заданий с расписанием по времени - пустой список.
+    """
+    if job.get('trigger_type') != AFTER_TRIGGER_TYPE:
+        return []
+    return list(json.loads(job.get('trigger_args_json') or '{}').get('job_ids', []))
+
+
+def downstream_jobs(jobs: List[Dict[str, Any]], job_id: str) -> List[Dict[str, Any]]:
+    """Задания, которые ждут завершения job_id."""
+    return [job for job in jobs if job_id in upstream_job_ids(job)]
+
+
+def find_dependency_cycle(jobs: List[Dict[str, Any]], job_id: str, new_upstream_ids: List[str]) -> Optional[List[str]]:
+    """
+    Checks whether making job_id depend on new_upstream_ids closes a cycle.
+    Returns the cycle as a list of job ids (job_id, ..., job_id) or None.
+    """
+    upstreams = {job['job_id']: upstream_job_ids(job) for job in jobs}
+    upstreams[job_id] = list(new_upstream_ids)
+
+    # Обход в глубину по ребрам "зависит от": цикл есть, если из job_id снова приходим в job_id
+    stack = [(job_id, [job_id])]
+    visited = set()
+    while stack:
+        current, path = stack.pop()
+        for upstream_id in upstreams.get(current, []):
+            if upstream_id == job_id:
+                return path + [job_id]
+            if upstream_id not in visited:
+                visited.add(upstream_id)
+                stack.append((upstream_id, path + [upstream_id]))
+    return None
+
+
+def is_expired_date_trigger(trigger_type: str, trigger_args: Dict[str, Any]) -> bool:
+    """One-off (date) job whose run date has already passed."""
+    if trigger_type != 'date' or not trigger_args.get('run_date'):
+        return False
+    run_date = datetime.fromisoformat(trigger_args['run_date'])
+    return run_date < datetime.now(run_date.tzinfo)
+
+
+class StartTimeHistogram:
+    """Start times of scheduled runs (last `size` runs) grouped into buckets within the hour."""
+
+    def __init__(self, bucket_seconds: int = 10, size: int = 1000):
+        self.bucket_seconds = bucket_seconds
+        self._starts: deque = deque(maxlen=size)
+
+    def record(self, timestamp: Optional[float] = None) -> None:
+        self._starts.append(time.time() if timestamp is None else timestamp)
+
+    def buckets(self) -> List[tuple]:
+        """[(bucket_start_second_of_hour, runs)] for non-empty buckets, in time order."""
+        counts = Counter(int(ts % 3600) // self.bucket_seconds * self.bucket_seconds for ts in self._starts)
+        return sorted(counts.items())
+
+    def peak_per_second(self) -> int:
+        """Largest number of runs that started within the same second."""
+        counts = Counter(int(ts) for ts in self._starts)
+        return max(counts.values(), default=0)
+
+    def total(self) -> int:
+        return len(self._starts)
+
+
+start_histogram = StartTimeHistogram()
+
+
+def format_start_histogram(histogram: StartTimeHistogram, max_rows: int = 12) -> str:
+    if not histogram.total():
+        return "Запусков по расписанию еще не было."
+    buckets = histogram.buckets()
+    widest = max(runs for _, runs in buckets)
+    # Показываем самые загруженные интервалы, в порядке времени
+    shown = sorted(sorted(buckets, key=lambda item: -item[1])[:max_rows])
+    lines = [f"Запуски по расписанию (последние {histogram.total()}, макс. в одну секунду: {histogram.peak_per_second()}):"]
+    for start, runs in shown:
+        bar = "▇" * max(1, round(runs / widest * 10))
+        lines.append(f"<code>:{start // 60:02d}:{start % 60:02d}</code> {bar} {runs}")
+    return "\n".join(lines)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import math
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from .. import config
+
+logger = logging.getLogger(__name__)
+
+TRUE_TABS_API_BASE_URL = "https://true.tabs.sale/fusion/v1"
+
+
+class TrueTabsAPIError(Exception):
+    """True Tabs answered with success=false in the response envelope."""
+
+
+class TrueTabsClient:
+    """
+    Long-lived True Tabs API client shared by the whole bot.
+
+    One pooled httpx connection pool (keep-alive, optional HTTP/2) and one limit of concurrent
+    requests for all handlers; the API token is injected per call because it belongs to a TT config.
+    """
+
+    def __init__(self, base_url: str = TRUE_TABS_API_BASE_URL, http2: Optional[bool] = None, max_concurrent_requests: Optional[int] = None):
+        http2 = config.TRUE_TABS_HTTP2 if http2 is None else http2
+        if http2:
+            try:
+                import h2  # noqa: F401  (httpx needs the h2 package for HTTP/2)
+            except ImportError:
+                logger.warning("TRUE_TABS_HTTP2 включен, но пакет h2 не установлен (pip install httpx[http2]). Используется HTTP/1.1.")
+                http2 = False
+
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            http2=http2,
+            timeout=httpx.Timeout(config.TRUE_TABS_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests or config.TRUE_TABS_MAX_CONCURRENT_REQUESTS)
+
+    @property
+    def is_closed(self) -> bool:
+        return self._client.is_closed
+
+    async def request(self, method: str, path: str, api_token: str, **kwargs) -> Dict[str, Any]:
+        """Sends an authorized request and returns the decoded JSON envelope; raises on HTTP or API errors."""
+        headers = {"Authorization": f"Bearer {api_token}", **kwargs.pop("headers", {})}
+        async with self._semaphore:
+            response = await self._client.request(method, path, headers=headers, **kwargs)
+        response.raise_for_status()
+        payload = response.json()
+        if payload.get("success") is False:
+            raise TrueTabsAPIError(f"True Tabs API error {payload.get('code')}: {payload.get('message')}")
+        return payload
+
+    async def get_records_page(self, api_token: str, datasheet_id: str, page_num: int, page_size: int, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Fetches one page of datasheet records. Returns the 'data' envelope
+        ({'total', 'pageNum', 'pageSize', 'records'}).
+        """
+        query = {"fieldKey": "name", **(params or {}), "pageNum": page_num, "pageSize": page_size}
+        payload = await self.request("GET", f"/datasheets/{datasheet_id}/records", api_token, params=query)
+        return payload.get("data") or {}
+
+    async def get_field_names(self, api_token: str, datasheet_id: str, view_id: Optional[str] = None) -> List[str]:
+        """Returns the datasheet's field names (in view order if view_id is given)."""
+        params = {"viewId": view_id} if view_id else None
+        payload = await self.request("GET", f"/datasheets/{datasheet_id}/fields", api_token, params=params)
+        return [field["name"] for field in (payload.get("data") or {}).get("fields", [])]
+
+    async def update_records(self, api_token: str, datasheet_id: str, records: List[Dict[str, Any]], field_key: str = "name") -> Dict[str, Any]:
+        """Updates records (PATCH, [{'recordId', 'fields'}]) and returns the response envelope."""
+        return await self.request("PATCH", f"/datasheets/{datasheet_id}/records", api_token, json={"records": records, "fieldKey": field_key})
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+def build_export_params(tt_config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Query parameters for exporting with the TT config's saved settings: only the chosen fields,
+    rows matching the filter formula and/or the view - so True Tabs sends only what is needed.
+    """
+    params: Dict[str, Any] = {}
+    if tt_config.get("export_fields"):
+        params["fields"] = ",".join(tt_config["export_fields"])
+    if tt_config.get("export_filter_formula"):
+        params["filterByFormula"] = tt_config["export_filter_formula"]
+    if tt_config.get("export_view_id"):
+        params["viewId"] = tt_config["export_view_id"]
+    return params
+
+
+# Клиент создается при старте в bot.py; если его нет (например, в скриптах) - создается по требованию
+_truetabs_client: Optional[TrueTabsClient] = None
+
+
+def set_truetabs_client(client: Optional[TrueTabsClient]) -> None:
+    global _truetabs_client
+    _truetabs_client = client
+
+
+def get_truetabs_client() -> TrueTabsClient:
+    """Returns the application-wide True Tabs client."""
+    global _truetabs_client
+    if _truetabs_client is None or _truetabs_client.is_closed:
+        _truetabs_client = TrueTabsClient()
+    return _truetabs_client
+
+
+async def iter_datasheet_records(api_token: str, datasheet_id: str, params: Optional[Dict[str, Any]] = None, page_size: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yields all datasheet records in order.
+
+    The first page tells the total count; the remaining pages are requested concurrently
+    (at most TRUE_TABS_MAX_CONCURRENT_REQUESTS in flight, only that many pages buffered ahead),
+    so the caller can start writing while later pages are still loading.
+    """
+    client = get_truetabs_client()
+    page_size = page_size or config.TRUE_TABS_PAGE_SIZE
+    first_page = await client.get_records_page(api_token, datasheet_id, 1, page_size, params)
+    for record in first_page.get("records", []):
+        yield record
+
+    total = first_page.get("total", 0)
+    page_count = math.ceil(total / page_size) if total else 1
+    if page_count <= 1:
+        return
+    logger.info(f"True Tabs datasheet {datasheet_id}: {total} records, {page_count} pages of {page_size}")
+
+    window = config.TRUE_TABS_MAX_CONCURRENT_REQUESTS
+    pending: Dict[int, asyncio.Task] = {}
+    next_page = 2
+    try:
+        for page_num in range(2, page_count + 1):
+            # Keep up to `window` pages in flight ahead of the one being yielded
+            while next_page <= page_count and next_page < page_num + window:
+                pending[next_page] = asyncio.create_task(client.get_records_page(api_token, datasheet_id, next_page, page_size, params))
+                next_page += 1
+            page = await pending.pop(page_num)
+            for record in page.get("records", []):
+                yield record
+    finally:
+        # Consumer stopped early or a page failed: don't leave requests running
+        for task in pending.values():
+            task.cancel()
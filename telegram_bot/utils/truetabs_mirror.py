@@ -0,0 +1,123 @@
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from .. import config
+from ..database import sqlite_db
+from .truetabs_api import get_truetabs_client, iter_datasheet_records
+
+logger = logging.getLogger(__name__)
+
+# Локальная копия таблицы True Tabs в SQLite. Первая синхронизация полная, дальше - только записи,
+# измененные после watermark (максимального updatedAt). Удаления в True Tabs инкрементально не видны,
+# поэтому при расхождении числа записей (и раз в TRUE_TABS_MIRROR_FULL_SYNC_HOURS) делается полная.
+
+UPSERT_BATCH_SIZE = 500
+# Запас при инкрементальном запросе: записи, измененные в ту же секунду, что и watermark
+WATERMARK_OVERLAP_MS = 1000
+
+
+def _modified_after_formula(watermark_ms: int) -> str:
+    since = datetime.utcfromtimestamp(max(watermark_ms - WATERMARK_OVERLAP_MS, 0) / 1000)
+    return f'IS_AFTER(LAST_MODIFIED_TIME(), "{since.strftime("%Y-%m-%dT%H:%M:%S.000Z")}")'
+
+
+async def _store_records(records: AsyncIterator[Dict[str, Any]], datasheet_id: str, sync_token: str) -> tuple:
+    """Writes records into the mirror in batches; returns (stored_count, max_updated_at_ms)."""
+    batch: List[Dict[str, Any]] = []
+    stored = 0
+    watermark_ms = None
+    async for record in records:
+        batch.append(record)
+        updated_at = record.get('updatedAt')
+        if updated_at is not None:
+            watermark_ms = updated_at if watermark_ms is None else max(watermark_ms, updated_at)
+        if len(batch) >= UPSERT_BATCH_SIZE:
+            await sqlite_db.upsert_mirror_records(datasheet_id, batch, sync_token)
+            stored += len(batch)
+            batch = []
+    if batch:
+        await sqlite_db.upsert_mirror_records(datasheet_id, batch, sync_token)
+        stored += len(batch)
+    return stored, watermark_ms
+
+
+async def _remote_record_count(api_token: str, datasheet_id: str) -> int:
+    page = await get_truetabs_client().get_records_page(api_token, datasheet_id, 1, 1)
+    return page.get('total', 0)
+
+
+def _full_sync_due(state: Dict[str, Any]) -> bool:
+    if not state.get('last_full_sync_at') or state.get('watermark_ms') is None:
+        return True
+    last_full_sync = datetime.fromisoformat(state['last_full_sync_at'])
+    return datetime.now() - last_full_sync > timedelta(hours=config.TRUE_TABS_MIRROR_FULL_SYNC_HOURS)
+
+
+async def sync_mirror(api_token: str, datasheet_id: str, force_full: bool = False) -> Dict[str, Any]:
+    """
+    Brings the local mirror of a datasheet up to date.
+    Returns {'mode': 'full'|'incremental', 'fetched': int, 'record_count': int}.
+    """
+    state = await sqlite_db.get_mirror_state(datasheet_id)
+    if state is None:
+        raise ValueError(f"Локальная копия таблицы {datasheet_id} не включена.")
+
+    full = force_full or _full_sync_due(state)
+    fetched = 0
+    if not full:
+        sync_token = uuid.uuid4().hex
+        try:
+            records = iter_datasheet_records(api_token, datasheet_id, params={"filterByFormula": _modified_after_formula(state['watermark_ms'])})
+            fetched, watermark_ms = await _store_records(records, datasheet_id, sync_token)
+            record_count = await sqlite_db.finish_mirror_sync(datasheet_id, sync_token, watermark_ms, full=False)
+            # Число записей разошлось - в True Tabs что-то удалили, нужна полная синхронизация
+            full = record_count != await _remote_record_count(api_token, datasheet_id)
+        except Exception as e:
+            logger.warning(f"Инкрементальная синхронизация таблицы {datasheet_id} не удалась, выполняется полная: {e}")
+            full = True
+
+    if full:
+        sync_token = uuid.uuid4().hex
+        fetched, watermark_ms = await _store_records(iter_datasheet_records(api_token, datasheet_id), datasheet_id, sync_token)
+        record_count = await sqlite_db.finish_mirror_sync(datasheet_id, sync_token, watermark_ms, full=True)
+
+    mode = 'full' if full else 'incremental'
+    logger.info(f"Локальная копия таблицы {datasheet_id}: синхронизация {mode}, получено {fetched}, всего {record_count}")
+    return {'mode': mode, 'fetched': fetched, 'record_count': record_count}
+
+
+async def get_mirrored_records(api_token: str, datasheet_id: str) -> Optional[AsyncIterator[Dict[str, Any]]]:
+    """
+    Returns an iterator over the local mirror, syncing first if it is older than
+    TRUE_TABS_MIRROR_MAX_AGE seconds. Returns None if the datasheet is not mirrored.
+    """
+    state = await sqlite_db.get_mirror_state(datasheet_id)
+    if state is None:
+        return None
+    if mirror_age_seconds(state) is None or mirror_age_seconds(state) > config.TRUE_TABS_MIRROR_MAX_AGE:
+        await sync_mirror(api_token, datasheet_id)
+    return sqlite_db.iter_mirror_records(datasheet_id)
+
+
+def mirror_age_seconds(state: Dict[str, Any]) -> Optional[float]:
+    if not state.get('last_synced_at'):
+        return None
+    return (datetime.now() - datetime.fromisoformat(state['last_synced_at'])).total_seconds()
+
+
+def format_mirror_freshness(state: Optional[Dict[str, Any]]) -> str:
+    """Human-readable freshness line for the export menu."""
+    if state is None:
+        return "Локальная копия: выключена (данные загружаются из True Tabs при каждой выгрузке)."
+    age = mirror_age_seconds(state)
+    if age is None:
+        return "Локальная копия: включена, еще не синхронизирована."
+    if age < 60:
+        age_text = "меньше минуты назад"
+    elif age < 3600:
+        age_text = f"{int(age // 60)} мин. назад"
+    else:
+        age_text = f"{age / 3600:.1f} ч. назад"
+    return f"Локальная копия: {state['record_count']} записей, обновлена {age_text}."